@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark for the normalization of HTML before it is converted by xhtml2pdf.
+
+Compares the single-pass normalizer (see htmlfilter.py) with lxml and with
+html5lib against the previous implementation with BeautifulSoup, which parsed
+each entry with html.parser and scanned the whole tree once per rule. All
+implementations get the same HTML like edited in Moodle (paragraphs with
+formatting, line breaks, lists, tables, links and images) and the same image
+callback, which only rewrites the attributes, so no images are loaded.
+
+The outputs are compared by their elements, attributes and text, so that
+differences in the serialization of both parsers (e.g. quotes) do not count.
+
+    ./benchmark_htmlfilter.py --entries 500 --complexity 3 12 48
+"""
+
+import time
+import random
+import argparse
+import statistics
+
+import lxml.html
+from bs4 import BeautifulSoup
+
+import htmlfilter
+
+
+WORDS = ('Glossar', 'Begriff', 'Definition', 'Beispiel', 'Schüler', 'Lehrer', 'Kurs', 'Aufgabe', 'Lösung',
+         'Verbindung', 'Speicher', 'Netzwerk', 'und', 'oder', 'das', 'die', 'der', 'mit', 'für', '&amp;')
+
+
+def create_html(seed, complexity):
+    """Returns HTML with the elements typically found in entries of Moodle glossaries and wikis."""
+    rand = random.Random(seed)
+
+    def text(n):
+        return ' '.join(rand.choice(WORDS) for _ in range(n))
+
+    blocks = []
+    for i in range(complexity):
+        kind = i % 6
+        if kind == 0:
+            blocks.append('<p dir="ltr" style="text-align: left;">{} <strong>{}</strong><br>{}<br></p>'.format(
+                text(12), text(3), text(15)))
+        elif kind == 1:
+            blocks.append('<ul>{}</ul>'.format(''.join('<li><span class="x" style="color: red;">{}</span></li>'.format(
+                text(4)) for _ in range(5))))
+        elif kind == 2:
+            blocks.append('<ol type="a">{}</ol>'.format(''.join('<li>{}<br></li>'.format(text(6)) for _ in range(4))))
+        elif kind == 3:
+            blocks.append('<table border="1"><tbody>{}</tbody></table>'.format(''.join(
+                '<tr><td>{}</td><td>{}</td></tr>'.format(text(2), text(3)) for _ in range(4))))
+        elif kind == 4:
+            blocks.append('<p>{} <a href="https://example.org/{}" target="_blank" rel="noopener" class="link">{}</a> '
+                          '{}</p>'.format(text(8), i, text(2), text(8)))
+        else:
+            blocks.append('<p><img src="https://moodle.example.org/pluginfile.php/{}/mod_glossary/entry/{}/bild.png" '
+                          'alt="Bild" class="img-fluid" width="{}" height="{}"><br></p>'.format(
+                              seed, i, rand.randint(100, 1200), rand.randint(100, 900)))
+    return ''.join(blocks)
+
+
+def replace_image(attributes):
+    """Rewrites an image like pdf.replace_image() without loading it."""
+    attributes['src'] = 'image_cache/{}.png'.format(abs(hash(attributes['src'])) % 100000)
+    attributes['width'] = '{:.0f}'.format(float(attributes.get('width', 400)) / 2)
+    attributes['height'] = '{:.0f}'.format(float(attributes.get('height', 300)) / 2)
+
+
+############################## Previous implementation ##############################
+
+def filter_html(bs):
+    REMOVE_ATTRIBUTES = ['alt', 'rel', 'target', 'class', 'style']
+    for tag in bs.find_all('img') + bs.find_all('a') + bs.find_all('span'):
+        tag.attrs = {key: value for key, value in tag.attrs.items()
+                     if key not in REMOVE_ATTRIBUTES}
+
+
+def filter_for_xhtml2pdf(bs):
+    for tag in bs.find_all('img'):
+        replace_image(tag.attrs)
+    for tag in bs.find_all('br'):
+        tag.decompose()
+    for tag in bs.find_all(type=True):
+        tag['type'] = 'circle'
+
+
+def substitute_lists(bs):
+    for list_tag in bs.find_all('ul'):
+        for tag in list_tag.find_all('li', recursive=False):
+            bullet = bs.new_tag('p', bulletFontName='Symbol')
+            bullet.append(tag.text)
+            tag.clear()
+            tag.insert(0, bullet)
+            tag.name = 'p'
+
+
+def normalize_with_beautifulsoup(content, remove_attributes, substitute):
+    bs = BeautifulSoup(content, features='html.parser')
+    if remove_attributes:
+        filter_html(bs)
+    filter_for_xhtml2pdf(bs)
+    if substitute:
+        substitute_lists(bs)
+    return str(bs)
+
+
+############################## Benchmark ##############################
+
+def get_structure(content):
+    """Returns all elements with their attributes and text for comparing outputs."""
+    root = lxml.html.fragment_fromstring(content, create_parent='div')
+    return [(e.tag, sorted(e.attrib.items()), (e.text or '').strip(), (e.tail or '').strip())
+            for e in root.iter() if isinstance(e.tag, str)]
+
+
+def measure(function, documents, repeat):
+    """Returns the median time in seconds for normalizing all documents and the outputs of the last run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(d) for d in documents]
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), outputs
+
+
+def run(entries, complexities, repeat, remove_attributes, substitute):
+    print('{:<12}{:<14}{:>14}{:>10}{:>12}'.format('complexity', 'implementation', 'us/entry', 'speedup', 'equal'))
+    for complexity in complexities:
+        documents = [create_html(seed, complexity) for seed in range(entries)]
+        implementations = [('bs4', lambda d: normalize_with_beautifulsoup(d, remove_attributes, substitute))]
+        for parser in ('lxml', 'html5lib'):
+            normalizer = htmlfilter.Normalizer(replace_image, remove_attributes, substitute, parser=parser)
+            implementations.append((parser, normalizer.normalize))
+        reference_time, reference = None, None
+        for name, function in implementations:
+            elapsed, outputs = measure(function, documents, repeat)
+            if reference is None:
+                reference_time, reference = elapsed, [get_structure(o) for o in outputs]
+            equal = sum(get_structure(o) == r for o, r in zip(outputs, reference))
+            print('{:<12}{:<14}{:>14.1f}{:>9.2f}x{:>12}'.format(complexity, name, elapsed / entries * 1e6,
+                                                                reference_time / elapsed,
+                                                                '{}/{}'.format(equal, entries)))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Microbenchmark for the normalization of HTML.')
+    parser.add_argument('-e', '--entries', type=int, default=200, help='number of entries per complexity')
+    parser.add_argument('-c', '--complexity', type=int, nargs='+', default=[3, 12, 48],
+                        help='number of blocks (paragraphs, lists, tables, images) per entry')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of runs (median is used)')
+    parser.add_argument('--remove-attributes', action='store_true', help='also remove attributes')
+    parser.add_argument('--substitute-lists', action='store_true', help='also substitute unordered lists')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    run(args.entries, args.complexity, args.repeat, args.remove_attributes, args.substitute_lists)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+"""
+End-to-end benchmark for building PDF files from Moodle modules.
+
+Every case exports a synthetic course with one glossary, one wiki and one
+database from the local Moodle stand-in (see moodle_standin.py). The time of
+build_pdf_for_glossaries_and_wikis() is split into phases:
+
+    fetch      waiting for entries, pages and images from the server
+    filter     parsing and normalizing the HTML (see htmlfilter.py)
+    normalize  scaling and recompressing images
+    pisa       converting HTML into flowables with xhtml2pdf
+    layout     laying out all flowables on pages with ReportLab
+    write      writing the PDF file
+    other      everything else
+
+Only time spent in the main thread is counted and nested phases are not
+counted twice, so all phases add up to the total time. Each run is done in a
+new process, so that the peak memory (resident set size) is measured per case.
+
+Run the benchmark and save the results, then compare later runs against them:
+
+    ./benchmark_pipeline.py --output baseline.json
+    ./benchmark_pipeline.py --compare baseline.json --threshold 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import datetime
+import tempfile
+import functools
+import threading
+import statistics
+import subprocess
+import collections
+import multiprocessing
+import concurrent.futures
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import xhtml2pdf.document
+import reportlab.pdfgen.canvas
+
+import pdf
+import images
+import moodle
+import moodle_async
+import moodle_standin
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.benchmark')
+
+PHASES = ('fetch', 'filter', 'normalize', 'pisa', 'layout', 'write', 'other')
+
+# synthetic courses with increasing number of entries, HTML complexity and number of images
+CASES = {'small': {'entries': 10, 'complexity': 3, 'images': 1},
+         'medium': {'entries': 50, 'complexity': 3, 'images': 1},
+         'large': {'entries': 200, 'complexity': 3, 'images': 1},
+         'complex-html': {'entries': 50, 'complexity': 12, 'images': 1},
+         'many-images': {'entries': 50, 'complexity': 3, 'images': 4}}
+
+# phases shorter than this (in seconds) are too noisy to be compared between runs
+MIN_COMPARED_TIME = 0.1
+
+
+class PhaseTimer:
+    """
+    Sums up the time spent in each phase. Time spent in a phase nested in
+    another phase is only counted for the inner phase.
+    """
+    def __init__(self):
+        self.times = collections.defaultdict(float)
+        self.stack = []
+
+    def wrap(self, phase, function):
+        """Returns a wrapper for the function counting all calls from the main thread for the given phase."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() is not threading.main_thread():
+                return function(*args, **kwargs)
+            self._enter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._exit(phase)
+        return wrapper
+
+    def wrap_iterator(self, phase, iterator):
+        """Yields all items of the iterator and counts the time waiting for each item for the given phase."""
+        iterator = iter(iterator)
+        while True:
+            self._enter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit(phase)
+            yield item
+
+    def _enter(self):
+        self.stack.append([time.perf_counter(), 0.0])
+
+    def _exit(self, phase):
+        start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.times[phase] += elapsed - nested
+        if self.stack:
+            self.stack[-1][1] += elapsed
+
+
+def instrument(timer):
+    """Replaces all functions of the build pipeline with wrappers measuring their phase."""
+    def wrap_generator(function):
+        return lambda *args, **kwargs: timer.wrap_iterator('fetch', function(*args, **kwargs))
+    moodle.get_entries_for_glossary = wrap_generator(moodle.get_entries_for_glossary)
+    moodle.get_entries_for_database = wrap_generator(moodle.get_entries_for_database)
+    moodle_async.get_subwiki_pages = timer.wrap('fetch', moodle_async.get_subwiki_pages)
+    images.resolve_image = timer.wrap('fetch', images.resolve_image)
+    images.normalize_image = timer.wrap('normalize', images.normalize_image)
+    pdf.filter_for_xhtml2pdf = timer.wrap('filter', pdf.filter_for_xhtml2pdf)
+    xhtml2pdf.document.pisaStory = timer.wrap('pisa', xhtml2pdf.document.pisaStory)
+    pdf.SimpleDocTemplate.build = timer.wrap('layout', pdf.SimpleDocTemplate.build)
+    reportlab.pdfgen.canvas.Canvas.save = timer.wrap('write', reportlab.pdfgen.canvas.Canvas.save)
+
+
+def get_peak_memory():
+    """Returns the peak resident set size of this process in kB or None if it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes instead of kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_case(parameters, latency):
+    """Exports a synthetic course in this process and returns the measured values."""
+    logging.basicConfig(level=logging.WARNING)
+    site = moodle_standin.SyntheticSite(courses=1, entries=parameters['entries'], images=parameters['images'],
+                                        complexity=parameters['complexity'])
+    server = moodle_standin.start_server(site, latency=latency)
+    # newer versions of xhtml2pdf only read images below the working directory
+    with tempfile.TemporaryDirectory(dir=os.getcwd()) as temp_dir:
+        CONFIG['moodle']['url'] = server.url
+        CONFIG['moodle']['token'] = moodle_standin.STANDIN_TOKEN
+        CONFIG['cache']['enabled'] = False
+        CONFIG['story_cache']['persistent'] = False
+        # measure the rendering of every module instead of stitching cached fragments
+        CONFIG['fragment_cache']['enabled'] = False
+        # phases are only measured in this process, so render all modules here
+        CONFIG['pdf']['render_processes'] = 1
+        CONFIG['images']['directory'] = os.path.join(temp_dir, 'images')
+        output_file = os.path.join(temp_dir, 'benchmark.pdf')
+        glossaries, wikis, databases = moodle_async.get_modules_for_course(site.course_ids[0])
+        timer = PhaseTimer()
+        instrument(timer)
+        baseline_memory = get_peak_memory()
+        start = time.perf_counter()
+        pdf.build_pdf_for_glossaries_and_wikis(glossaries, wikis, databases, output_file)
+        total = time.perf_counter() - start
+        timer.times['other'] = total - sum(timer.times.values())
+        result = {'total': total, 'phases': {p: timer.times[p] for p in PHASES},
+                  'baseline_memory_kb': baseline_memory, 'peak_memory_kb': get_peak_memory(),
+                  'output_size': os.path.getsize(output_file), 'requests': moodle.get_request_statistics()[0]}
+    server.shutdown()
+    return result
+
+
+def run_benchmark(cases, repeat, latency):
+    """Runs all given cases and returns the median of all repetitions for each case."""
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name in cases:
+        runs = []
+        for i in range(repeat):
+            # a new process for every run, so that no memory or caches are shared between runs
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                runs.append(executor.submit(run_case, CASES[name], latency).result())
+            logger.info('Case {} run {}/{}: {:.2f} s'.format(name, i + 1, repeat, runs[-1]['total']))
+        results[name] = {'parameters': CASES[name],
+                         'total': statistics.median(r['total'] for r in runs),
+                         'phases': {p: statistics.median(r['phases'][p] for r in runs) for p in PHASES},
+                         'baseline_memory_kb': runs[0]['baseline_memory_kb'],
+                         'peak_memory_kb': max(r['peak_memory_kb'] or 0 for r in runs) or None,
+                         'output_size': runs[0]['output_size'],
+                         'requests': runs[0]['requests']}
+    return results
+
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with the results of an earlier run and returns a list of
+    all regressions beyond the threshold (relative increase, e.g. 0.2 for 20%).
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline['cases'].get(name)
+        if old is None or old['parameters'] != result['parameters']:
+            continue
+        values = [('total', old['total'], result['total'])]
+        values.extend(('phase ' + p, old['phases'].get(p, 0), result['phases'][p]) for p in PHASES
+                      if old['phases'].get(p, 0) >= MIN_COMPARED_TIME)
+        if old.get('peak_memory_kb') and result['peak_memory_kb']:
+            values.append(('peak memory', old['peak_memory_kb'], result['peak_memory_kb']))
+        for metric, old_value, new_value in values:
+            if new_value > old_value * (1 + threshold):
+                regressions.append('{}: {} increased from {:.2f} to {:.2f} (+{:.0%})'.format(
+                    name, metric, old_value, new_value, new_value / old_value - 1))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    phases = ''.join('{:>10}'.format(p) for p in PHASES)
+    print('{:<14}{:>9}{}{:>12}{:>12}'.format('case', 'total', phases, 'peak (MB)', 'size (kB)'))
+    for name, result in results.items():
+        line = '{:<14}{:>9.2f}'.format(name, result['total'])
+        line += ''.join('{:>10.2f}'.format(result['phases'][p]) for p in PHASES)
+        line += '{:>12.1f}{:>12.1f}'.format((result['peak_memory_kb'] or 0) / 1024, result['output_size'] / 1024)
+        old = baseline['cases'].get(name) if baseline else None
+        if old:
+            line += '  ({:+.0%} total)'.format(result['total'] / old['total'] - 1)
+        print(line)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark for building PDF files.')
+    parser.add_argument('-c', '--cases', nargs='+', choices=CASES, default=list(CASES), help='cases to run')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='number of runs per case (median is used)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0, help='latency of the server in milliseconds')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='JSON file to write results to')
+    parser.add_argument('--compare', metavar='FILE', help='JSON file with results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative increase counted as regression (default: 0.2)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s')
+    args = parse_arguments()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run_benchmark(args.cases, args.repeat, args.latency / 1000)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'date': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': get_revision(),
+                   'python': platform.python_version(), 'platform': platform.platform(),
+                   'repeat': args.repeat, 'latency_ms': args.latency, 'cases': results}, f, indent=2)
+    print_results(results, baseline)
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for r in regressions:
+            logger.error('Regression: {}'.format(r))
+        if regressions:
+            sys.exit(1)
+        logger.info('No regressions beyond {:.0%} compared to {}.'.format(args.threshold, args.compare))
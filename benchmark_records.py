@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Compares the memory needed for the records from data.py with the tuples,
+dictionaries and plain dataclasses used before, for a synthetic course with
+many course modules.
+
+    ./benchmark_records.py --modules 10000
+"""
+
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+
+from data import CourseModule, DatabaseEntry
+
+
+@dataclass(frozen=True)
+class PlainCourseModule:
+    section_id: int
+    section_name: str
+    id: int
+    name: str
+    modname: str
+    visible: int
+    uservisible: bool
+    visibleoncoursepage: int
+    modicon: str
+
+
+def measure(factory, count):
+    """Returns the number of bytes allocated per object created by the factory."""
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    objects = [factory(i) for i in range(count)]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # subtract list holding all objects
+    return (end - start - objects.__sizeof__()) / count
+
+
+def create_module_values(i):
+    # all strings are shared between objects, so only the objects themselves are measured
+    return (i // 20, SECTION_NAME, i, MODULE_NAME, 'glossary', 1, True, 1, MODICON)
+
+
+SECTION_NAME = 'Abschnitt'
+MODULE_NAME = 'Glossar'
+MODICON = 'https://moodle.example.org/theme/image.php/boost/glossary/1/icon'
+FIELDS = ('section_id', 'section_name', 'id', 'name', 'modname', 'visible', 'uservisible', 'visibleoncoursepage',
+          'modicon')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark for records of Moodle data.')
+    parser.add_argument('-m', '--modules', type=int, default=10000, help='number of course modules')
+    args = parser.parse_args()
+    print('Course modules ({} objects):'.format(args.modules))
+    results = [('tuple', measure(lambda i: create_module_values(i), args.modules)),
+               ('dict', measure(lambda i: dict(zip(FIELDS, create_module_values(i))), args.modules)),
+               ('dataclass', measure(lambda i: PlainCourseModule(*create_module_values(i)), args.modules)),
+               ('data.CourseModule', measure(lambda i: CourseModule(*create_module_values(i)), args.modules))]
+    for name, size in results:
+        print('    {:<20} {:8.1f} bytes per object'.format(name, size))
+    record_size = results[-1][1]
+    for name, size in results[:-1]:
+        print('    saving compared to {:<10} {:8.1f} bytes per object ({:.0%})'.format(
+            name, size - record_size, (size - record_size) / size))
+    print('Database entries ({} objects with 3 fields):'.format(args.modules))
+    entry_fields = (('Name', 'Wert'), ('Beschreibung', 'Text'), ('Bild', 'bild.png'))
+    entry_files = (('bild.png', 'https://moodle.example.org/pluginfile.php/1/bild.png'),)
+    dict_size = measure(lambda i: {'id': i, 'files': dict(entry_files), **dict(entry_fields)}, args.modules)
+    record_size = measure(lambda i: DatabaseEntry(i, tuple(list(entry_fields)), tuple(list(entry_files))),
+                          args.modules)
+    print('    {:<20} {:8.1f} bytes per object'.format('dict', dict_size))
+    print('    {:<20} {:8.1f} bytes per object'.format('data.DatabaseEntry', record_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Persistent cache for responses of the Moodle Web Service.
+
+Responses are stored in a SQLite database together with an expiry time and a
+set of tags (e.g. "course:2" or "glossary:13"). All entries with a given tag
+can be invalidated at once, e.g. when a module was changed on the Moodle site.
+When the cache grows beyond its maximum size, the least recently used entries
+are evicted.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger('moodle2pdf.cache')
+
+# seconds to wait for a lock on the database held by another process
+SQLITE_TIMEOUT = 30
+
+
+class ResponseCache:
+    def __init__(self, filename, max_size):
+        """
+        Opens or creates a response cache.
+
+        :param filename: file name of the SQLite database
+        :param max_size: maximum size of all cached responses in bytes
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # processes rendering modules in parallel share the cache, so wait longer for their transactions
+        self.connection = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, fname TEXT, data TEXT, size INTEGER,
+                                                      expires REAL, accessed REAL);
+                CREATE TABLE IF NOT EXISTS tags (key TEXT, tag TEXT);
+                CREATE INDEX IF NOT EXISTS tags_by_tag ON tags (tag);
+                CREATE INDEX IF NOT EXISTS tags_by_key ON tags (key);
+                CREATE TABLE IF NOT EXISTS modified (tag TEXT PRIMARY KEY, timemodified INTEGER);
+                CREATE TABLE IF NOT EXISTS modules (cmid INTEGER PRIMARY KEY, courseid INTEGER);
+            ''')
+
+    @staticmethod
+    def make_key(url, token, fname, parameters):
+        """
+        Builds the cache key from the site URL, the token of the user, the name
+        of the API function and the flattened parameters (as returned by
+        rest_api_parameters()). Responses depend on the permissions of the
+        user, so they are never shared between users.
+        """
+        key = json.dumps([url, token, fname, sorted((k, str(v)) for k, v in parameters.items())])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns the cached response for the given key or None."""
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT data, expires FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            data, expires = row
+            if expires < now:
+                self._delete_keys([key])
+                return None
+            self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(data)
+
+    def put(self, key, fname, response, ttl, tags=()):
+        """Stores a response for ttl seconds and tags it with all given tags."""
+        data = json.dumps(response)
+        now = time.time()
+        with self.lock, self.connection:
+            self._delete_keys([key])
+            self.connection.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                    (key, fname, data, len(data), now + ttl, now))
+            self.connection.executemany('INSERT INTO tags VALUES (?, ?)', ((key, t) for t in tags))
+            self._evict()
+
+    def invalidate(self, tag):
+        """Removes all responses tagged with the given tag."""
+        with self.lock, self.connection:
+            keys = [k for k, in self.connection.execute('SELECT key FROM tags WHERE tag = ?', (tag,))]
+            self._delete_keys(keys)
+        if keys:
+            logger.debug('Invalidated {} cached responses for {}.'.format(len(keys), tag))
+
+    def clear(self):
+        """Removes all responses from the cache."""
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.execute('DELETE FROM tags')
+
+    def check_modified(self, tag, timemodified):
+        """
+        Compares the given modification time with the one seen before for the
+        same tag. If it has changed, all responses with this tag are invalidated.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT timemodified FROM modified WHERE tag = ?', (tag,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO modified VALUES (?, ?)', (tag, timemodified))
+        if row is not None and row[0] != timemodified:
+            self.invalidate(tag)
+
+    def add_modules(self, courseid, cmids):
+        """Remembers the course for the given course module ids."""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO modules VALUES (?, ?)',
+                                        ((cmid, courseid) for cmid in cmids))
+
+    def get_course_for_module(self, cmid):
+        """Returns the course id for a course module id or None if unknown."""
+        with self.lock:
+            row = self.connection.execute('SELECT courseid FROM modules WHERE cmid = ?', (cmid,)).fetchone()
+        return row[0] if row else None
+
+    def _delete_keys(self, keys):
+        for key in keys:
+            self.connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.connection.execute('DELETE FROM tags WHERE key = ?', (key,))
+
+    def _evict(self):
+        overall, = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if overall <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            if overall <= self.max_size:
+                break
+            evicted.append(key)
+            overall -= size
+        self._delete_keys(evicted)
+        logger.debug('Evicted {} cached responses.'.format(len(evicted)))
@@ -1,5 +1,4 @@
-
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields
 
 
 @dataclass(frozen=True)
@@ -9,3 +8,105 @@ class Section:
 
     def __str__(self):
         return '{} ({})'.format(self.name, self.id)
+
+
+class Record:
+    """
+    Base class for compact, immutable records. Subclasses are frozen
+    dataclasses declaring their fields in __slots__, so that no dictionary is
+    allocated per instance. Because frozen instances can not be restored by
+    the default pickle protocol for slotted classes, the state is handled here.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, f.name) for f in fields(self))
+
+    def __setstate__(self, state):
+        for f, value in zip(fields(self), state):
+            object.__setattr__(self, f.name, value)
+
+
+@dataclass(frozen=True)
+class Course(Record):
+    __slots__ = ('id', 'name')
+    id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class CourseModule(Record):
+    __slots__ = ('section_id', 'section_name', 'id', 'name', 'modname', 'visible', 'uservisible',
+                 'visibleoncoursepage', 'modicon')
+    section_id: int
+    section_name: str
+    id: int
+    name: str
+    modname: str
+    visible: int
+    uservisible: bool
+    visibleoncoursepage: int
+    modicon: str
+
+
+@dataclass(frozen=True)
+class Glossary(Record):
+    __slots__ = ('id', 'name')
+    id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class Wiki(Record):
+    __slots__ = ('id', 'name', 'firstpagetitle', 'wikimode', 'defaultformat', 'visible')
+    id: int
+    name: str
+    firstpagetitle: str
+    wikimode: str
+    defaultformat: str
+    visible: int
+
+
+@dataclass(frozen=True)
+class Database(Record):
+    __slots__ = ('id', 'name', 'singletemplate', 'listtemplate')
+    id: int
+    name: str
+    singletemplate: str
+    listtemplate: str
+
+
+@dataclass(frozen=True)
+class GlossaryEntry(Record):
+    __slots__ = ('id', 'concept', 'definition', 'timemodified')
+    id: int
+    concept: str
+    definition: str
+    timemodified: int
+
+
+@dataclass(frozen=True)
+class WikiPage(Record):
+    __slots__ = ('id', 'title', 'content')
+    id: int
+    title: str
+    content: str
+
+
+@dataclass(frozen=True)
+class DatabaseEntry(Record):
+    """
+    Entry of a database with a tuple of pairs of field name and content and a
+    tuple of pairs of file name and URL for all attached files.
+    """
+    __slots__ = ('id', 'fields', 'files')
+    id: int
+    fields: tuple
+    files: tuple
+
+    def get_file_url(self, filename):
+        """Returns the URL of an attached file or None if no file with this name is attached."""
+        for name, url in self.files:
+            if name == filename:
+                return url
+        return None
@@ -0,0 +1,124 @@
+"""
+Jobs for exporting every module into a separate PDF file.
+
+Every selected module becomes a job with the name of its output file. File
+names are derived from the module names, so that they are valid on all
+platforms and unique within the output directory. While the jobs are run (see
+pdf.export_modules_separately()), every job records the number of pages, the
+time needed for its export and the error, if the export failed. The results of
+all jobs are collected in a manifest, which is written as JSON file next to
+the PDF files, e.g. for archiving the exported modules.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import unicodedata
+
+import pdfmerge
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.export_jobs')
+
+# characters not allowed in file names on Windows (and slashes on all other platforms)
+INVALID_CHARACTERS = re.compile(r'[<>:"/\\|?*\x00-\x1f\x7f]')
+# names of devices on Windows, which can not be used as file names even with an extension
+RESERVED_NAMES = {'CON', 'PRN', 'AUX', 'NUL'} | {'COM{}'.format(i) for i in range(1, 10)} | \
+    {'LPT{}'.format(i) for i in range(1, 10)}
+MAX_NAME_LENGTH = 100
+
+
+class ExportJob:
+    """Export of a single module into its own PDF file and the result of the export."""
+    def __init__(self, module_type, module, output_file):
+        self.module_type = module_type
+        self.module = module
+        self.output_file = output_file
+        self.finished = False
+        self.pages = 0
+        # seconds needed for loading, converting and laying out the module
+        self.duration = 0.0
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.finished and self.error is None
+
+    def to_dict(self):
+        return {'type': self.module_type, 'id': self.module.id, 'name': self.module.name,
+                'file': os.path.basename(self.output_file), 'pages': self.pages,
+                'duration': round(self.duration, 3), 'error': self.error}
+
+    def __str__(self):
+        return '{} no. {}: {}'.format(self.module_type, self.module.id, self.module.name)
+
+
+class Manifest:
+    """Results of all jobs of an export into separate files."""
+    def __init__(self, output_directory, jobs):
+        self.output_directory = output_directory
+        self.jobs = jobs
+        self.started = time.time()
+        self.duration = 0.0
+        # statistics of an incremental export, otherwise None
+        self.statistics = None
+
+    @property
+    def failed(self):
+        return [job for job in self.jobs if not job.succeeded]
+
+    def to_dict(self):
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'duration': round(self.duration, 3), 'site': CONFIG['moodle']['url'],
+                'succeeded': len(self.jobs) - len(self.failed), 'failed': len(self.failed),
+                'modules': [job.to_dict() for job in self.jobs]}
+
+    def write(self, filename=None):
+        """Writes the manifest atomically into the output directory and returns its file name."""
+        manifest_file = os.path.join(self.output_directory, filename or CONFIG['pdf']['manifest_filename'])
+        with pdfmerge.atomic_output(manifest_file, suffix='.json') as temp_file:
+            with open(temp_file, 'w', encoding='utf8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        return manifest_file
+
+
+def safe_filename(name, fallback='module'):
+    """
+    Returns a file name (without extension) for the given name, which is valid
+    on all platforms. Invalid characters are replaced by underscores, if
+    nothing is left the fallback is used.
+    """
+    name = unicodedata.normalize('NFC', name)
+    name = ' '.join(INVALID_CHARACTERS.sub('_', name).split())
+    # trailing dots and spaces are removed by Windows, leading dots hide files
+    name = name[:MAX_NAME_LENGTH].strip('. ')
+    if not name:
+        name = fallback
+    if name.split('.')[0].upper() in RESERVED_NAMES:
+        name = '_' + name
+    return name
+
+
+def create_jobs(glossaries, wikis, databases, output_directory):
+    """
+    Returns a job for every module with a unique output file in the output
+    directory. If the names of several modules result in the same file name,
+    the id of the module is appended.
+    """
+    jobs = []
+    used = set()
+    modules = [('glossary', g) for g in glossaries] + [('wiki', w) for w in wikis] + \
+        [('database', d) for d in databases]
+    for module_type, module in modules:
+        name = safe_filename(module.name, '{}_{}'.format(module_type, module.id))
+        candidate, no = name, 1
+        # compare case-insensitively for file systems on Windows and macOS
+        while candidate.casefold() in used:
+            candidate = '{}_{}'.format(name, module.id) if no == 1 else '{}_{}_{}'.format(name, module.id, no)
+            no += 1
+        used.add(candidate.casefold())
+        jobs.append(ExportJob(module_type, module, os.path.join(output_directory, candidate + '.pdf')))
+    return jobs
@@ -0,0 +1,263 @@
+"""
+Incremental loading of module data for repeated exports.
+
+For every exported module a state file is kept containing all entries with
+their modification time. On the next export a listing of all entries is
+compared with the state: entries missing in the listing were deleted, only
+new and changed entries are loaded from Moodle, all others are taken from the
+state file. For wikis and databases the listing contains no content, so only
+changed entries are loaded with their content, one request for every entry.
+If a module was not exported before or a large share of its entries (option
+"bulk_ratio") has changed, all entries are loaded with their content in paged
+requests instead. For glossaries there is no listing without content, so all
+entries are listed with their definitions. Listings and changed entries are
+never taken from the response cache.
+"""
+
+import os
+import json
+import logging
+import tempfile
+
+import moodle
+from config import CONFIG
+from data import GlossaryEntry, WikiPage, DatabaseEntry
+
+
+logger = logging.getLogger('moodle2pdf.export_state')
+
+
+class ExportStatistics:
+    """Counts how many modules and entries were reused from the state or loaded again."""
+    def __init__(self):
+        self.modules_reused = 0
+        self.modules_refetched = 0
+        self.entries_reused = 0
+        self.entries_refetched = 0
+
+    def add_module(self, reused_entries, refetched_entries):
+        self.entries_reused += reused_entries
+        self.entries_refetched += refetched_entries
+        if refetched_entries:
+            self.modules_refetched += 1
+        else:
+            self.modules_reused += 1
+
+    def merge(self, other):
+        """Adds the counts of other statistics, e.g. from another process."""
+        self.modules_reused += other.modules_reused
+        self.modules_refetched += other.modules_refetched
+        self.entries_reused += other.entries_reused
+        self.entries_refetched += other.entries_refetched
+
+    def __str__(self):
+        return 'modules reused: {}, refetched: {} - entries reused: {}, refetched: {}'.format(
+            self.modules_reused, self.modules_refetched, self.entries_reused, self.entries_refetched)
+
+
+def load_state(module_type, module_id):
+    """Returns the stored state for a module or None, if it was not exported before."""
+    state_file = _get_state_file(module_type, module_id)
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_state(module_type, module_id, state):
+    """Writes the state for a module atomically into its state file."""
+    directory = CONFIG['incremental']['directory']
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=directory, delete=False) as f:
+        json.dump(state, f)
+    os.replace(f.name, _get_state_file(module_type, module_id))
+
+
+def use_bulk_fetch(old_items, listing):
+    """
+    Returns whether so many items of the listing are new or changed compared
+    to the stored items (option "bulk_ratio"), that loading all items with
+    their content in paged requests is cheaper than a request for every item.
+    """
+    changed = 0
+    for item in listing:
+        old_item = old_items.get(str(item['id']))
+        if old_item is None or old_item['timemodified'] != item['timemodified']:
+            changed += 1
+    return changed > CONFIG['incremental']['bulk_ratio'] * len(listing)
+
+
+def _get_state_file(module_type, module_id):
+    site = ''.join(c if c.isalnum() else '_' for c in CONFIG['moodle']['url'])
+    return os.path.join(CONFIG['incremental']['directory'], '{}_{}_{}.json'.format(site, module_type, module_id))
+
+
+############################## Glossary functions ##############################
+
+def get_entries_for_glossary(glossary_id, statistics):
+    """
+    Returns all entries of a glossary and updates its state with all entries
+    that were added, changed or deleted since the last export.
+
+    The Web Service has no listing of glossary entries without their
+    definitions, so all entries are listed to compare their ids with the
+    state. Otherwise a deleted entry would be missed, whenever another entry
+    was added at the same time. Because all definitions are loaded anyway, all
+    entries are counted as refetched in the statistics.
+    """
+    state = load_state('glossary', glossary_id) or {'entries': {}}
+    old_entries = state['entries']
+    page_size = CONFIG['moodle']['page_size']
+    entries = {}
+    changed = 0
+    for e in moodle.iterate_pages(_fetch_glossary_page(glossary_id, page_size)):
+        entry = old_entries.get(str(e['id']))
+        if entry is None or entry['timemodified'] != e['timemodified']:
+            entry = {'concept': e['concept'], 'definition': e['definition'], 'timemodified': e['timemodified']}
+            changed += 1
+        entries[str(e['id'])] = entry
+    statistics.add_module(0, len(entries))
+    logger.debug('{} of {} entries of glossary {} were changed.'.format(changed, len(entries), glossary_id))
+    if changed or entries.keys() != old_entries.keys():
+        save_state('glossary', glossary_id, {'entries': entries})
+    # order entries like the API function mod_glossary_get_entries_by_letter
+    return [GlossaryEntry(int(i), e['concept'], e['definition'], e['timemodified'])
+            for i, e in sorted(entries.items(), key=lambda item: item[1]['concept'].lower())]
+
+
+def list_glossary_entries(glossary_id):
+    """
+    Returns all entries of a glossary like moodle.get_entries_for_glossary(),
+    but never from the response cache, e.g. for comparing their modification
+    times with those seen before.
+    """
+    entries = moodle.iterate_pages(_fetch_glossary_page(glossary_id, CONFIG['moodle']['page_size']))
+    return sorted((GlossaryEntry(e['id'], e['concept'], e['definition'], e['timemodified']) for e in entries),
+                  key=lambda entry: entry.concept.lower())
+
+
+def _fetch_glossary_page(glossary_id, page_size):
+    def fetch_page(page_no):
+        response = moodle.call_mdl_function_uncached('mod_glossary_get_entries_by_date', id=glossary_id,
+                                                     order='UPDATE', sort='DESC',
+                                                     **{'from': page_no * page_size, 'limit': page_size})
+        more = len(response['entries']) > 0 and (page_no + 1) * page_size < response['count']
+        return response['entries'], more
+    return fetch_page
+
+
+################################ Wiki functions #################################
+
+def get_subwiki_pages(wiki_id, statistics):
+    """
+    Returns all pages of a wiki, loading only the content of pages that were
+    changed since the last export (or of all pages, see use_bulk_fetch()).
+    """
+    state = load_state('wiki', wiki_id) or {'pages': {}}
+    old_pages = state['pages']
+    # without a state all pages are loaded with their content at once
+    bulk = not old_pages
+    listing = _fetch_subwiki_pages(wiki_id, bulk)
+    if not bulk and use_bulk_fetch(old_pages, listing):
+        bulk = True
+        listing = _fetch_subwiki_pages(wiki_id, bulk)
+    pages = {}
+    changed = 0
+    for p in listing:
+        page = old_pages.get(str(p['id']))
+        if page is None or page['timemodified'] != p['timemodified']:
+            content = p
+            if not bulk:
+                content = moodle.call_mdl_function_uncached('mod_wiki_get_page_contents', pageid=p['id'])['page']
+            page = {'title': content['title'], 'cachedcontent': content['cachedcontent'],
+                    'timemodified': p['timemodified']}
+            changed += 1
+        pages[str(p['id'])] = page
+    statistics.add_module(len(pages) - changed, changed)
+    # pages missing in the listing were deleted
+    if changed or pages.keys() != old_pages.keys():
+        save_state('wiki', wiki_id, {'pages': pages})
+    return [WikiPage(int(i), p['title'], p['cachedcontent']) for i, p in pages.items()]
+
+
+def _fetch_subwiki_pages(wiki_id, with_content):
+    # the listing is never taken from the response cache, it would hide changed pages
+    return moodle.call_mdl_function_uncached('mod_wiki_get_subwiki_pages', wikiid=wiki_id,
+                                             options={'includecontent': int(with_content)})['pages']
+
+
+############################## Database functions #############################
+
+def get_entries_for_database(database_id, statistics):
+    """
+    Returns all entries of a database (see moodle.get_entries_for_database()),
+    loading only the content of entries that were changed since the last export
+    (or of all entries, see use_bulk_fetch()).
+    """
+    state = load_state('database', database_id) or {'entries': {}}
+    old_entries = state['entries']
+    page_size = CONFIG['moodle']['page_size']
+    # without a state all entries are loaded with their content page by page
+    bulk = not old_entries
+    listing = moodle.iterate_pages(_fetch_database_page(database_id, page_size, bulk))
+    if not bulk:
+        listing = list(listing)
+        if use_bulk_fetch(old_entries, listing):
+            bulk = True
+            listing = moodle.iterate_pages(_fetch_database_page(database_id, page_size, bulk))
+    fields = None
+    entries = {}
+    changed = 0
+    for e in listing:
+        entry = old_entries.get(str(e['id']))
+        if entry is None or entry['timemodified'] != e['timemodified']:
+            if fields is None:
+                fields = moodle.get_fields_for_database(database_id)
+            content = e
+            if not bulk:
+                content = moodle.call_mdl_function_uncached('mod_data_get_entry', entryid=e['id'],
+                                                            returncontents='1')['entry']
+            data = moodle.parse_database_entry(content, fields)
+            entry = {'fields': data.fields, 'files': data.files, 'timemodified': e['timemodified']}
+            changed += 1
+        entries[str(e['id'])] = entry
+    statistics.add_module(len(entries) - changed, changed)
+    # entries missing in the listing were deleted
+    if changed or entries.keys() != old_entries.keys():
+        save_state('database', database_id, {'entries': entries})
+    return [DatabaseEntry(int(i), tuple(tuple(f) for f in e['fields']), tuple(tuple(f) for f in e['files']))
+            for i, e in entries.items()]
+
+
+def _fetch_database_page(database_id, page_size, with_content=False):
+    def fetch_page(page_no):
+        # the listing is never taken from the response cache, it would hide changed entries
+        response = moodle.call_mdl_function_uncached('mod_data_get_entries', databaseid=database_id,
+                                                     returncontents=str(int(with_content)), page=page_no,
+                                                     perpage=page_size)
+        more = len(response['entries']) > 0 and (page_no + 1) * page_size < response['totalcount']
+        return response['entries'], more
+    return fetch_page
+
+
+################################## Listings ###################################
+
+def get_listing(module_type, module_id):
+    """
+    Returns the ids and modification times of all pages of a wiki or all
+    entries of a database (and its fields), e.g. to find out whether a module
+    was changed since it was last rendered without loading its content.
+    Glossary entries can only be listed with their definitions, so there is
+    no listing for glossaries (see pdf.get_module_listing()).
+    """
+    page_size = CONFIG['moodle']['page_size']
+    listing = {}
+    if module_type == 'wiki':
+        items = moodle.call_mdl_function_uncached('mod_wiki_get_subwiki_pages', wikiid=module_id,
+                                                  options={'includecontent': 0})['pages']
+    else:
+        # renamed fields change the rendered entries, but not their modification time
+        listing['fields'] = moodle.get_fields_for_database(module_id)
+        items = moodle.iterate_pages(_fetch_database_page(module_id, page_size))
+    listing['entries'] = sorted((i['id'], i['timemodified']) for i in items)
+    return listing
@@ -0,0 +1,162 @@
+"""
+Cache for modules rendered into PDF fragments.
+
+The same modules are often exported many times, e.g. once for every class,
+once for a department and once for the whole site. Every module rendered into
+a fragment (see pdf.build_module_fragment()) is stored under a hash of a
+listing of its entries or pages and of everything else influencing its
+rendering: the ids and modification times of all entries or pages (see
+export_state.get_listing()), the versions of the libraries and the options for
+pages, HTML and images. An unchanged module is taken from the cache without
+loading its content, while a changed entry or option simply misses it.
+
+Images are not part of the listing, so the files of all images of a fragment
+(stored in the image store under the hash of their content) are kept next to
+the fragment. If the option "revalidate_images" is set, a cached fragment is
+only used while the files of all its images are unchanged.
+
+Fragments have no page margins. Those are drawn with continuous page numbers
+and the running header when the fragments are merged (see pdfmerge.py), so
+a fragment can be used at any position of any document. Merging needs the
+library pypdf, without it the cache is not used.
+
+Fragments are stored as files in the directory given in the [fragment_cache]
+section of the configuration file. When the cache grows beyond its maximum
+size, the least recently used fragments are removed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import threading
+import contextlib
+
+import pdfmerge
+import story_cache
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.fragment_cache')
+
+# change when the way modules are rendered into fragments changes
+CACHE_VERSION = 2
+
+
+class FragmentCache:
+    def __init__(self, directory, max_size):
+        """
+        Opens or creates a cache for rendered modules.
+
+        :param directory: directory containing the fragments
+        :param max_size: maximum size of all fragments in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(module_type, module, listing):
+        """
+        Builds the cache key from the type and name of a module, the listing
+        of its entries or pages and the render settings.
+        """
+        key = hashlib.sha256()
+        for value in (CACHE_VERSION, story_cache.get_style_hash(), get_render_settings(), module_type, module.name):
+            key.update(str(value).encode('utf-8'))
+            key.update(b'\0')
+        key.update(json.dumps(listing, ensure_ascii=False, sort_keys=True).encode('utf-8', 'surrogatepass'))
+        return key.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the file name of the cached fragment for the given key and a
+        mapping from the URLs of its images to the names of their files in the
+        image store or None.
+        """
+        path = self._get_path(key)
+        try:
+            with open(self._get_image_path(key), encoding='utf-8') as f:
+                image_files = json.load(f)
+            # mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return path, image_files
+
+    def put(self, key, fragment_file, image_files):
+        """Stores a copy of the fragment and the names of the files of its images under the given key."""
+        try:
+            with pdfmerge.atomic_output(self._get_image_path(key), suffix='.json') as temp_file:
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(image_files, f)
+            with pdfmerge.atomic_output(self._get_path(key)) as temp_file:
+                shutil.copyfile(fragment_file, temp_file)
+        except OSError as e:
+            logger.warning('Could not store fragment in cache: {}'.format(e))
+
+    def evict(self):
+        """
+        Removes the least recently used fragments, until all fragments fit into
+        the maximum size. Fragments used by a running export must not be
+        removed, so this is called after the fragments are merged.
+        """
+        with self.lock:
+            fragments = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith('.pdf'):
+                    stat = entry.stat()
+                    fragments.append((stat.st_mtime, stat.st_size, entry.path))
+            overall = sum(size for _, size, _ in fragments)
+            evicted = 0
+            for _, size, path in sorted(fragments):
+                if overall <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.splitext(path)[0] + '.json')
+                overall -= size
+                evicted += 1
+            if evicted:
+                logger.debug('Evicted {} cached fragments.'.format(evicted))
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def _get_image_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+
+def get_render_settings():
+    """Returns all options influencing how a module is rendered as string."""
+    settings = {'pdf': {k: CONFIG['pdf'][k] for k in ('border_horizontal', 'border_vertical')},
+                'html': CONFIG['html'],
+                'images': {k: CONFIG['images'][k] for k in ('normalize', 'dpi', 'jpeg_quality')}}
+    return json.dumps(settings, sort_keys=True)
+
+
+_fragment_cache = None
+_fragment_cache_lock = threading.Lock()
+
+
+def get_fragment_cache():
+    """
+    Returns the shared fragment cache or None, if caching is disabled in the
+    [fragment_cache] section of the configuration file or pypdf is missing.
+    """
+    global _fragment_cache
+    cache_config = CONFIG['fragment_cache']
+    if not cache_config['enabled']:
+        return None
+    if pdfmerge.pypdf is None:
+        logger.warning('Library pypdf not installed, fragment cache is not used.')
+        return None
+    with _fragment_cache_lock:
+        if _fragment_cache is None:
+            _fragment_cache = FragmentCache(cache_config['directory'], cache_config['max_size_mb'] * 1024 * 1024)
+        return _fragment_cache
@@ -0,0 +1,154 @@
+"""
+Normalization of HTML from Moodle before it is converted by xhtml2pdf.
+
+The HTML of an entry or page is parsed once, all rules are applied in a single
+traversal of the tree and the result is serialized once, because xhtml2pdf
+only accepts HTML as text. Rules are functions registered for a tag name and
+called as rule(element, parent) for every element with that tag. A rule
+returning False has removed or replaced the element, so its children are not
+visited and no further rules are applied to it.
+
+The tree is built by lxml if it is installed. Otherwise html5lib is used,
+which is always installed together with xhtml2pdf. Both build trees with the
+ElementTree API, so the rules work with both.
+"""
+
+import html
+import logging
+import collections
+import xml.etree.ElementTree
+
+import html5lib
+try:
+    import lxml.html
+    import lxml.etree
+except ImportError:
+    lxml = None
+
+
+logger = logging.getLogger('moodle2pdf.htmlfilter')
+
+# attributes removed from images, links and spans, if enabled
+REMOVED_ATTRIBUTES = ('alt', 'rel', 'target', 'class', 'style')
+STRIPPED_TAGS = ('img', 'a', 'span')
+
+DEFAULT_PARSER = 'lxml' if lxml is not None else 'html5lib'
+
+
+class Normalizer:
+    def __init__(self, image_callback=None, remove_attributes=False, substitute_lists=False, parser=None):
+        """
+        Creates a normalizer with the rules needed by xhtml2pdf.
+
+        :param image_callback: function called with the attributes of every image, it can change the source and size
+        :param remove_attributes: remove the attributes alt, rel, target, class and style from images, links and spans
+        :param substitute_lists: replace items of unordered lists with paragraphs with a bullet
+        :param parser: 'lxml' or 'html5lib', by default lxml is used if it is installed
+        """
+        self.parser = parser or DEFAULT_PARSER
+        # mapping from tag name to all rules for that tag
+        self.rules = collections.defaultdict(list)
+        if remove_attributes:
+            for tag in STRIPPED_TAGS:
+                self.rules[tag].append(remove_attributes_rule)
+        if image_callback:
+            self.rules['img'].append(lambda element, parent: image_callback(element.attrib))
+        # remove all seperate line breaks and trust that all paragraphs are formatted with the <p> tag
+        self.rules['br'].append(remove_element_rule)
+        if substitute_lists:
+            self.rules['li'].append(substitute_list_item_rule)
+
+    def add_rule(self, tag, rule):
+        self.rules[tag].append(rule)
+
+    def normalize(self, content):
+        """Returns the normalized HTML for the given HTML."""
+        root = parse_fragment(content, self.parser)
+        self.apply(root)
+        return serialize_fragment(root, self.parser)
+
+    def apply(self, root):
+        """Applies all rules to the children of the given element in one traversal."""
+        rules = self.rules
+        stack = [root]
+        while stack:
+            parent = stack.pop()
+            # iterate over a copy, because rules may remove elements
+            for element in list(parent):
+                tag = element.tag
+                if not isinstance(tag, str):
+                    # comments and processing instructions
+                    continue
+                if 'type' in element.attrib:
+                    # change all types in lists and enumerations to 'circle'
+                    element.set('type', 'circle')
+                for rule in rules.get(tag, ()):
+                    if rule(element, parent) is False:
+                        break
+                else:
+                    if len(element):
+                        stack.append(element)
+
+
+############################## Rules ##############################
+
+def remove_attributes_rule(element, parent):
+    for key in REMOVED_ATTRIBUTES:
+        element.attrib.pop(key, None)
+
+
+def remove_element_rule(element, parent):
+    """Removes the element with all its children, but keeps the text following it."""
+    if element.tail:
+        index = list(parent).index(element)
+        if index:
+            previous = parent[index - 1]
+            previous.tail = (previous.tail or '') + element.tail
+        else:
+            parent.text = (parent.text or '') + element.tail
+    parent.remove(element)
+    return False
+
+
+def substitute_list_item_rule(element, parent):
+    """Replaces an item of an unordered list with a paragraph containing its text and a bullet."""
+    if parent.tag != 'ul':
+        return None
+    text = ''.join(element.itertext())
+    tail = element.tail
+    element.clear()
+    element.tail = tail
+    element.tag = 'p'
+    bullet = element.makeelement('p', {'bulletFontName': 'Symbol'})
+    bullet.text = text
+    element.append(bullet)
+    return False
+
+
+############################## Parsing ##############################
+
+def close_tags(content, parser=None):
+    """Returns the HTML with all elements closed, so that it can be concatenated with other HTML."""
+    parser = parser or DEFAULT_PARSER
+    return serialize_fragment(parse_fragment(content, parser), parser)
+
+
+def parse_fragment(content, parser='lxml'):
+    """Parses a fragment of HTML and returns an element containing all parsed elements."""
+    if parser == 'lxml':
+        try:
+            return lxml.html.fragment_fromstring(content, create_parent='div')
+        except lxml.etree.ParserError:
+            # e.g. only whitespace or comments
+            return lxml.html.fragment_fromstring('', create_parent='div')
+    return html5lib.parseFragment(content, treebuilder='etree', namespaceHTMLElements=False)
+
+
+def serialize_fragment(root, parser='lxml'):
+    """Returns the HTML for all children of the element returned by parse_fragment()."""
+    parts = [html.escape(root.text, quote=False)] if root.text else []
+    if parser == 'lxml':
+        parts.extend(lxml.html.tostring(child, encoding='unicode', method='html') for child in root)
+    else:
+        parts.extend(xml.etree.ElementTree.tostring(child, encoding='unicode', method='html') for child in root)
+    return ''.join(parts)
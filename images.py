@@ -0,0 +1,431 @@
+"""
+Persistent store for images loaded from Moodle and other sites.
+
+Image files are stored under the hash of their content, so that an image used
+in many entries or under different URLs is stored only once. For every URL the
+store remembers the content hash together with ETag and Last-Modified headers
+and revalidates the stored file with a conditional request once per export.
+When the store grows beyond its maximum size, the least recently used files
+are removed.
+"""
+
+import os
+import re
+import html
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import tempfile
+import mimetypes
+import contextlib
+import collections
+import concurrent.futures
+
+import PIL.Image
+import PIL.ImageDraw
+
+import moodle
+import metrics
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.images')
+
+CHUNK_SIZE = 64 * 1024
+# seconds to wait for a lock on the index held by another process
+SQLITE_TIMEOUT = 30
+
+
+class ImageStore:
+    def __init__(self, directory, max_size):
+        """
+        Opens or creates an image store.
+
+        :param directory: directory containing the image files and the index
+        :param max_size: maximum size of all stored image files in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.resolved = {}
+        os.makedirs(directory, exist_ok=True)
+        # processes rendering modules in parallel share the index, so wait longer for their transactions
+        self.connection = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=SQLITE_TIMEOUT,
+                                          check_same_thread=False)
+        with self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, hash TEXT, etag TEXT, last_modified TEXT);
+                CREATE TABLE IF NOT EXISTS files (hash TEXT PRIMARY KEY, filename TEXT, size INTEGER,
+                                                  accessed REAL);
+                CREATE TABLE IF NOT EXISTS variants (key TEXT PRIMARY KEY, filename TEXT);
+            ''')
+        self.bytes_saved = 0
+        self.normalized = set()
+
+    def begin_export(self):
+        """Forgets which URLs were already resolved, so they are revalidated again."""
+        with self.lock:
+            self.resolved.clear()
+            self.normalized.clear()
+            self.bytes_saved = 0
+
+    def take_bytes_saved(self):
+        """Returns the bytes saved by normalizing images since the last call, e.g. in a worker process."""
+        with self.lock:
+            bytes_saved, self.bytes_saved = self.bytes_saved, 0
+        return bytes_saved
+
+    def add_bytes_saved(self, bytes_saved):
+        """Adds the bytes saved by normalizing images in another process."""
+        with self.lock:
+            self.bytes_saved += bytes_saved
+
+    def resolve(self, url):
+        """
+        Returns the path of a local file containing the image from the given
+        URL. The image is only downloaded when it is not yet stored or has been
+        changed on the server.
+        """
+        with self.lock:
+            if url in self.resolved:
+                return self.resolved[url]
+            row = self.connection.execute('SELECT urls.hash, etag, last_modified, filename FROM urls '
+                                          'JOIN files ON urls.hash = files.hash WHERE url = ?', (url,)).fetchone()
+        headers = {}
+        if row is not None and os.path.exists(os.path.join(self.directory, row[3])):
+            content_hash, etag, last_modified, filename = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        with metrics.span('images.download'):
+            response = moodle.fetch_image(url, headers, stream=True)
+            if response.status_code == 304:
+                logger.debug('Image not modified: {}'.format(url))
+                metrics.count('images.not_modified')
+                response.close()
+            else:
+                if not response.ok:
+                    response.close()
+                response.raise_for_status()
+                content_hash, filename = self._store(response)
+                with self.lock, self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)',
+                                            (url, content_hash, response.headers.get('ETag'),
+                                             response.headers.get('Last-Modified')))
+        path = os.path.join(self.directory, filename)
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE files SET accessed = ? WHERE hash = ?', (time.time(), content_hash))
+            self.resolved[url] = path
+            self._evict()
+        return path
+
+    def lookup(self, url):
+        """Returns the path of the file stored for the given URL without revalidating it or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT filename FROM urls JOIN files ON urls.hash = files.hash '
+                                          'WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(os.path.join(self.directory, row[0])):
+            return None
+        return os.path.join(self.directory, row[0])
+
+    def normalize(self, path, width, height):
+        """
+        Returns the path of a variant of the given image that is resampled to
+        the resolution needed for a box of the given size (in points) and
+        recompressed. The variant is stored, so it is created only once. If it
+        is not smaller than the original image, the original path is returned.
+        """
+        images_config = CONFIG['images']
+        if not images_config['normalize']:
+            return path
+        dpi = images_config['dpi']
+        target_width, target_height = int(width / 72 * dpi), int(height / 72 * dpi)
+        name = os.path.basename(path)
+        key = '{}_{}x{}_{}'.format(name, target_width, target_height, images_config['jpeg_quality'])
+        with self.lock:
+            row = self.connection.execute('SELECT filename FROM variants WHERE key = ?', (key,)).fetchone()
+        if row is not None and os.path.exists(os.path.join(self.directory, row[0])):
+            variant_path = os.path.join(self.directory, row[0])
+        else:
+            with metrics.span('images.normalize'):
+                variant_path = self._create_variant(path, key, target_width, target_height)
+        if variant_path != path:
+            saved = os.path.getsize(path) - os.path.getsize(variant_path)
+            # count every variant once per export, even if several threads normalize the same image
+            with self.lock:
+                if key not in self.normalized:
+                    self.normalized.add(key)
+                    self.bytes_saved += saved
+        return variant_path
+
+    def _create_variant(self, path, key, target_width, target_height):
+        images_config = CONFIG['images']
+        try:
+            with PIL.Image.open(path) as image:
+                image_format = image.format
+                if image_format not in ('JPEG', 'PNG'):
+                    return path
+                if image.width > target_width or image.height > target_height:
+                    image.thumbnail((max(target_width, 1), max(target_height, 1)), PIL.Image.LANCZOS)
+                else:
+                    image.load()
+                variant_name = '{}{}'.format(hashlib.sha256(key.encode('utf-8')).hexdigest(),
+                                             '.jpg' if image_format == 'JPEG' else '.png')
+                variant_path = os.path.join(self.directory, variant_name)
+                # write to a temporary file first, other processes may read the same variant at the same time
+                temp_path = '{}.{}.{}.tmp'.format(variant_path, os.getpid(), threading.get_ident())
+                if image_format == 'JPEG':
+                    image.convert('RGB').save(temp_path, 'JPEG', quality=images_config['jpeg_quality'],
+                                              optimize=True)
+                else:
+                    image.save(temp_path, 'PNG', optimize=True)
+        except (OSError, ValueError) as e:
+            logger.warning('Could not normalize image {}: {}'.format(path, e))
+            return path
+        size = os.path.getsize(temp_path)
+        if size >= os.path.getsize(path):
+            os.remove(temp_path)
+            variant_name, variant_path = os.path.basename(path), path
+        else:
+            os.replace(temp_path, variant_path)
+            logger.debug('Normalized image {} to {} bytes.'.format(path, size))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO variants VALUES (?, ?)', (key, variant_name))
+            if variant_path != path:
+                self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                        (variant_name[:64], variant_name, size, time.time()))
+        return variant_path
+
+    def get_placeholder(self):
+        """Returns the path of an image used in place of images that could not be loaded."""
+        path = os.path.join(self.directory, 'placeholder.png')
+        if not os.path.exists(path):
+            placeholder = PIL.Image.new('RGB', (200, 150), 'lightgray')
+            draw = PIL.ImageDraw.Draw(placeholder)
+            draw.line((0, 0, 199, 149), fill='darkgray', width=3)
+            draw.line((0, 149, 199, 0), fill='darkgray', width=3)
+            # write to a temporary file first, other threads and processes may read the placeholder at the same time
+            temp_file = tempfile.NamedTemporaryFile(dir=self.directory, prefix='placeholder_', suffix='.png',
+                                                    delete=False)
+            try:
+                with temp_file:
+                    placeholder.save(temp_file, 'PNG')
+            except BaseException:
+                os.remove(temp_file.name)
+                raise
+            os.replace(temp_file.name, path)
+        return path
+
+    def _store(self, response):
+        """
+        Streams the body of the response into a file in the store. The content
+        is hashed while it is written, so it is never held in memory as a
+        whole. Downloads larger than the configured maximum or shorter than
+        announced are aborted and their partial files removed.
+        """
+        max_size = CONFIG['images']['max_download_mb'] * 1024 * 1024
+        expected_size = response.headers.get('Content-Length')
+        if expected_size is not None and int(expected_size) > max_size:
+            response.close()
+            raise OSError('Image too large ({} bytes): {}'.format(expected_size, response.url))
+        content_hash = hashlib.sha256()
+        size = 0
+        temp_file = tempfile.NamedTemporaryFile(dir=self.directory, prefix='download_', delete=False)
+        try:
+            with temp_file, response:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise OSError('Image too large (more than {} bytes): {}'.format(max_size, response.url))
+                    content_hash.update(chunk)
+                    temp_file.write(chunk)
+            if expected_size is not None and size != int(expected_size) and not response.headers.get(
+                    'Content-Encoding'):
+                raise OSError('Incomplete download ({} of {} bytes): {}'.format(size, expected_size, response.url))
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+        content_hash = content_hash.hexdigest()
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        filename = content_hash + (mimetypes.guess_extension(content_type) or '')
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            exists = self.connection.execute('SELECT 1 FROM files WHERE hash = ?', (content_hash,)).fetchone()
+        if exists and os.path.exists(path):
+            logger.debug('Image already stored as {}.'.format(filename))
+            os.remove(temp_file.name)
+            return content_hash, filename
+        os.replace(temp_file.name, path)
+        metrics.count('images.downloaded_bytes', size)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    (content_hash, filename, size, time.time()))
+        return content_hash, filename
+
+    def _evict(self):
+        overall, = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()
+        if overall <= self.max_size:
+            return
+        in_use = set(self.resolved.values())
+        for content_hash, filename, size in self.connection.execute(
+                'SELECT hash, filename, size FROM files ORDER BY accessed').fetchall():
+            if overall <= self.max_size:
+                break
+            path = os.path.join(self.directory, filename)
+            if path in in_use:
+                continue
+            logger.debug('Removing image {} from store.'.format(filename))
+            if os.path.exists(path):
+                os.remove(path)
+            self.connection.execute('DELETE FROM files WHERE hash = ?', (content_hash,))
+            self.connection.execute('DELETE FROM urls WHERE hash = ?', (content_hash,))
+            self.connection.execute('DELETE FROM variants WHERE filename = ?', (filename,))
+            overall -= size
+
+
+class ImagePrefetcher:
+    """
+    Downloads images on a pool of worker threads ahead of rendering. Images that
+    can not be loaded are replaced by a placeholder, so a broken link does not
+    abort the export.
+    """
+    def __init__(self, store, max_workers):
+        self.store = store
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='image_prefetch')
+        self.lock = threading.Lock()
+        self.futures = {}
+        # list of tuples with URL, latency in seconds and error message (or None)
+        self.report = []
+
+    def submit(self, url):
+        """Starts loading the image from the given URL, if not already started."""
+        with self.lock:
+            if url not in self.futures:
+                self.futures[url] = self.executor.submit(self._load, url)
+            return self.futures[url]
+
+    def submit_html(self, html):
+        """Starts loading all images referenced by <img> tags in the given HTML."""
+        for url in find_image_urls(html):
+            self.submit(url)
+
+    def resolve(self, url):
+        """Returns the path of the local file for the image, waiting for its download if necessary."""
+        return self.submit(url).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        failed = [(url, error) for url, _, error in self.report if error]
+        if self.report:
+            latencies = [latency for _, latency, _ in self.report]
+            logger.info('Prefetched {} images (mean latency: {:.3f} s, max. latency: {:.3f} s), {} failed.'.format(
+                len(self.report), sum(latencies) / len(latencies), max(latencies), len(failed)))
+        for url, error in failed:
+            logger.warning('Could not load image {}: {}'.format(url, error))
+
+    def _load(self, url):
+        start = time.perf_counter()
+        error = None
+        try:
+            path = self.store.resolve(url)
+        except Exception as e:
+            error = str(e)
+            metrics.count('images.failed')
+            path = self.store.get_placeholder()
+        with self.lock:
+            self.report.append((url, time.perf_counter() - start, error))
+        return path
+
+
+IMG_SRC_REGEX = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*["']([^"']+)["']""", re.IGNORECASE)
+
+
+def find_image_urls(content):
+    """
+    Returns the source URLs of all <img> tags in the given HTML. Character
+    references are replaced like by an HTML parser, so the URLs are the same
+    as those resolved while the HTML is converted.
+    """
+    return [html.unescape(url) for url in IMG_SRC_REGEX.findall(content)]
+
+
+def prefetch_ahead(items, get_urls, window):
+    """
+    Generator passing through all items while submitting the image URLs of the
+    next items to the active prefetcher. Up to window items are read ahead.
+    """
+    if _prefetcher is None:
+        yield from items
+        return
+    buffer = collections.deque()
+    for item in items:
+        for url in get_urls(item):
+            _prefetcher.submit(url)
+        buffer.append(item)
+        if len(buffer) > window:
+            yield buffer.popleft()
+    yield from buffer
+
+
+_image_store = None
+_image_store_lock = threading.Lock()
+_prefetcher = None
+
+
+def get_image_store():
+    """Returns the shared image store configured by the [images] section."""
+    global _image_store
+    with _image_store_lock:
+        if _image_store is None:
+            _image_store = ImageStore(CONFIG['images']['directory'], CONFIG['images']['max_size_mb'] * 1024 * 1024)
+        return _image_store
+
+
+@contextlib.contextmanager
+def prefetch():
+    """
+    Context manager activating a prefetcher for the shared image store. While
+    it is active, resolve_image() takes images from the prefetcher.
+    """
+    global _prefetcher
+    _prefetcher = ImagePrefetcher(get_image_store(), CONFIG['images']['prefetch_workers'])
+    try:
+        yield _prefetcher
+    finally:
+        _prefetcher.close()
+        _prefetcher = None
+
+
+def submit_html(html):
+    """Starts loading all images referenced in the given HTML, if a prefetcher is active."""
+    if _prefetcher is not None:
+        _prefetcher.submit_html(html)
+
+
+def resolve_image(url):
+    """
+    Returns the path of a local file containing the image from the given URL.
+    If the image can not be loaded, the path of a placeholder image is returned.
+    """
+    if _prefetcher is not None:
+        with metrics.span('images.wait'):
+            return _prefetcher.resolve(url)
+    store = get_image_store()
+    try:
+        return store.resolve(url)
+    except Exception as e:
+        logger.warning('Could not load image {}: {}'.format(url, e))
+        metrics.count('images.failed')
+        return store.get_placeholder()
+
+
+def normalize_image(path, width, height):
+    """
+    Returns the path of a variant of the given image that is resampled for a
+    box of the given size (in points) and recompressed.
+    """
+    return get_image_store().normalize(path, width, height)
@@ -0,0 +1,285 @@
+"""
+Lightweight instrumentation of the export pipeline.
+
+Code measures the duration of an operation with a span and counts events with
+a counter, both identified by a name and optional labels:
+
+    with metrics.span('moodle.call', function=fname):
+        ...
+    metrics.count('images.downloaded_bytes', size)
+
+While metrics are disabled, span() returns a shared no-op context manager and
+count() returns at once, so instrumented code runs at nearly full speed.
+After enable() all spans and counters are aggregated in memory and passed to
+the configured exporters (JSON lines file, Prometheus text file). The
+aggregated values can be printed as a summary table with format_summary().
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.metrics')
+
+_registry = None
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class MetricsRegistry:
+    """Aggregates all spans and counters and passes them on to the exporters."""
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+        self.lock = threading.Lock()
+        # mapping from name and labels to count, total and maximum duration
+        self.spans = {}
+        # mapping from name and labels to value
+        self.counters = {}
+
+    def add_span(self, name, labels, start, duration):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.spans.get(key)
+            if values is None:
+                self.spans[key] = [1, duration, duration]
+            else:
+                values[0] += 1
+                values[1] += duration
+                values[2] = max(values[2], duration)
+            for exporter in self.exporters:
+                exporter.add_span(name, labels, start, duration)
+
+    def add(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def merge(self, spans, counters):
+        with self.lock:
+            for key, (number, total, maximum) in spans.items():
+                values = self.spans.get(key)
+                if values is None:
+                    self.spans[key] = [number, total, maximum]
+                else:
+                    values[0] += number
+                    values[1] += total
+                    values[2] = max(values[2], maximum)
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def close(self):
+        """Writes all aggregated values with the exporters and closes them."""
+        with self.lock:
+            for exporter in self.exporters:
+                try:
+                    exporter.close(self)
+                except OSError as e:
+                    logger.error('Could not write metrics: {}'.format(e))
+
+
+class Span:
+    __slots__ = ('registry', 'name', 'labels', 'start', 'wall_time')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.wall_time = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.labels = dict(self.labels, error=exc_type.__name__)
+        self.registry.add_span(self.name, self.labels, self.wall_time, duration)
+        return False
+
+
+def span(name, **labels):
+    """Returns a context manager measuring the duration of the enclosed code."""
+    registry = _registry
+    if registry is None:
+        return _NULL_SPAN
+    return Span(registry, name, labels)
+
+
+def measure_iterator(iterable, name, **labels):
+    """
+    Returns an iterator over all items of the iterable, that measures the time
+    spent producing the items as one span. Time spent by the consumer between
+    the items is not counted.
+    """
+    registry = _registry
+    if registry is None:
+        return iter(iterable)
+    return _measure_iterator(registry, iter(iterable), name, labels)
+
+
+def _measure_iterator(registry, iterator, name, labels):
+    wall_time = time.time()
+    duration = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                duration += time.perf_counter() - start
+            yield item
+    finally:
+        registry.add_span(name, labels, wall_time, duration)
+
+
+def count(name, value=1, **labels):
+    """Adds a value to a counter."""
+    registry = _registry
+    if registry is not None:
+        registry.add(name, value, labels)
+
+
+def is_enabled():
+    return _registry is not None
+
+
+def collect():
+    """
+    Returns the spans and counters aggregated since the last call and starts
+    aggregating anew, e.g. in a worker process sending its metrics to the main
+    process. Returns None while metrics are disabled.
+    """
+    registry = _registry
+    if registry is None:
+        return None
+    with registry.lock:
+        values = registry.spans, registry.counters
+        registry.spans, registry.counters = {}, {}
+    return values
+
+
+def merge(values):
+    """
+    Adds spans and counters returned by collect() in another process. Only
+    the aggregated values are added, the exporters do not see single spans.
+    """
+    registry = _registry
+    if registry is not None and values is not None:
+        registry.merge(*values)
+
+
+def enable(exporters=None):
+    """
+    Starts collecting metrics. If no exporters are given, they are created as
+    configured in the [metrics] section of the configuration file.
+    """
+    global _registry
+    if exporters is None:
+        exporters = create_exporters()
+    _registry = MetricsRegistry(exporters)
+    return _registry
+
+
+def disable():
+    """Stops collecting metrics, writes them with all exporters and returns the registry."""
+    global _registry
+    registry, _registry = _registry, None
+    if registry is not None:
+        registry.close()
+    return registry
+
+
+def create_exporters():
+    metrics_config = CONFIG['metrics']
+    exporters = []
+    for name in metrics_config['exporters']:
+        if name == 'jsonl':
+            exporters.append(JsonLinesExporter(metrics_config['jsonl_filename']))
+        elif name == 'prometheus':
+            exporters.append(PrometheusExporter(metrics_config['prometheus_filename']))
+        else:
+            logger.warning('Unknown metrics exporter: {}'.format(name))
+    return exporters
+
+
+def format_summary(registry):
+    """Returns a table with count, total, mean and maximum duration of all spans and all counters."""
+    lines = ['{:<60}{:>8}{:>11}{:>11}{:>11}'.format('Span', 'Count', 'Total (s)', 'Mean (s)', 'Max (s)')]
+    for (name, labels), (number, total, maximum) in sorted(registry.spans.items(), key=lambda s: -s[1][1]):
+        lines.append('{:<60}{:>8}{:>11.3f}{:>11.3f}{:>11.3f}'.format(
+            _format_name(name, labels), number, total, total / number, maximum))
+    if registry.counters:
+        lines.append('')
+        lines.append('{:<60}{:>8}'.format('Counter', 'Value'))
+        for (name, labels), value in sorted(registry.counters.items()):
+            lines.append('{:<60}{:>8}'.format(_format_name(name, labels), value))
+    return '\n'.join(lines)
+
+
+def _format_name(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for k, v in labels))
+
+
+############################## Exporters ##############################
+
+class JsonLinesExporter:
+    """Writes every span as a line of JSON and all counters when closed."""
+    def __init__(self, filename):
+        self.file = open(filename, 'a', encoding='utf-8')
+
+    def add_span(self, name, labels, start, duration):
+        self.file.write(json.dumps({'type': 'span', 'name': name, 'labels': labels, 'start': start,
+                                    'duration': duration, 'thread': threading.current_thread().name}) + '\n')
+
+    def close(self, registry):
+        now = time.time()
+        for (name, labels), value in registry.counters.items():
+            self.file.write(json.dumps({'type': 'counter', 'name': name, 'labels': dict(labels), 'time': now,
+                                        'value': value}) + '\n')
+        self.file.close()
+
+
+class PrometheusExporter:
+    """
+    Writes all aggregated values in the text format of Prometheus when closed,
+    e.g. for the textfile collector of the node exporter.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def add_span(self, name, labels, start, duration):
+        pass
+
+    def close(self, registry):
+        lines = []
+        for metric, suffix, metric_type, values in (
+                ('seconds', '', 'summary', registry.spans),
+                ('', 'total', 'counter', registry.counters)):
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                metric_name = '_'.join(s for s in ('moodle2pdf', name.replace('.', '_'), metric, suffix) if s)
+                if metric_name not in typed:
+                    typed.add(metric_name)
+                    lines.append('# TYPE {} {}'.format(metric_name, metric_type))
+                label_text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                label_text = '{{{}}}'.format(label_text) if label_text else ''
+                if metric_type == 'summary':
+                    lines.append('{}_sum{} {}'.format(metric_name, label_text, value[1]))
+                    lines.append('{}_count{} {}'.format(metric_name, label_text, value[0]))
+                else:
+                    lines.append('{}{} {}'.format(metric_name, label_text, value))
+        # replace the file at once, so that a collector never reads a partial file
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(self.filename + '.tmp', self.filename)
@@ -1,16 +1,172 @@
 
 import os
+import json
+import time
+import random
 import logging
+import threading
+import collections
+import concurrent.futures
 import urllib.parse
 
 import requests
-
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import metrics
+from cache import ResponseCache
+from ratelimit import AdaptiveLimiter
 from config import CONFIG
+from data import Course, CourseModule, Glossary, Wiki, Database, GlossaryEntry, WikiPage, DatabaseEntry
 
 
 logger = logging.getLogger('moodle2pdf.moodle')
 
 
+############################## HTTP session ########################################
+
+_session = None
+_session_lock = threading.Lock()
+request_timings = collections.deque(maxlen=1000)
+
+
+def get_session():
+    """
+    Returns the shared HTTP session used for all requests to the Moodle site.
+    The session pools its connections and keeps them alive, so consecutive
+    calls reuse an open TCP/TLS connection instead of doing a new handshake.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def create_session():
+    """
+    Creates a new HTTP session configured by the [http] section of the
+    configuration file.
+    """
+    http_config = CONFIG['http']
+    session = requests.Session()
+    retries = Retry(total=http_config['retries'], connect=http_config['retries'], read=0,
+                    backoff_factor=http_config['backoff_factor'])
+    adapter = HTTPAdapter(pool_connections=http_config['pool_connections'],
+                          pool_maxsize=http_config['pool_maxsize'], max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not http_config['keep_alive']:
+        session.headers['Connection'] = 'close'
+    session.hooks['response'].append(_record_timing)
+    return session
+
+
+def close_session():
+    """Closes all pooled connections of the shared HTTP session."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _record_timing(response, *args, **kwargs):
+    url = response.request.url.split('?')[0]
+    elapsed = response.elapsed.total_seconds()
+    request_timings.append((response.request.method, url, response.status_code, elapsed))
+    logger.debug('{} {} -> {} in {:.3f} s'.format(response.request.method, url, response.status_code, elapsed))
+
+
+def get_request_statistics():
+    """
+    Returns number of requests, total time and mean time (in seconds) over all
+    recorded requests. The time is measured until the response headers were
+    received, so reused connections show up as shorter requests.
+    """
+    count = len(request_timings)
+    total = sum(t[3] for t in request_timings)
+    return count, total, total / count if count else 0.0
+
+
+def _request(method, url, **kwargs):
+    http_config = CONFIG['http']
+    kwargs.setdefault('timeout', (http_config['connect_timeout'], http_config['read_timeout']))
+    limiter = get_rate_limiter()
+    if limiter is None or not CONFIG['moodle']['url'] or not url.startswith(CONFIG['moodle']['url']):
+        return get_session().request(method, url, **kwargs)
+    # requests to the Moodle site are limited and feed back whether the server is overloaded
+    limiter.acquire()
+    overloaded = False
+    try:
+        response = get_session().request(method, url, **kwargs)
+        overloaded = response.status_code in OVERLOAD_STATUS_CODES
+        return response
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+        overloaded = True
+        raise
+    finally:
+        limiter.release(overloaded)
+
+
+############################## Rate limiting ########################################
+
+# HTTP status codes signaling that the server is overloaded
+OVERLOAD_STATUS_CODES = (429, 503)
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter shared by all threads or None, if rate limiting
+    is disabled in the [ratelimit] section of the configuration file.
+    """
+    global _rate_limiter
+    limit_config = CONFIG['ratelimit']
+    if not limit_config['enabled']:
+        return None
+    with _session_lock:
+        if _rate_limiter is None:
+            _rate_limiter = AdaptiveLimiter(limit_config['rate'], limit_config['min_rate'], limit_config['max_rate'],
+                                            limit_config['burst'], limit_config['concurrency'],
+                                            CONFIG['http']['max_concurrency'])
+        return _rate_limiter
+
+
+def share_rate_limit(parts):
+    """
+    Divides the configured request rate and concurrency into equal parts, e.g.
+    for each of several processes sending requests to the same site, so that
+    all processes together stay within the configured limits. Must be called
+    before the rate limiter is created.
+    """
+    limit_config = CONFIG['ratelimit']
+    for key in ('rate', 'min_rate', 'max_rate'):
+        limit_config[key] = limit_config[key] / parts
+    limit_config['burst'] = max(1, limit_config['burst'] // parts)
+    limit_config['concurrency'] = max(1, limit_config['concurrency'] // parts)
+    CONFIG['http']['max_concurrency'] = max(1, CONFIG['http']['max_concurrency'] // parts)
+
+
+def _get_retry_delay(attempt, response=None):
+    """Returns the time to wait before the next attempt with exponential backoff and jitter."""
+    limit_config = CONFIG['ratelimit']
+    delay = min(limit_config['backoff_max'], limit_config['backoff_base'] * 2 ** attempt)
+    delay = random.uniform(delay / 2, delay)
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        delay = max(delay, int(response.headers['Retry-After']))
+    return delay
+
+
 ############################## General functions ########################################
 
 def rest_api_parameters(in_args, prefix='', out_dict=None):
@@ -51,35 +207,230 @@ def call_mdl_function(fname, **kwargs):
     >>> call_mdl_function('core_course_update_courses',
                            courses = [{'id': 1, 'fullname': 'My favorite course'}])
     """
+    return _call_mdl_function(fname, kwargs, use_cache=True)
+
+
+def call_mdl_function_uncached(fname, **kwargs):
+    """
+    Calls a Moodle API function like call_mdl_function(), but never takes the
+    response from the response cache or stores it there, e.g. for listings
+    used to detect changes.
+    """
+    return _call_mdl_function(fname, kwargs, use_cache=False)
+
+
+def _call_mdl_function(fname, kwargs, use_cache):
     parameters = rest_api_parameters(kwargs)
+    url = urllib.parse.urljoin(CONFIG['moodle']['url'], CONFIG['moodle']['endpoint'])
+    cache = get_response_cache()
+    ttl = CONFIG['cache']['ttl'].get(fname) if cache and use_cache else None
+    if ttl:
+        key = cache.make_key(url, CONFIG['moodle']['token'], fname, parameters)
+        response = cache.get(key)
+        if response is not None:
+            logger.debug('Using cached response for {}.'.format(fname))
+            metrics.count('moodle.cache_hits', function=fname)
+            return response
     parameters.update({'wstoken': CONFIG['moodle']['token'],
                        'moodlewsrestformat': 'json', 'wsfunction': fname})
-    response = requests.post(urllib.parse.urljoin(CONFIG['moodle']['url'], CONFIG['moodle']['endpoint']), parameters)
-    logger.debug('Response Encoding: {}, Best guess: {}'.format(response.encoding, response.apparent_encoding))
-    response = response.json()
+    # only calls that do not change data are retried
+    retries = 0 if fname in MUTATING_FUNCTIONS else CONFIG['ratelimit']['retries']
+    with metrics.span('moodle.call', function=fname):
+        for attempt in range(retries + 1):
+            response = None
+            try:
+                response = _request('POST', url, data=parameters)
+                response.raise_for_status()
+                response = decode_json(response)
+                break
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                    requests.exceptions.HTTPError, ValueError) as e:
+                client_error = isinstance(e, requests.exceptions.HTTPError) and response.status_code < 500 and \
+                    response.status_code != 429
+                if attempt == retries or client_error:
+                    raise
+                delay = _get_retry_delay(attempt, response)
+                logger.warning('Calling {} failed ({}), retrying in {:.1f} s...'.format(fname, e, delay))
+                metrics.count('moodle.retries', function=fname)
+                time.sleep(delay)
     if type(response) == dict and response.get('exception'):
         raise SystemError('Error calling Moodle API', response)
+    if cache:
+        if ttl:
+            cache.put(key, fname, response, ttl, _get_cache_tags(fname, kwargs))
+        _update_cache(cache, fname, kwargs, response)
     return response
 
 
-def download_image(link, directory):
-    try:
-        download_image.counter += 1
-    except AttributeError:
-        download_image.counter = 1
+############################## Response cache ########################################
+
+# API functions that change data on the Moodle site and therefore invalidate cached responses
+MUTATING_FUNCTIONS = ('core_course_edit_module', 'core_course_edit_section', 'core_course_update_courses')
+
+# parameters of API functions identifying the Moodle module whose data is returned
+MODULE_PARAMETERS = {'mod_glossary_get_entries_by_letter': ('glossary', 'id'),
+                     'mod_glossary_get_entries_by_date': ('glossary', 'id'),
+                     'mod_data_get_fields': ('database', 'databaseid'),
+                     'mod_data_get_entries': ('database', 'databaseid'),
+                     'mod_wiki_get_subwikis': ('wiki', 'wikiid'),
+                     'mod_wiki_get_subwiki_pages': ('wiki', 'wikiid')}
+
+# API functions listing modules of courses together with their modification time
+MODULE_LISTINGS = {'mod_glossary_get_glossaries_by_courses': ('glossary', 'glossaries'),
+                   'mod_data_get_databases_by_courses': ('database', 'databases'),
+                   'mod_wiki_get_wikis_by_courses': ('wiki', 'wikis')}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Returns the shared response cache or None, if caching is disabled in the
+    [cache] section of the configuration file.
+    """
+    global _response_cache
+    if not CONFIG['cache']['enabled']:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(CONFIG['cache']['filename'], CONFIG['cache']['max_size_mb'] * 1024 * 1024)
+        return _response_cache
+
+
+def invalidate_module(module_type, module_id):
+    """Removes all cached responses containing data of the given module, e.g. when it was changed."""
+    cache = get_response_cache()
+    if cache:
+        cache.invalidate('{}:{}'.format(module_type, module_id))
+
+
+def _get_cache_tags(fname, kwargs):
+    tags = ['course:{}'.format(c) for c in kwargs.get('courseids', [])]
+    if 'courseid' in kwargs:
+        tags.append('course:{}'.format(kwargs['courseid']))
+    if fname in MODULE_PARAMETERS:
+        module_type, parameter = MODULE_PARAMETERS[fname]
+        tags.append('{}:{}'.format(module_type, kwargs[parameter]))
+    return tags
+
+
+def _update_cache(cache, fname, kwargs, response):
+    if fname in MUTATING_FUNCTIONS:
+        # invalidate all responses for the course containing the changed module
+        courseid = cache.get_course_for_module(kwargs.get('id'))
+        if courseid is None:
+            logger.debug('Course for changed module unknown, clearing response cache.')
+            cache.clear()
+        else:
+            cache.invalidate('course:{}'.format(courseid))
+    elif fname == 'core_course_get_contents':
+        cache.add_modules(kwargs['courseid'], [m['id'] for c in response for m in c['modules']])
+    elif fname in MODULE_LISTINGS:
+        # invalidate data of all modules that have been changed since they were last seen
+        module_type, key = MODULE_LISTINGS[fname]
+        for m in response[key]:
+            if 'timemodified' in m:
+                cache.check_modified('{}:{}'.format(module_type, m['id']), m['timemodified'])
+
+
+def decode_json(response):
+    """
+    Decodes the JSON body of a response. Moodle always sends UTF-8, so the
+    body is decoded without guessing its character set. If the library orjson
+    is installed, it is used instead of the standard library.
+    """
+    content = response.content
+    if response.encoding and response.encoding.lower() not in ('utf-8', 'utf8'):
+        content = content.decode(response.encoding).encode('utf-8')
+    if orjson:
+        return orjson.loads(content)
+    return json.loads(content.decode('utf-8'))
+
+
+def iter_mdl_function(fname, prefix, **kwargs):
+    """
+    Calls moodle API function and yields all elements of a list in the
+    response. The list is given by a prefix in the notation of the library
+    ijson, e.g. "item" for a top-level list or "pages.item" for the list
+    "pages".
+
+    If the library ijson is installed and the option "stream_json" is set, the
+    response is parsed while it is received, so the first items are available
+    before the whole body is loaded. Streamed responses are not cached.
+    Otherwise the call is done by call_mdl_function().
+    """
+    cache = get_response_cache()
+    if not ijson or not CONFIG['http']['stream_json'] or (cache and CONFIG['cache']['ttl'].get(fname)):
+        response = call_mdl_function(fname, **kwargs)
+        for key in prefix.split('.')[:-1]:
+            response = response[key]
+        yield from response
+        return
+    parameters = rest_api_parameters(kwargs)
+    parameters.update({'wstoken': CONFIG['moodle']['token'],
+                       'moodlewsrestformat': 'json', 'wsfunction': fname})
+    url = urllib.parse.urljoin(CONFIG['moodle']['url'], CONFIG['moodle']['endpoint'])
+    # only the time until the headers are received is measured, the body is read while it is consumed
+    with metrics.span('moodle.call', function=fname, streamed=True):
+        response = _request('POST', url, data=parameters, stream=True)
+    with response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        # errors are returned as small objects starting with the key "exception"
+        start = response.raw.read(1024)
+        if start.lstrip().startswith(b'{"exception"'):
+            error = json.loads((start + response.raw.read()).decode('utf-8'))
+            raise SystemError('Error calling Moodle API', error)
+        yield from ijson.items(_PrefixedStream(start, response.raw), prefix, use_float=True)
+
+
+class _PrefixedStream:
+    """File-like object returning already read bytes before the rest of a stream."""
+    def __init__(self, start, stream):
+        self.start = start
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.start and size != 0:
+            data, self.start = self.start, b''
+            return data
+        return self.stream.read(size)
+
+
+def iterate_pages(fetch_page):
+    """
+    Generator yielding all items of a paged API function. The given function
+    fetch_page(page_no) has to return a list of items and whether more pages
+    follow. While the items of one page are consumed, the next page is already
+    loaded in the background, so only two pages are held in memory at a time.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        page_no = 0
+        future = executor.submit(fetch_page, page_no)
+        while future is not None:
+            items, more = future.result()
+            page_no += 1
+            future = executor.submit(fetch_page, page_no) if more else None
+            yield from items
+            del items
+
+
+def fetch_image(link, headers=None, stream=False):
+    """
+    Requests an image and returns the response. Images from the Moodle site are
+    requested with the auth token, all others by a simple GET request. Optional
+    headers can be used for conditional requests. If stream is set, the body is
+    not loaded until it is read from the response.
+    """
     logger.info('Loading image from {}'.format(link))
-    if CONFIG['moodle']['url'] in link:
+    if CONFIG['moodle']['url'] and CONFIG['moodle']['url'] in link:
         # get image file from Moodle by POST request with auth token
         parameters = {'token': CONFIG['moodle']['token']}
-        response = requests.post(link, parameters)
+        return _request('POST', link, data=parameters, headers=headers, stream=stream)
     else:
         # get external image with a simple GET request
-        response = requests.get(link)
-    only_file_name = 'image{}'.format(download_image.counter)
-    image_file_name_on_disk = os.path.join(directory, only_file_name)
-    with open(image_file_name_on_disk, 'wb') as image_on_disk:
-        image_on_disk.write(response.content)
-    return image_file_name_on_disk
+        return _request('GET', link, headers=headers, stream=stream)
 
 
 ################################## User and Course functions ##################################
@@ -88,7 +439,7 @@ def get_token_for_user(username, password, servicename='moodle_mobile_app'):
     login_url = 'login/token.php?username={username}&password={password}&service={servicename}'
     token_url = urllib.parse.urljoin(CONFIG['moodle']['url'], login_url)
     url = token_url.format(username=username, password=password, servicename=servicename)
-    r = requests.get(url)
+    r = _request('GET', url)
     return r.json()['token']
 
 
@@ -97,7 +448,7 @@ def get_courses_for_user(userid=None):
         userid = get_user_id()
     response = call_mdl_function('core_enrol_get_users_courses', userid=userid)
     # check whether user is teacher: core_enrol_get_enrolled_users
-    return [(c['id'], c['fullname']) for c in response]
+    return [Course(c['id'], c['fullname']) for c in response]
 
 
 def get_user_id():
@@ -109,48 +460,73 @@ def get_user_id():
 def get_content_for_course(courseid):
     """
     Gets all activities and materials for a given course. The returned list
-    contains tuple with the id and name of the course section and the id, name
-    and type of the element.
+    contains a course module for each element with the id and name of its
+    course section and the id, name and type of the element.
     """
-    content = call_mdl_function('core_course_get_contents', courseid=courseid)
     result = []
-    for c in content:
+    # sections are processed while the (possibly very large) response is received
+    for c in iter_mdl_function('core_course_get_contents', 'item', courseid=courseid):
         for m in c['modules']:
-            result.append((c['id'], c['name'], m['id'], m['name'], m['modname'], m['visible'], m['uservisible'],
-                          m['visibleoncoursepage'], m['modicon']))
+            result.append(CourseModule(c['id'], c['name'], m['id'], m['name'], m['modname'], m['visible'],
+                                       m['uservisible'], m['visibleoncoursepage'], m['modicon']))
     return result
 
 
 ############################## Glossary functions ##############################
 
 def get_glossaries_from_course(courseid):
-    id_list = []
     response = call_mdl_function('mod_glossary_get_glossaries_by_courses', courseids=[courseid])
+    return parse_glossaries(response)
+
+
+def parse_glossaries(response):
+    id_list = []
     for g in response['glossaries']:
-        id_list.append((g['id'], g['name']))
+        id_list.append(Glossary(g['id'], g['name']))
     return id_list
 
 
 def get_entries_for_glossary(glossary_id, directory):
-    entries = call_mdl_function('mod_glossary_get_entries_by_letter', id=glossary_id, letter='ALL', limit=1000)
-    with open(os.path.join(directory, 'loaded_data_{}.xml'.format(glossary_id)), 'w', encoding='utf8') as f:
-        f.write(str(entries))
-    no = entries['count']
-    logger.info('Found {} entries in glossary.'.format(no))
-    if 'attachment' in entries and entries['attachment']:
-        for a in entries['attachments']:
-            logger.info('Found attachment for entry: {}'.format(a))
-    for e in entries['entries']:
-        yield (e['concept'], e['definition'])
+    """
+    Generator yielding all entries of a glossary. The entries are loaded page
+    by page, while the entries of one page are processed the next page is
+    already loaded in the background.
+
+    If the option "dump_responses" is set, all loaded data is written to the
+    given directory for debugging.
+    """
+    page_size = CONFIG['moodle']['page_size']
+    dump_file = os.path.join(directory, 'loaded_data_{}.xml'.format(glossary_id))
+
+    def fetch_page(page_no):
+        entries = call_mdl_function('mod_glossary_get_entries_by_letter', id=glossary_id, letter='ALL',
+                                    **{'from': page_no * page_size, 'limit': page_size})
+        if CONFIG['system']['dump_responses']:
+            with open(dump_file, 'a' if page_no else 'w', encoding='utf8') as f:
+                f.write(str(entries))
+        if page_no == 0:
+            logger.info('Found {} entries in glossary.'.format(entries['count']))
+        more = len(entries['entries']) > 0 and (page_no + 1) * page_size < entries['count']
+        return entries['entries'], more
+
+    for e in iterate_pages(fetch_page):
+        if e.get('attachment'):
+            for a in e.get('attachments', []):
+                logger.info('Found attachment for entry: {}'.format(a))
+        yield GlossaryEntry(e['id'], e['concept'], e['definition'], e['timemodified'])
 
 
 ############################## Database functions #############################
 
 def get_databases_by_courses(courseid):
-    id_list = []
     response = call_mdl_function('mod_data_get_databases_by_courses', courseids=[courseid])
+    return parse_databases(response)
+
+
+def parse_databases(response):
+    id_list = []
     for d in response['databases']:
-        id_list.append((d['id'], d['name'], d['singletemplate'], d['listtemplate']))  # d['intro']???
+        id_list.append(Database(d['id'], d['name'], d['singletemplate'], d['listtemplate']))  # d['intro']???
     return id_list
 
 
@@ -160,32 +536,54 @@ def get_fields_for_database(databaseid):
 
 
 def get_entries_for_database(databaseid):
-    entry_list = []
+    """
+    Generator yielding all entries of a database. The entries are loaded page
+    by page, while the entries of one page are processed the next page is
+    already loaded in the background.
+    """
+    page_size = CONFIG['moodle']['page_size']
     # get field names and types
     fields = get_fields_for_database(databaseid)
-    # get entries
-    entries = call_mdl_function('mod_data_get_entries', databaseid=databaseid, returncontents='1')
-    no = entries['totalcount']
-    logger.info('Found {} entries in glossary.'.format(no))
+
+    def fetch_page(page_no):
+        entries = call_mdl_function('mod_data_get_entries', databaseid=databaseid, returncontents='1',
+                                    page=page_no, perpage=page_size)
+        if page_no == 0:
+            logger.info('Found {} entries in database.'.format(entries['totalcount']))
+        more = len(entries['entries']) > 0 and (page_no + 1) * page_size < entries['totalcount']
+        return entries['entries'], more
+
     # handle all entries
-    for e in entries['entries']:
-        entry_data = {'id': e['id'], 'files': {}}
-        for i, d in enumerate(e['contents']):
-            entry_data[fields[i][1]] = d['content']
-            for f in d['files']:
-                entry_data['files'][f['filename']] = f['fileurl']
-                logger.info('Found attached file for database entry: {} (URL: {})'.format(f['filename'], f['fileurl']))
-        entry_list.append(entry_data)
-    return entry_list
+    for e in iterate_pages(fetch_page):
+        yield parse_database_entry(e, fields)
+
+
+def parse_database_entry(e, fields):
+    """
+    Returns a database entry with the names and contents of all its fields and
+    the names and URLs of all attached files.
+    """
+    entry_fields = []
+    files = []
+    for i, d in enumerate(e['contents']):
+        entry_fields.append((fields[i][1], d['content']))
+        for f in d['files']:
+            files.append((f['filename'], f['fileurl']))
+            logger.info('Found attached file for database entry: {} (URL: {})'.format(f['filename'], f['fileurl']))
+    return DatabaseEntry(e['id'], tuple(entry_fields), tuple(files))
 
 
 ################################ Wiki functions #################################
 
 def get_wikis_by_courses(courseid):
-    id_list = []
     response = call_mdl_function('mod_wiki_get_wikis_by_courses', courseids=[courseid])
+    return parse_wikis(response)
+
+
+def parse_wikis(response):
+    id_list = []
     for w in response['wikis']:
-        id_list.append((w['id'], w['name'], w['firstpagetitle'], w['wikimode'], w['defaultformat'], w['visible']))
+        id_list.append(Wiki(w['id'], w['name'], w['firstpagetitle'], w['wikimode'], w['defaultformat'], w['visible']))
     return id_list
 
 
@@ -199,10 +597,14 @@ def get_subwikis(wikiid):
 
 def get_subwiki_pages(wikiid):
     # Alternatively the API call "mod_wiki_get_page_contents" could be used.
+    pages = iter_mdl_function('mod_wiki_get_subwiki_pages', 'pages.item', wikiid=wikiid)
+    return parse_subwiki_pages({'pages': pages})
+
+
+def parse_subwiki_pages(response):
     id_list = []
-    response = call_mdl_function('mod_wiki_get_subwiki_pages ', wikiid=wikiid)
     for p in response['pages']:
-        id_list.append((p['id'], p['title'], p['cachedcontent']))
+        id_list.append(WikiPage(p['id'], p['title'], p['cachedcontent']))
     return id_list
 
 ########################### Miscellaneous functions ###########################
@@ -5,14 +5,19 @@ Moodle2PDF loads data directly from Moodle glossaries and creates a PDF file
 with the formatted entries.
 """
 
+import os
 import sys
 import getpass
 import logging
 import argparse
+import multiprocessing
 import logging.handlers
 
 import pdf
 import moodle
+import metrics
+import profiling
+import moodle_async
 from config import CONFIG
 
 
@@ -34,19 +39,28 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Converter for Moodle glossary files.')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-l', '--link', help='link for a Moodle course')
-    group.add_argument('-i', '--id', help='id of a Moodle course')
+    group.add_argument('-i', '--id', help='ids of one or more Moodle courses', nargs='+', type=int)
     parser.add_argument('-a', '--apart', action='store_false', help='create seperate PDF files for each glossary')
     parser.add_argument('-o', '--output', help='output PDF file to write glossaries to')
+    parser.add_argument('-d', '--directory', help='output directory for separate PDF files')
     parser.add_argument('-s', '--site', help='link to Moodle site including the trailing slash', required=True)
     parser.add_argument('-u', '--username', help='username for Moodle site')
     parser.add_argument('-p', '--password', help='password for Moodle site')
     parser.add_argument('-g', '--glossary', help='include Glossary modules', action='store_false')
     parser.add_argument('-w', '--wiki', help='include Wiki modules', action='store_false')
+    parser.add_argument('-n', '--incremental', action='store_true',
+                        help='only load entries that were changed since the last export')
+    parser.add_argument('-m', '--metrics', action='store_true',
+                        help='measure all phases of the export and print a summary at the end')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the export and write the reports next to the output PDF file')
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
+    # render workers of frozen executables must not start the application again
+    multiprocessing.freeze_support()
     create_logger()
     args = parse_arguments()
     # handle username and password
@@ -65,20 +79,47 @@ if __name__ == '__main__':
         match = re.match(regex, args.link, re.MULTILINE)
         if match:
             site = match.group(1)
-            course_id = match.group(2)
-            logger.debug('Result of regex: {} {}'.format(site, course_id))
+            course_ids = [int(match.group(2))]
+            logger.debug('Result of regex: {} {}'.format(site, course_ids))
         else: 
             logger.error('Link not valid!')
             sys.exit()
     else:
-        course_id = args.id
-    logger.debug('Given course id was: {}'.format(course_id))
+        course_ids = args.id
+    logger.debug('Given course ids were: {}'.format(course_ids))
     # handle option combine, site URL and 
     if args.output:
         CONFIG['pdf']['default_output_filename'] = args.output
+    if args.directory:
+        CONFIG['pdf']['output_directory'] = args.directory
+    if args.metrics or CONFIG['metrics']['enabled']:
+        metrics.enable()
     if args.site:
         CONFIG['moodle']['url'] = args.site
         CONFIG['moodle']['token'] = moodle.get_token_for_user(username, password)
-        pdf.make_pdf_from_moodle(moodle.get_glossaries_from_course(course_id), moodle.get_wikis_by_courses(53), combine_to_one_document=args.apart)
+        # discover modules of all given courses with as few requests as possible
+        glossaries, wikis, databases = [], [], []
+        for course_glossaries, course_wikis, course_databases in moodle_async.get_modules_for_courses(
+                course_ids).values():
+            glossaries.extend(course_glossaries)
+            wikis.extend(course_wikis)
+            databases.extend(course_databases)
+        # write the profile next to the output file or into the output directory next to the manifest
+        if args.apart:
+            profile_file = CONFIG['pdf']['default_output_filename']
+        else:
+            profile_file = os.path.join(CONFIG['pdf']['output_directory'], CONFIG['pdf']['manifest_filename'])
+        with profiling.profile(profile_file, enabled=args.profile):
+            statistics = pdf.make_pdf_from_moodle(glossaries, wikis, databases,
+                                                  combine_to_one_document=args.apart, incremental=args.incremental)
+        if statistics:
+            logger.info('Reused {} modules and {} entries, refetched {} modules and {} entries.'.format(
+                statistics.modules_reused, statistics.entries_reused, statistics.modules_refetched,
+                statistics.entries_refetched))
+        count, total, mean = moodle.get_request_statistics()
+        logger.info('Sent {} requests to Moodle site in {:.2f} s (mean: {:.3f} s).'.format(count, total, mean))
+        registry = metrics.disable()
+        if registry:
+            logger.info('Metrics of export:\n{}'.format(metrics.format_summary(registry)))
     else:
         logger.error('Site URL not valid!')
@@ -14,18 +14,22 @@ To finish a translation:
 
 """
 
+import os
 import sys
 import logging
 import webbrowser
+import multiprocessing
 import logging.handlers
 	
 import requests
 from PyQt5 import QtGui, QtWidgets, Qt, uic, QtCore
 
 import moodle
+import profiling
+import moodle_async
 from config import CONFIG
 from guilib import CredentialsDialog, get_resource_path
-from pdf import build_pdf_for_glossaries_and_wikis
+from pdf import build_pdf_for_glossaries_and_wikis, export_modules_separately
 
 
 logger = logging.getLogger('moodle2pdf')
@@ -76,12 +80,20 @@ class Moodle2PdfWindow(QtWidgets.QMainWindow):
         self.progressBar.setValue(0)
         for i, c in enumerate(courses):
             courseNode = QtWidgets.QTreeWidgetItem(self.siteNode)
-            courseNode.setText(0, c[1])
+            courseNode.setText(0, c.name)
             courseNode.setData(0, QtCore.Qt.UserRole, c)
             #courseNode.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
             courseNode.setIcon(0, QtGui.QIcon(get_resource_path('res/course.svg')))
             self.progressBar.setValue(100 / len(courses) * (i + 1))
         self.siteNode.setExpanded(True)
+        # load modules for all courses at once
+        self.statusBar().showMessage(self.tr('Loading all modules for courses...'))
+        modules = moodle_async.get_modules_for_courses([c.id for c in courses])
+        for i in range(self.siteNode.childCount()):
+            courseNode = self.siteNode.child(i)
+            course = courseNode.data(0, QtCore.Qt.UserRole)
+            self.populateModules(courseNode, *modules[course.id])
+        self.statusBar().showMessage(self.tr('All modules loaded.'))
 
     def removeCourses(self):
         self.siteNode.takeChildren()
@@ -98,11 +110,12 @@ class Moodle2PdfWindow(QtWidgets.QMainWindow):
             logger.info('Changing site URL...')
             self.showSiteDialog()
         elif item.parent() == self.siteNode:
-            logger.info('Loading glossaries for chosen course...')
-            id, _ = item.data(0, QtCore.Qt.UserRole)
-            self.populateGlossaries(item, id)
-            self.populateWikis(item, id)
-            self.populateDatabases(item, id)
+            if not item.childCount():
+                logger.info('Loading glossaries for chosen course...')
+                course = item.data(0, QtCore.Qt.UserRole)
+                self.statusBar().showMessage(self.tr('Loading all modules for course...'))
+                self.populateModules(item, *moodle_async.get_modules_for_course(course.id))
+            item.setExpanded(True)
 
     def showSiteDialog(self):
         self.statusBar().showMessage(self.tr('Logging in to Moodle site...'))
@@ -121,44 +134,37 @@ class Moodle2PdfWindow(QtWidgets.QMainWindow):
                 QtWidgets.QMessageBox.warning(self, self.tr('Error'), self.tr('Wrong site URL or credentials.'), QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Ok)
             self.statusBar().showMessage(self.tr('Logged in.'))
 
-    def populateGlossaries(self, item, course_id):
-        self.statusBar().showMessage(self.tr('Loading all glossaries for course...'))
-        glossaries = moodle.get_glossaries_from_course(course_id)
+    def populateModules(self, item, glossaries, wikis, databases):
+        self.populateGlossaries(item, glossaries)
+        self.populateWikis(item, wikis)
+        self.populateDatabases(item, databases)
+
+    def populateGlossaries(self, item, glossaries):
         for g in glossaries:
             glossaryNode = QtWidgets.QTreeWidgetItem(item)
-            glossaryNode.setText(0, g[1])
+            glossaryNode.setText(0, g.name)
             glossaryNode.setData(0, QtCore.Qt.UserRole, g)
             glossaryNode.setCheckState(0, QtCore.Qt.Unchecked)
             glossaryNode.moodleType = 'glossary'
             glossaryNode.setIcon(0, QtGui.QIcon(get_resource_path('res/glossar.svg')))
-        self.statusBar().showMessage(self.tr('All glossaries loaded.'))
-        item.setExpanded(True)
 
-    def populateWikis(self, item, course_id):
-        self.statusBar().showMessage(self.tr('Loading all wikis for course...'))
-        wikis = moodle.get_wikis_by_courses(course_id)
+    def populateWikis(self, item, wikis):
         for w in wikis:
             wikiNode = QtWidgets.QTreeWidgetItem(item)
-            wikiNode.setText(0, w[1])
+            wikiNode.setText(0, w.name)
             wikiNode.setData(0, QtCore.Qt.UserRole, w)
             wikiNode.setCheckState(0, QtCore.Qt.Unchecked)
             wikiNode.moodleType = 'wiki'
             wikiNode.setIcon(0, QtGui.QIcon(get_resource_path('res/wiki.svg')))
-        self.statusBar().showMessage(self.tr('All wikis loaded.'))
-        item.setExpanded(True)
 
-    def populateDatabases(self, item, course_id):
-        self.statusBar().showMessage(self.tr('Loading all databases for course...'))
-        databases = moodle.get_databases_by_courses(course_id)
+    def populateDatabases(self, item, databases):
         for d in databases:
             databaseNode = QtWidgets.QTreeWidgetItem(item)
-            databaseNode.setText(0, d[1])
+            databaseNode.setText(0, d.name)
             databaseNode.setData(0, QtCore.Qt.UserRole, d)
             databaseNode.setCheckState(0, QtCore.Qt.Unchecked)
             databaseNode.moodleType = 'database'
             databaseNode.setIcon(0, QtGui.QIcon(get_resource_path('res/database.svg')))
-        self.statusBar().showMessage(self.tr('All databases loaded.'))
-        item.setExpanded(True)
 
     def exportSelectedModules(self):
         selectedGlossaries = []
@@ -168,18 +174,18 @@ class Moodle2PdfWindow(QtWidgets.QMainWindow):
             if item.checkState(0) > 0:
                 moodleItem = item.data(0, QtCore.Qt.UserRole)
                 if item.moodleType == 'wiki':
-                    logger.debug('Wiki selected: {}'.format(moodleItem[1]))
+                    logger.debug('Wiki selected: {}'.format(moodleItem.name))
                     selectedWikis.append(moodleItem)
                 elif item.moodleType == 'glossary':
-                    logger.debug('Glossary selected: {}'.format(moodleItem[1]))
+                    logger.debug('Glossary selected: {}'.format(moodleItem.name))
                     selectedGlossaries.append(moodleItem)
                 elif item.moodleType == 'database':
-                    logger.debug('Database selected: {}'.format(moodleItem[1]))
+                    logger.debug('Database selected: {}'.format(moodleItem.name))
                     selectedDatabases.append(moodleItem)
         if selectedGlossaries or selectedWikis or selectedDatabases:
             if self.combineGlossariesCheckBox.checkState() > 0:
                 all_modules = selectedDatabases + selectedGlossaries + selectedWikis
-                default_output_file = CONFIG['pdf']['default_output_filename'] if len(all_modules) > 1 else '{}.pdf'.format(all_modules[0][1])
+                default_output_file = CONFIG['pdf']['default_output_filename'] if len(all_modules) > 1 else '{}.pdf'.format(all_modules[0].name)
                 options = QtWidgets.QFileDialog.Options()
                 # options |= QtWidgets.QFileDialog.DontUseNativeDialog
                 output_file, _ = QtWidgets.QFileDialog.getSaveFileName(self, self.tr('Save as PDF File...'),
@@ -188,17 +194,32 @@ class Moodle2PdfWindow(QtWidgets.QMainWindow):
                 if output_file:
                     self.progressBar.setValue(0)
                     self.statusBar().showMessage(self.tr('Building PDF file...'))
-                    build_pdf_for_glossaries_and_wikis(selectedGlossaries, selectedWikis, selectedDatabases, output_file,
-                                                       lambda no, overall: self.progressBar.setValue(int(100 / overall * no)))
+                    with profiling.profile(output_file, enabled=self.actionProfile.isChecked()):
+                        build_pdf_for_glossaries_and_wikis(
+                            selectedGlossaries, selectedWikis, selectedDatabases, output_file,
+                            lambda no, overall: self.progressBar.setValue(int(100 / overall * no)))
                     # open file with associated application (there is no really good solution,
                     # see https://stackoverflow.com/a/17317468 and https://stackoverflow.com/a/21987839)
                     webbrowser.open(output_file)
                     self.statusBar().showMessage(self.tr('Finished PDF file.'))
             else:
-                logger.error('Not implemented yet!')
-                QtWidgets.QMessageBox.warning(self, self.tr('Error'),
-                                              self.tr('Separate export is not implemented yet.'),
-                                              QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Ok)
+                output_directory = QtWidgets.QFileDialog.getExistingDirectory(
+                    self, self.tr('Select Directory for PDF Files...'), CONFIG['pdf']['output_directory'])
+                if output_directory:
+                    self.progressBar.setValue(0)
+                    self.statusBar().showMessage(self.tr('Building PDF files...'))
+                    manifest_file = os.path.join(output_directory, CONFIG['pdf']['manifest_filename'])
+                    with profiling.profile(manifest_file, enabled=self.actionProfile.isChecked()):
+                        manifest = export_modules_separately(
+                            selectedGlossaries, selectedWikis, selectedDatabases, output_directory,
+                            lambda no, overall: self.progressBar.setValue(int(100 / overall * no)))
+                    if manifest.failed:
+                        QtWidgets.QMessageBox.warning(self, self.tr('Error'),
+                                                      self.tr('Could not export these modules:\n{}').format(
+                                                          '\n'.join(job.module.name for job in manifest.failed)),
+                                                      QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Ok)
+                    webbrowser.open(output_directory)
+                    self.statusBar().showMessage(self.tr('Finished PDF files.'))
         else:
             QtWidgets.QMessageBox.warning(self, self.tr('Error'), self.tr('You have to select some modules first.'),
                                           QtWidgets.QMessageBox.Ok, QtWidgets.QMessageBox.Ok)
@@ -221,6 +242,8 @@ def create_logger():
 
 
 if __name__ == '__main__':
+    # render workers of frozen executables must not start the application again
+    multiprocessing.freeze_support()
     create_logger()
     app = QtWidgets.QApplication(sys.argv)
     translator = QtCore.QTranslator()
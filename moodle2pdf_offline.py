@@ -27,6 +27,8 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
 from reportlab.platypus.flowables import KeepTogether
 from reportlab.platypus.tableofcontents import TableOfContents
 
+import profiling
+
 
 logger = logging.getLogger('moodle2pdf')
 
@@ -109,6 +111,7 @@ def create_pdf_doc(glossar_files, output_file):
             # TODO: Set bookmark for question in PDF file.
         story.append(PageBreak())
     logger.info('Writing Moodle glossar to PDF file: {}.'.format(output_file))
+    profiling.checkpoint('before layout')
     doc.build(story, onFirstPage=create_page_margins, onLaterPages=create_page_margins)
 
 
@@ -132,18 +135,22 @@ def parse_arguments():
                        help='provide a list of files to convert')
     parser.add_argument('-c', '--combine', action='store_true',
                         help='combine all glossar data into one PDF file')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the conversion and write the reports next to the output PDF files')
     args = parser.parse_args()
     return args
 
 
-def make_pdf_from_glossar(filelist, combine_to_one_document=False):
+def make_pdf_from_glossar(filelist, combine_to_one_document=False, profile=False):
     if combine_to_one_document:
         output_file = DEFAULT_OUTPUT_FILENAME
-        create_pdf_doc(filelist, output_file)
+        with profiling.profile(output_file, enabled=profile):
+            create_pdf_doc(filelist, output_file)
     else:
         for f in filelist:
             output_file = '{}.pdf'.format(f)
-            create_pdf_doc((f, ), output_file)
+            with profiling.profile(output_file, enabled=profile):
+                create_pdf_doc((f, ), output_file)
 
 
 if __name__ == '__main__':
@@ -155,4 +162,4 @@ if __name__ == '__main__':
     elif args.files:
         filelist = args.files
         logger.info('Converting only these XML glossar files: {}.'.format(filelist))
-    make_pdf_from_glossar(filelist, combine_to_one_document=args.combine)
+    make_pdf_from_glossar(filelist, combine_to_one_document=args.combine, profile=args.profile)
@@ -0,0 +1,140 @@
+"""
+Concurrent client for the Moodle Web Service.
+
+All calls are executed by the same functions as in the module moodle, but
+several of them are sent at once. The blocking requests run in a thread pool
+and are driven by asyncio, so they share the pooled HTTP session from the
+module moodle. The number of calls in flight is bounded by the configuration
+value "max_concurrency" in the [http] section.
+
+Example:
+>>> call_mdl_functions([('mod_glossary_get_glossaries_by_courses', {'courseids': [2]}),
+                        ('mod_wiki_get_wikis_by_courses', {'courseids': [2]})])
+[{'glossaries': [...], 'warnings': []}, {'wikis': [...], 'warnings': []}]
+"""
+
+import asyncio
+import logging
+import functools
+import concurrent.futures
+
+import moodle
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.moodle_async')
+
+
+async def call_mdl_functions_async(calls, limit=None):
+    """
+    Calls all given Moodle API functions concurrently and returns their results
+    in the same order as the calls.
+
+    :param calls: iterable of tuples containing the name of the API function and
+                  a dictionary with its keyword arguments
+    :param limit: maximum number of calls in flight at the same time, defaults
+                  to the configured value
+    """
+    calls = list(calls)
+    if not calls:
+        return []
+    if limit is None:
+        limit = CONFIG['http']['max_concurrency']
+    limit = max(1, min(limit, len(calls)))
+    semaphore = asyncio.Semaphore(limit)
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limit) as executor:
+        async def run(fname, kwargs):
+            async with semaphore:
+                function = functools.partial(moodle.call_mdl_function, fname, **kwargs)
+                return await loop.run_in_executor(executor, function)
+        logger.debug('Calling {} API functions with up to {} at a time.'.format(len(calls), limit))
+        return await asyncio.gather(*(run(fname, kwargs) for fname, kwargs in calls))
+
+
+def call_mdl_functions(calls, limit=None):
+    """
+    Calls all given Moodle API functions concurrently and blocks until all
+    results are available. See call_mdl_functions_async() for the parameters.
+    """
+    return asyncio.run(call_mdl_functions_async(calls, limit))
+
+
+############################## Batch functions ##############################
+
+def get_modules_for_course(courseid):
+    """
+    Gets all glossaries, wikis and databases of a course in a single round-trip.
+    Returns a tuple of three lists in the same format as the functions
+    get_glossaries_from_course(), get_wikis_by_courses() and
+    get_databases_by_courses() from the module moodle.
+    """
+    return get_modules_for_courses([courseid])[courseid]
+
+
+def get_modules_for_courses(courseids):
+    """
+    Gets all glossaries, wikis and databases for any number of courses. The
+    course ids are sent in chunks, so only a few requests are necessary even
+    for all courses of a site. Returns a dictionary mapping each course id to
+    a tuple of three lists with its glossaries, wikis and databases.
+    """
+    courseids = list(courseids)
+    glossaries, wikis, databases = _call_for_courses(courseids, ('mod_glossary_get_glossaries_by_courses',
+                                                                 'mod_wiki_get_wikis_by_courses',
+                                                                 'mod_data_get_databases_by_courses'))
+    return {c: (moodle.parse_glossaries({'glossaries': glossaries[c]}), moodle.parse_wikis({'wikis': wikis[c]}),
+                moodle.parse_databases({'databases': databases[c]})) for c in courseids}
+
+
+def get_glossaries_from_courses(courseids):
+    """Returns a dictionary mapping each given course id to a list of its glossaries."""
+    courseids = list(courseids)
+    glossaries, = _call_for_courses(courseids, ('mod_glossary_get_glossaries_by_courses',))
+    return {c: moodle.parse_glossaries({'glossaries': glossaries[c]}) for c in courseids}
+
+
+def get_wikis_by_courses(courseids):
+    """Returns a dictionary mapping each given course id to a list of its wikis."""
+    courseids = list(courseids)
+    wikis, = _call_for_courses(courseids, ('mod_wiki_get_wikis_by_courses',))
+    return {c: moodle.parse_wikis({'wikis': wikis[c]}) for c in courseids}
+
+
+def get_databases_by_courses(courseids):
+    """Returns a dictionary mapping each given course id to a list of its databases."""
+    courseids = list(courseids)
+    databases, = _call_for_courses(courseids, ('mod_data_get_databases_by_courses',))
+    return {c: moodle.parse_databases({'databases': databases[c]}) for c in courseids}
+
+
+def get_subwiki_pages(wikiids):
+    """Returns a list of pages for each given wiki id."""
+    responses = call_mdl_functions(('mod_wiki_get_subwiki_pages', {'wikiid': w}) for w in wikiids)
+    return [moodle.parse_subwiki_pages(r) for r in responses]
+
+
+# keys of the module lists in the responses of the API functions for courses
+COURSE_FUNCTION_KEYS = {'mod_glossary_get_glossaries_by_courses': 'glossaries',
+                        'mod_wiki_get_wikis_by_courses': 'wikis',
+                        'mod_data_get_databases_by_courses': 'databases'}
+
+
+def _call_for_courses(courseids, fnames):
+    """
+    Calls each of the given API functions with chunks of the course ids and
+    returns for each function a dictionary mapping course ids to the list of
+    modules (as returned by Moodle) in that course.
+    """
+    chunk_size = CONFIG['moodle']['bulk_chunk_size']
+    chunks = [courseids[i:i + chunk_size] for i in range(0, len(courseids), chunk_size)]
+    responses = call_mdl_functions((fname, {'courseids': chunk}) for fname in fnames for chunk in chunks)
+    logger.debug('Loaded modules for {} courses with {} requests.'.format(len(courseids), len(responses)))
+    results = []
+    for i, fname in enumerate(fnames):
+        modules_by_course = {c: [] for c in courseids}
+        for response in responses[i * len(chunks):(i + 1) * len(chunks)]:
+            for m in response[COURSE_FUNCTION_KEYS[fname]]:
+                modules_by_course.setdefault(m['course'], []).append(m)
+        results.append(modules_by_course)
+    return results
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the Moodle Web Service, so that exports can be measured
+and tested without a real Moodle site.
+
+The server implements the REST endpoint (webservice/rest/server.php), the
+token endpoint (login/token.php) and the download of images from
+pluginfile.php for all API functions called by this project. It serves either
+synthetic courses of configurable size or responses recorded from a real
+site. Latency and errors can be injected to simulate a slow or overloaded
+server.
+
+Serve synthetic courses:
+
+    ./moodle_standin.py --courses 2 --entries 500 --images 2 --latency 50
+
+Record all requests sent to the stand-in from a real site, then replay them:
+
+    ./moodle_standin.py --record https://moodle.example.org/ --token TOKEN --fixtures fixtures
+    ./moodle_standin.py --fixtures fixtures
+
+Then use "http://127.0.0.1:8080/" as site with any username and password.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import urllib.parse
+import http.server
+
+import PIL.Image
+import requests
+
+
+logger = logging.getLogger('moodle2pdf.standin')
+
+REST_ENDPOINT = '/webservice/rest/server.php'
+TOKEN_ENDPOINT = '/login/token.php'
+PLUGINFILE_REGEX = re.compile(r'^/(webservice/)?pluginfile\.php/')
+# token returned for every username and password
+STANDIN_TOKEN = 'standin-token'
+# modification time of all synthetic data
+TIMEMODIFIED = 1600000000
+
+WORDS = ('Moodle', 'Glossar', 'Eintrag', 'Begriff', 'Definition', 'Beispiel', 'Übung', 'Schüler', 'Lehrkraft',
+         'Netzwerk', 'Datenbank', 'Protokoll', 'Adresse', 'Speicher', 'Größe', 'Verbindung', 'Rechner', 'und',
+         'oder', 'mit', 'für', 'die', 'der', 'das', 'ist', 'wird', 'werden', 'nicht')
+
+
+class MoodleError(Exception):
+    """Error returned to the client in the same format as Moodle does."""
+    def __init__(self, errorcode, message, exception='moodle_exception'):
+        super().__init__(message)
+        self.errorcode = errorcode
+        self.message = message
+        self.exception = exception
+
+    def to_response(self):
+        return {'exception': self.exception, 'errorcode': self.errorcode, 'message': self.message}
+
+
+############################## Synthetic site ##############################
+
+class SyntheticSite:
+    """
+    Site with generated courses. Every course contains the given number of
+    glossaries, wikis and databases, each with the given number of entries.
+    All data is derived from the ids, so the same options always give the same
+    responses and only the module lists are held in memory.
+
+    Ids of modules contain the id of their course (course 2 has glossaries
+    2001, 2002, ...) and ids of entries contain the id of their module.
+    """
+    # offsets for ids of modules in a course and for course module ids
+    MODULE_TYPES = {'glossary': 0, 'wiki': 300, 'data': 600}
+
+    def __init__(self, courses=2, glossaries=1, wikis=1, databases=1, entries=50, images=1, complexity=3,
+                 image_size=(800, 600)):
+        """
+        Creates a new synthetic site.
+
+        :param courses: number of courses
+        :param glossaries: number of glossaries per course
+        :param wikis: number of wikis per course
+        :param databases: number of databases per course
+        :param entries: number of entries or pages per module
+        :param images: number of images per entry
+        :param complexity: number of HTML blocks (paragraphs, lists, tables) per entry
+        :param image_size: width and height of all images in pixel
+        """
+        self.course_ids = list(range(2, courses + 2))
+        self.module_counts = {'glossary': glossaries, 'wiki': wikis, 'data': databases}
+        self.entries = entries
+        self.images = images
+        self.complexity = complexity
+        self.image_size = image_size
+        self.image_cache = {}
+        self.image_lock = threading.Lock()
+
+    def call(self, fname, parameters, base_url):
+        """Returns the response of an API function as Python object."""
+        function = getattr(self, fname, None)
+        if function is None or fname.startswith('_') or fname not in API_FUNCTIONS:
+            raise MoodleError('invalidrecord', 'Can\'t find data record in database table external_functions.',
+                              'dml_missing_record_exception')
+        return function(base_url=base_url, **parameters)
+
+    def get_file(self, path, base_url):
+        """Returns content type and content of a file from pluginfile.php."""
+        if not path.endswith('.png'):
+            raise MoodleError('filenotfound', 'File not found')
+        # every image has a different color, so that no two images have the same content
+        color = tuple(hashlib.md5(path.encode('utf-8')).digest()[:3])
+        with self.image_lock:
+            if color not in self.image_cache:
+                buffer = io.BytesIO()
+                PIL.Image.new('RGB', self.image_size, color).save(buffer, 'PNG')
+                self.image_cache[color] = buffer.getvalue()
+            return 'image/png', self.image_cache[color]
+
+    ##### Helper functions #####
+
+    def _get_module_ids(self, modname, courseid):
+        offset = self.MODULE_TYPES[modname]
+        return [courseid * 1000 + offset + i for i in range(1, self.module_counts[modname] + 1)]
+
+    def _check_module(self, modname, module_id):
+        module_id = int(module_id)
+        courseid, index = divmod(module_id, 1000)
+        index -= self.MODULE_TYPES[modname]
+        if courseid not in self.course_ids or not 1 <= index <= self.module_counts[modname]:
+            raise MoodleError('invalidrecord', 'Can\'t find data record in database table {}.'.format(modname),
+                              'dml_missing_record_exception')
+        return module_id
+
+    def _check_entry(self, modname, entry_id):
+        module_id, index = divmod(int(entry_id), 100000)
+        self._check_module(modname, module_id)
+        if not 0 <= index < self.entries:
+            raise MoodleError('invalidrecord', 'Can\'t find data record in database table.',
+                              'dml_missing_record_exception')
+        return module_id, index
+
+    def _get_courses(self, courseids):
+        courseids = [int(c) for c in (courseids.values() if isinstance(courseids, dict) else courseids)]
+        return [c for c in courseids if c in self.course_ids]
+
+    def _get_text(self, seed, words):
+        rng = random.Random(seed)
+        return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+    def _get_html(self, seed, base_url, component, with_images=True):
+        """Returns HTML content with paragraphs, lists, tables and images like edited in Moodle."""
+        blocks = []
+        for i in range(self.complexity):
+            text = self._get_text(seed * 31 + i, 40)
+            if i % 3 == 0:
+                blocks.append('<p>{} <b>{}</b> {}</p>'.format(text[:80], text[80:120], text[120:]))
+            elif i % 3 == 1:
+                blocks.append('<ul>{}</ul>'.format(''.join('<li>{}</li>'.format(w) for w in text.split()[:5])))
+            else:
+                rows = ''.join('<tr><td>{}</td><td>{}</td></tr>'.format(a, b)
+                               for a, b in zip(text.split()[:4], text.split()[4:8]))
+                blocks.append('<table border="1">{}</table>'.format(rows))
+        for i in range(self.images if with_images else 0):
+            blocks.append('<p><img src="{}pluginfile.php/{}/{}/{}/bild{}.png" alt="Bild {}" width="{}" '
+                          'height="{}"></p>'.format(base_url, seed // 100000, component, seed, i, i,
+                                                    self.image_size[0], self.image_size[1]))
+        return ''.join(blocks)
+
+    ##### API functions #####
+
+    def core_webservice_get_site_info(self, base_url):
+        return {'sitename': 'Moodle Stand-in', 'username': 'standin', 'firstname': 'Moodle', 'lastname': 'Stand-in',
+                'fullname': 'Moodle Stand-in', 'lang': 'de', 'userid': 2, 'siteurl': base_url.rstrip('/'),
+                'functions': [{'name': f, 'version': '2020061500'} for f in API_FUNCTIONS], 'release': '3.9'}
+
+    def core_enrol_get_users_courses(self, base_url, userid):
+        return [{'id': c, 'shortname': 'kurs{}'.format(c), 'fullname': 'Kurs {}'.format(c), 'visible': 1,
+                 'format': 'topics'} for c in self.course_ids]
+
+    def core_course_get_contents(self, base_url, courseid):
+        courseid = self._get_courses([courseid])
+        if not courseid:
+            raise MoodleError('invalidrecord', 'Can\'t find data record in database table course.',
+                              'dml_missing_record_exception')
+        sections = []
+        for section, modname in enumerate(self.MODULE_TYPES, start=1):
+            modules = []
+            for module_id in self._get_module_ids(modname, courseid[0]):
+                modules.append({'id': module_id * 10, 'instance': module_id, 'name': '{} {}'.format(modname, module_id),
+                                'modname': modname, 'visible': 1, 'uservisible': True, 'visibleoncoursepage': 1,
+                                'modicon': '{}theme/image.php/boost/{}/1/icon'.format(base_url, modname),
+                                'url': '{}mod/{}/view.php?id={}'.format(base_url, modname, module_id * 10)})
+            sections.append({'id': courseid[0] * 10 + section, 'name': 'Abschnitt {}'.format(section), 'visible': 1,
+                             'section': section, 'modules': modules})
+        return sections
+
+    def core_course_edit_module(self, base_url, action, id):
+        return ''
+
+    def mod_glossary_get_glossaries_by_courses(self, base_url, courseids=()):
+        glossaries = [{'id': g, 'course': c, 'coursemodule': g * 10, 'name': 'Glossar {}'.format(g), 'intro': '',
+                       'timemodified': TIMEMODIFIED} for c in self._get_courses(courseids)
+                      for g in self._get_module_ids('glossary', c)]
+        return {'glossaries': glossaries, 'warnings': []}
+
+    def _get_glossary_entry(self, glossary_id, index, base_url):
+        entry_id = glossary_id * 100000 + index
+        return {'id': entry_id, 'glossaryid': glossary_id, 'userid': 2, 'concept': 'Begriff {:05d}'.format(index),
+                'definition': self._get_html(entry_id, base_url, 'mod_glossary/entry'), 'definitionformat': 1,
+                'timecreated': TIMEMODIFIED, 'timemodified': TIMEMODIFIED + index, 'approved': 1, 'attachment': False}
+
+    def mod_glossary_get_entries_by_letter(self, base_url, id, letter='ALL', options=None, limit=20, **kwargs):
+        glossary_id = self._check_module('glossary', id)
+        start, limit = int(kwargs.get('from', 0)), int(limit)
+        entries = [self._get_glossary_entry(glossary_id, i, base_url)
+                   for i in range(start, min(self.entries, start + limit))]
+        return {'count': self.entries, 'entries': entries, 'ratinginfo': {}, 'warnings': []}
+
+    def mod_glossary_get_entries_by_date(self, base_url, id, order='UPDATE', sort='DESC', options=None, limit=20,
+                                         **kwargs):
+        glossary_id = self._check_module('glossary', id)
+        start, limit = int(kwargs.get('from', 0)), int(limit)
+        indices = range(self.entries - 1, -1, -1) if sort == 'DESC' else range(self.entries)
+        entries = [self._get_glossary_entry(glossary_id, i, base_url) for i in indices[start:start + limit]]
+        return {'count': self.entries, 'entries': entries, 'ratinginfo': {}, 'warnings': []}
+
+    def mod_wiki_get_wikis_by_courses(self, base_url, courseids=()):
+        wikis = [{'id': w, 'course': c, 'coursemodule': w * 10, 'name': 'Wiki {}'.format(w), 'intro': '',
+                  'firstpagetitle': 'Startseite', 'wikimode': 'collaborative', 'defaultformat': 'html', 'visible': 1,
+                  'timemodified': TIMEMODIFIED} for c in self._get_courses(courseids)
+                 for w in self._get_module_ids('wiki', c)]
+        return {'wikis': wikis, 'warnings': []}
+
+    def mod_wiki_get_subwikis(self, base_url, wikiid):
+        wiki_id = self._check_module('wiki', wikiid)
+        return {'subwikis': [{'id': wiki_id, 'wikiid': wiki_id, 'groupid': 0, 'userid': 0, 'canedit': True}],
+                'warnings': []}
+
+    def _get_wiki_page(self, wiki_id, index, base_url, includecontent=True):
+        page_id = wiki_id * 100000 + index
+        page = {'id': page_id, 'subwikiid': wiki_id, 'title': 'Seite {:05d}'.format(index),
+                'timecreated': TIMEMODIFIED, 'timemodified': TIMEMODIFIED + index, 'timerendered': TIMEMODIFIED,
+                'userid': 2, 'pageviews': 0, 'readonly': 0, 'caneditpage': True, 'firstpage': index == 0}
+        if includecontent:
+            page['cachedcontent'] = self._get_html(page_id, base_url, 'mod_wiki/attachments')
+            page['contentformat'] = 1
+        return page
+
+    def mod_wiki_get_subwiki_pages(self, base_url, wikiid, options=None, **kwargs):
+        wiki_id = self._check_module('wiki', wikiid)
+        includecontent = str((options or {}).get('includecontent', 1)) != '0'
+        return {'pages': [self._get_wiki_page(wiki_id, i, base_url, includecontent) for i in range(self.entries)],
+                'warnings': []}
+
+    def mod_wiki_get_page_contents(self, base_url, pageid):
+        wiki_id, index = self._check_entry('wiki', pageid)
+        page = self._get_wiki_page(wiki_id, index, base_url)
+        return {'page': {'id': page['id'], 'wikiid': wiki_id, 'subwikiid': wiki_id, 'groupid': 0, 'userid': 0,
+                         'title': page['title'], 'cachedcontent': page['cachedcontent'], 'contentformat': 1,
+                         'caneditpage': True, 'version': 1}, 'warnings': []}
+
+    def mod_data_get_databases_by_courses(self, base_url, courseids=()):
+        databases = [{'id': d, 'course': c, 'coursemodule': d * 10, 'name': 'Datenbank {}'.format(d), 'intro': '',
+                      'singletemplate': '', 'listtemplate': '', 'timemodified': TIMEMODIFIED}
+                     for c in self._get_courses(courseids) for d in self._get_module_ids('data', c)]
+        return {'databases': databases, 'warnings': []}
+
+    def mod_data_get_fields(self, base_url, databaseid):
+        database_id = self._check_module('data', databaseid)
+        fields = [('text', 'Name'), ('textarea', 'Beschreibung'), ('picture', 'Bild')]
+        return {'fields': [{'id': database_id * 10 + i, 'dataid': database_id, 'type': t, 'name': n,
+                            'description': ''} for i, (t, n) in enumerate(fields)], 'warnings': []}
+
+    def _get_database_entry(self, database_id, index, base_url, returncontents=True):
+        entry_id = database_id * 100000 + index
+        entry = {'id': entry_id, 'userid': 2, 'groupid': 0, 'dataid': database_id, 'timecreated': TIMEMODIFIED,
+                 'timemodified': TIMEMODIFIED + index, 'approved': True, 'canmanageentry': True}
+        if returncontents:
+            image = 'bild{}.png'.format(entry_id)
+            entry['contents'] = [
+                {'fieldid': database_id * 10, 'recordid': entry_id, 'content': 'Eintrag {:05d}'.format(index),
+                 'files': []},
+                {'fieldid': database_id * 10 + 1, 'recordid': entry_id,
+                 'content': self._get_html(entry_id, base_url, 'mod_data/content', with_images=False), 'files': []},
+                {'fieldid': database_id * 10 + 2, 'recordid': entry_id, 'content': image,
+                 'files': [{'filename': image, 'filepath': '/', 'filesize': 0, 'mimetype': 'image/png',
+                            'fileurl': '{}webservice/pluginfile.php/{}/mod_data/content/{}/{}'.format(
+                                base_url, database_id, entry_id, image)}]}]
+        return entry
+
+    def mod_data_get_entries(self, base_url, databaseid, returncontents='0', page=0, perpage=0, **kwargs):
+        database_id = self._check_module('data', databaseid)
+        page, perpage = int(page), int(perpage) or self.entries
+        returncontents = str(returncontents) not in ('0', 'false', '')
+        indices = range(page * perpage, min(self.entries, (page + 1) * perpage))
+        return {'entries': [self._get_database_entry(database_id, i, base_url, returncontents) for i in indices],
+                'totalcount': self.entries, 'totalfilesize': 0, 'warnings': []}
+
+    def mod_data_get_entry(self, base_url, entryid, returncontents='0'):
+        database_id, index = self._check_entry('data', entryid)
+        returncontents = str(returncontents) not in ('0', 'false', '')
+        return {'entry': self._get_database_entry(database_id, index, base_url, returncontents),
+                'ratinginfo': {}, 'warnings': []}
+
+
+# API functions implemented by the synthetic site
+API_FUNCTIONS = ('core_webservice_get_site_info', 'core_enrol_get_users_courses', 'core_course_get_contents',
+                 'core_course_edit_module', 'mod_glossary_get_glossaries_by_courses',
+                 'mod_glossary_get_entries_by_letter', 'mod_glossary_get_entries_by_date',
+                 'mod_wiki_get_wikis_by_courses', 'mod_wiki_get_subwikis', 'mod_wiki_get_subwiki_pages',
+                 'mod_wiki_get_page_contents', 'mod_data_get_databases_by_courses', 'mod_data_get_fields',
+                 'mod_data_get_entries', 'mod_data_get_entry')
+
+
+############################## Recorded site ##############################
+
+class FixtureSite:
+    """
+    Site replaying responses recorded from a real Moodle site. Each response
+    is stored in a JSON file named after the API function and a hash of its
+    parameters. URLs of the recorded site are replaced with the URL of the
+    stand-in, so images are loaded from the stand-in as well.
+
+    If a URL and token are given, all requests missing in the fixtures are
+    forwarded to the real site and their responses are recorded.
+    """
+    def __init__(self, directory, record_url=None, token=None):
+        self.directory = directory
+        self.record_url = record_url
+        self.token = token
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'files'), exist_ok=True)
+        site_file = os.path.join(directory, 'site.json')
+        if record_url:
+            with open(site_file, 'w', encoding='utf-8') as f:
+                json.dump({'url': record_url}, f)
+        if not os.path.exists(site_file):
+            raise FileNotFoundError('No recorded fixtures found in {}.'.format(directory))
+        with open(site_file, encoding='utf-8') as f:
+            self.site_url = json.load(f)['url']
+
+    def call(self, fname, parameters, base_url):
+        fixture_file = os.path.join(self.directory, '{}_{}.json'.format(fname, self._hash(parameters)))
+        if not os.path.exists(fixture_file):
+            if not self.record_url:
+                raise MoodleError('fixturemissing', 'No recorded response for {}.'.format(fname))
+            parameters = dict(flatten_parameters(parameters), wstoken=self.token, moodlewsrestformat='json',
+                              wsfunction=fname)
+            url = urllib.parse.urljoin(self.record_url, REST_ENDPOINT.lstrip('/'))
+            response = requests.post(url, data=parameters, timeout=60)
+            response.raise_for_status()
+            logger.info('Recorded response for {}.'.format(fname))
+            self._write(fixture_file, response.content)
+        with open(fixture_file, encoding='utf-8') as f:
+            return json.loads(f.read().replace(self.site_url, base_url))
+
+    def get_file(self, path, base_url):
+        file_name = os.path.join(self.directory, 'files', self._hash(path))
+        if not os.path.exists(file_name):
+            if not self.record_url:
+                raise MoodleError('filenotfound', 'File not found')
+            url = urllib.parse.urljoin(self.record_url, path.lstrip('/'))
+            response = requests.post(url, data={'token': self.token}, timeout=60)
+            if response.status_code == 404:
+                raise MoodleError('filenotfound', 'File not found')
+            response.raise_for_status()
+            logger.info('Recorded file {}.'.format(path))
+            self._write(file_name, response.content)
+            self._write(file_name + '.type', response.headers.get('Content-Type', '').encode('utf-8'))
+        with open(file_name, 'rb') as f:
+            content = f.read()
+        with open(file_name + '.type', encoding='utf-8') as f:
+            content_type = f.read()
+        return content_type, content
+
+    def _write(self, file_name, content):
+        with self.lock:
+            with open(file_name + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(file_name + '.tmp', file_name)
+
+    @staticmethod
+    def _hash(parameters):
+        return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+############################## HTTP server ##############################
+
+def unflatten_parameters(flat):
+    """
+    Reverses rest_api_parameters() from the module moodle and transforms keys
+    like "courseids[0]" into nested lists and dictionaries.
+    """
+    result = {}
+    for key, value in flat.items():
+        parts = re.findall(r'[^\[\]]+', key)
+        node = result
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+    def to_lists(node):
+        if not isinstance(node, dict):
+            return node
+        if node and all(k.isdigit() for k in node):
+            return [to_lists(node[k]) for k in sorted(node, key=int)]
+        return {k: to_lists(v) for k, v in node.items()}
+    return to_lists(result)
+
+
+def flatten_parameters(parameters, prefix=''):
+    """Reverses unflatten_parameters() for forwarding requests to a real site."""
+    if isinstance(parameters, list):
+        parameters = {str(i): v for i, v in enumerate(parameters)}
+    if not isinstance(parameters, dict):
+        return {prefix: parameters}
+    result = {}
+    for key, value in parameters.items():
+        result.update(flatten_parameters(value, '{}[{}]'.format(prefix, key) if prefix else key))
+    return result
+
+
+class StandinRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        parameters.update(urllib.parse.parse_qsl(body))
+        server = self.server
+        if server.latency:
+            time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_body(server.error_status, 'text/plain', b'Injected error', {'Retry-After': '1'})
+            return
+        base_url = 'http://{}/'.format(self.headers.get('Host', '{}:{}'.format(*server.server_address)))
+        try:
+            if url.path == TOKEN_ENDPOINT:
+                self.send_json({'token': STANDIN_TOKEN, 'privatetoken': None})
+            elif url.path == REST_ENDPOINT:
+                fname = parameters.pop('wsfunction', '')
+                parameters.pop('wstoken', None)
+                parameters.pop('moodlewsrestformat', None)
+                self.send_json(server.site.call(fname, unflatten_parameters(parameters), base_url))
+            elif PLUGINFILE_REGEX.match(url.path):
+                self.send_file(url.path, base_url)
+            else:
+                self.send_body(404, 'text/plain', b'Not found')
+        except MoodleError as e:
+            if url.path == REST_ENDPOINT:
+                self.send_json(e.to_response())
+            else:
+                self.send_body(404, 'text/plain', e.message.encode('utf-8'))
+        except (TypeError, ValueError) as e:
+            self.send_json(MoodleError('invalidparameter', 'Invalid parameter value detected ({})'.format(e),
+                                       'invalid_parameter_exception').to_response())
+
+    def send_json(self, response):
+        self.send_body(200, 'application/json; charset=utf-8',
+                       json.dumps(response, ensure_ascii=False).encode('utf-8'))
+
+    def send_file(self, path, base_url):
+        content_type, content = self.server.site.get_file(path, base_url)
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        headers = {'ETag': etag, 'Last-Modified': self.date_time_string(TIMEMODIFIED),
+                   'Cache-Control': 'private, max-age=0'}
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, None, b'', headers)
+        else:
+            self.send_body(200, content_type, content, headers)
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('{} - {}'.format(self.address_string(), format % args))
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503):
+        """
+        Creates a new server for a stand-in site.
+
+        :param site: site answering all requests (SyntheticSite or FixtureSite)
+        :param host: address to listen on
+        :param port: port to listen on, 0 selects a free port
+        :param latency: mean delay for every request in seconds
+        :param jitter: standard deviation of the delay in seconds
+        :param error_rate: fraction of requests answered with an error
+        :param error_status: HTTP status code of injected errors
+        """
+        super().__init__((host, port), StandinRequestHandler)
+        self.site = site
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def handle_error(self, request, client_address):
+        # clients close pooled connections at any time, e.g. after aborting a download
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            logger.debug('Connection closed by {}.'.format(client_address[0]))
+        else:
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://{}:{}/'.format(*self.server_address[:2])
+
+
+def start_server(site, **kwargs):
+    """
+    Starts a stand-in server in a background thread and returns it. The URL of
+    the site is available as attribute "url", call shutdown() to stop it.
+    """
+    server = StandinServer(site, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, name='moodle-standin', daemon=True)
+    thread.start()
+    logger.info('Moodle stand-in listening on {}'.format(server.url))
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Moodle Web Service.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean delay per request in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the delay in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing (0.0 - 1.0)')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status code of failing requests')
+    group = parser.add_argument_group('synthetic site')
+    group.add_argument('--courses', type=int, default=2, help='number of courses')
+    group.add_argument('--glossaries', type=int, default=1, help='number of glossaries per course')
+    group.add_argument('--wikis', type=int, default=1, help='number of wikis per course')
+    group.add_argument('--databases', type=int, default=1, help='number of databases per course')
+    group.add_argument('--entries', type=int, default=50, help='number of entries per module')
+    group.add_argument('--images', type=int, default=1, help='number of images per entry')
+    group.add_argument('--complexity', type=int, default=3, help='number of HTML blocks per entry')
+    group.add_argument('--image-size', default='800x600', help='size of images in pixel (WIDTHxHEIGHT)')
+    group = parser.add_argument_group('recorded site')
+    group.add_argument('--fixtures', help='directory with recorded responses, replaces the synthetic site')
+    group.add_argument('--record', metavar='URL', help='record missing responses from this Moodle site')
+    group.add_argument('--token', help='token for the Moodle site to record from')
+    args = parser.parse_args()
+    if args.record and not (args.fixtures and args.token):
+        parser.error('--record requires --fixtures and --token')
+    return args
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    args = parse_arguments()
+    if args.fixtures:
+        site = FixtureSite(args.fixtures, args.record, args.token)
+    else:
+        width, height = (int(s) for s in args.image_size.lower().split('x'))
+        site = SyntheticSite(args.courses, args.glossaries, args.wikis, args.databases, args.entries, args.images,
+                             args.complexity, (width, height))
+    server = StandinServer(site, args.host, args.port, args.latency / 1000, args.jitter / 1000, args.error_rate,
+                           args.error_status)
+    logger.info('Moodle stand-in listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
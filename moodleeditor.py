@@ -62,8 +62,8 @@ class MoodleEditor(QtWidgets.QMainWindow):
             self.showSiteDialog()
         elif item.parent() == self.siteNode:
             logger.info('Loading activities and material for chosen course...')
-            id, _ = item.data(0, QtCore.Qt.UserRole)
-            self.populateActivities(item, id)
+            course = item.data(0, QtCore.Qt.UserRole)
+            self.populateActivities(item, course.id)
 
     def handleChange(self, changedItem, column):
         if self.userCanChoose and column == 1:
@@ -75,7 +75,7 @@ class MoodleEditor(QtWidgets.QMainWindow):
                 for i in range(childCount):
                     child = changedItem.child(i)
                     moodleItem = child.data(0, QtCore.Qt.UserRole)
-                    id = moodleItem[2]
+                    id = moodleItem.id
                     checked = changedItem.checkState(1)
                     # TODO: Handle return value of changeVisibilityForModule().
                     self.changeVisibilityForModule(id, checked)
@@ -86,7 +86,7 @@ class MoodleEditor(QtWidgets.QMainWindow):
                     self.progressBar.setValue(100 / childCount * (i + 1))
             else:
                 self.statusBar().showMessage(self.tr('Changing visibility for module...'))
-                id = dataForChangedItem[2]
+                id = dataForChangedItem.id
                 checked = changedItem.checkState(1)
                 self.changeVisibilityForModule(id, checked)
             self.statusBar().showMessage(self.tr('Visibility changed.'))
@@ -139,7 +139,7 @@ class MoodleEditor(QtWidgets.QMainWindow):
         self.progressBar.setValue(0)
         for i, c in enumerate(courses):
             courseNode = QtWidgets.QTreeWidgetItem(self.siteNode)
-            courseNode.setText(0, c[1])
+            courseNode.setText(0, c.name)
             courseNode.setData(0, QtCore.Qt.UserRole, c)
             # courseNode.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
             courseNode.setIcon(0, QtGui.QIcon(get_resource_path('res/course.svg')))
@@ -165,13 +165,13 @@ class MoodleEditor(QtWidgets.QMainWindow):
         activities = moodle.get_content_for_course(course_id)
         self.progressBar.setValue(0)
         for i, a in enumerate(activities):
-            activitiesNode = QtWidgets.QTreeWidgetItem(self.findSectionItem(topItem, a[0], a[1]))
-            activitiesNode.setText(0, '{} ({})'.format(a[3], a[4]))
-            activitiesNode.setIcon(0, QtGui.QIcon(self.getIcon(a[8])))
+            activitiesNode = QtWidgets.QTreeWidgetItem(self.findSectionItem(topItem, a.section_id, a.section_name))
+            activitiesNode.setText(0, '{} ({})'.format(a.name, a.modname))
+            activitiesNode.setIcon(0, QtGui.QIcon(self.getIcon(a.modicon)))
             activitiesNode.setData(0, QtCore.Qt.UserRole, a)
-            if a[5] == 1:
+            if a.visible == 1:
                 activitiesNode.setCheckState(1, QtCore.Qt.Checked)
-            elif a[5] == 0:
+            elif a.visible == 0:
                 activitiesNode.setCheckState(1, QtCore.Qt.Unchecked)
             self.progressBar.setValue(int(100 / len(activities) * (i + 1)))
         topItem.setExpanded(True)
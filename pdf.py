@@ -1,197 +1,798 @@
 
+import os
+import time
 import logging
 import tempfile
-from itertools import chain
+import contextlib
+import logging.handlers
+import multiprocessing
+import concurrent.futures
 
-from bs4 import BeautifulSoup
 from xhtml2pdf import document
-from reportlab.platypus import SimpleDocTemplate, PageBreak, Image, HRFlowable
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import SimpleDocTemplate, PageBreak, Image, Spacer
 
+import images
+import htmlfilter
+import config
+import metrics
+import pdfmerge
+import profiling
+import export_jobs
+import story_cache
+import fragment_cache
+import export_state
 import moodle
-from config import CONFIG, BORDER_HORIZONTAL, BORDER_VERTICAL, PAGE_WIDTH
+import moodle_async
+from config import CONFIG, BORDER_HORIZONTAL, BORDER_VERTICAL, PAGE_WIDTH, PAGE_HEIGHT
 
 
 logger = logging.getLogger('moodle2pdf.pdf')
 
+MAX_IMAGE_WIDTH = PAGE_WIDTH - 2 * BORDER_HORIZONTAL
+MAX_IMAGE_HEIGHT = PAGE_HEIGHT - 4 * BORDER_VERTICAL
+
+# divider between entries (see https://stackoverflow.com/a/36112136)
+DIVIDER = '<hr width="40%" size="2" color="darkgray" style="margin: 1pt 0">'
+# height of the spacers marking the start of a fragment in a batch, no other spacer has this height
+MARKER_HEIGHT = 0.0123
+FRAGMENT_MARKER = '<pdf:spacer height="{}"></pdf:spacer>'.format(MARKER_HEIGHT)
+# number of flowables taken from the modules ahead of the layout in streaming mode
+STREAMING_LOOKAHEAD = 100
+
 
 def create_page_margins(canvas, doc):
     canvas.saveState()
     canvas.setFont('Helvetica', 10)
-    canvas.drawString(BORDER_HORIZONTAL, BORDER_VERTICAL, CONFIG['pdf']['title'])
+    canvas.drawString(BORDER_HORIZONTAL, BORDER_VERTICAL, doc.title)
     canvas.drawRightString(PAGE_WIDTH - BORDER_HORIZONTAL,
                            BORDER_VERTICAL, "Seite {}".format(doc.page))
     canvas.restoreState()
 
 
-def filter_html(bs):
-    REMOVE_ATTRIBUTES = ['alt', 'rel', 'target', 'class', 'style']
-    for tag in chain(bs.findAll('img'), bs.findAll('a'), bs.findAll('span')):
-        tag.attrs = {key: value for key, value in tag.attrs.items()
-                     if key not in REMOVE_ATTRIBUTES}
-
-
-def extract_images(bs, directory):
-    SCALING_FACTOR = 0.5
-    image_list = []
-    for tag in bs.findAll('img'):
-        # get source link for images in entry
-        image_file = moodle.download_image(tag['src'], directory)
-        tag['src'] = image_file
-        width = int(float(tag['width']) * SCALING_FACTOR)
-        tag['width'] = str(width)
-        height = int(float(tag['height']) * SCALING_FACTOR)
-        tag['height'] = str(height)
-        # tag['valign'] = 'super', 'baseline', 'sub', 'super', 'top', 'text-top', 'middle', 'bottom', 'text-bottom', '0%', '2in'
-        # tag.parent['spaceAfter'] = '2cm'
-        tag.decompose()
-        i = Image(image_file, width=width, height=height)
-        i.vAlign = 'TOP'
-        image_list.append(i)
-    return image_list
-
-
-def filter_for_xhtml2pdf(bs, directory):
-    for tag in bs.findAll('img'):
-        # get source link for images in entry
-        image_file = moodle.download_image(tag['src'], directory)
-        tag['src'] = image_file
-    for tag in bs.findAll('br'):
-        # remove all seperate line breaks and trust that all paragraphs are formatted with the <p> tag
-        tag.decompose()
-    for tag in bs.find_all(type=True):
-        # change all types in lists and enumerations to 'circle'
-        tag['type'] = 'circle'
-
-
-def substitute_lists(bs):
-    for list_tag in bs.findAll('ul'):
-        for tag in list_tag.findAll('li'):
-            bullet = bs.new_tag('p', bulletFontName='Symbol')
-            bullet.append(tag.text)
-            tag.clear()
-            tag.insert(0, bullet)
-            tag.append('<br>')
-            tag.name = 'p'
-        print(list_tag)
-
-
-def build_pdf_for_glossary(glossary_id, glossary_name, temp_dir):
-    #
-    # Some string include Unicode byte order marker ('\ufeff') to get the PDF
-    # library to interpret them correctly. Without those markers non-ASCII
-    # characters like German umlauts are not displyed correctly in the created
-    # PDF file.
-    #
-    part = []
+def parse_size(value):
+    """Returns the numerical value of a size attribute or None for relative, invalid or non-positive sizes."""
+    try:
+        size = float(str(value).strip().lower().replace('px', ''))
+    except ValueError:
+        return None
+    return size if 0 < size < float('inf') else None
+
+
+def fit_image(image_file, width=None, height=None):
+    """
+    Calculates the size (in points) an image is displayed with, keeping its
+    aspect ratio and fitting it onto the page. Returns the file name of the
+    image normalized for that size and its width and height.
+    """
+    try:
+        image_width, image_height = ImageReader(image_file).getSize()
+    except Exception as e:
+        logger.warning('Could not read image {}: {}'.format(image_file, e))
+        return image_file, width, height
+    # an image with a width or height of zero is displayed with its own size
+    width = width if width and width > 0 else None
+    height = height if height and height > 0 else None
+    if width is None and height is None:
+        width, height = image_width, image_height
+    elif width is None:
+        width = height * image_width / image_height
+    elif height is None:
+        height = width * image_height / image_width
+    scale = min(1.0, MAX_IMAGE_WIDTH / width, MAX_IMAGE_HEIGHT / height)
+    width, height = width * scale, height * scale
+    return images.normalize_image(image_file, width, height), width, height
+
+
+def filter_for_xhtml2pdf(html):
+    """Returns the HTML of an entry or page normalized for xhtml2pdf (see module htmlfilter)."""
+    html_config = CONFIG['html']
+    normalizer = htmlfilter.Normalizer(replace_image, html_config['remove_attributes'],
+                                       html_config['substitute_lists'])
+    return normalizer.normalize(html)
+
+
+def replace_image(attributes):
+    if 'src' not in attributes:
+        return
+    # get source link for images in entry and replace it with the stored image file
+    image_file = images.resolve_image(attributes['src'])
+    # replace image with a variant in the resolution needed for its size in the document
+    image_file, width, height = fit_image(image_file, parse_size(attributes.get('width')),
+                                          parse_size(attributes.get('height')))
+    attributes['src'] = image_file
+    if width and height:
+        attributes['width'] = '{:.0f}'.format(width)
+        attributes['height'] = '{:.0f}'.format(height)
+
+
+def convert_html(html):
+    """Converts HTML into a list of flowables. Identical HTML is only converted once, if the story cache is enabled."""
+    cache = story_cache.get_story_cache()
+    if cache:
+        key = cache.make_key(html)
+        story = cache.get(key)
+        if story is not None:
+            metrics.count('pdf.story_cache_hits')
+            return story
+    with metrics.span('pdf.pisa'):
+        story = document.pisaStory(html).story
+    if cache:
+        cache.put(key, story)
+    return story
+
+
+class StoryBuilder:
+    """
+    Collects the HTML of headings and entries of a module and converts the
+    HTML of several entries at once, because every call of pisaStory() has to
+    set up a context and parse the default style sheet again.
+
+    Converted separately, every piece of HTML (a fragment) starts with a
+    spacer for the top margin of its first block, while the margins of blocks
+    in one document overlap. To keep the layout, each fragment in a batch
+    starts with a marker, which is replaced by the spacer after conversion.
+    """
+    def __init__(self, batch_size=None):
+        """
+        :param batch_size: number of entries converted at once, 0 converts every fragment separately (by default
+                           as configured by the option "batch_entries")
+        """
+        self.batch_size = CONFIG['pdf']['batch_entries'] if batch_size is None else batch_size
+        self.story = []
+        self.parts = []
+        self.entries = 0
+
+    def add_html(self, html, normalized=False):
+        """Adds a fragment of HTML. Fragments not normalized by filter_for_xhtml2pdf() are closed first."""
+        if not self.batch_size:
+            self.flush()
+        self.parts.append(FRAGMENT_MARKER)
+        self.parts.append(html if normalized else htmlfilter.close_tags(html))
+
+    def add_divider(self):
+        self.parts.append(DIVIDER)
+
+    def add_flowable(self, flowable):
+        self.flush()
+        self.story.append(flowable)
+
+    def end_entry(self):
+        """Converts all collected HTML, if the batch is complete."""
+        self.entries += 1
+        if self.batch_size and self.entries >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # The HTML starts with the Unicode byte order marker ('\ufeff') to get
+        # the PDF library to interpret it correctly. Without the marker non-ASCII
+        # characters like German umlauts are not displyed correctly in the
+        # created PDF file.
+        if self.parts:
+            self.story.extend(replace_fragment_markers(convert_html('\ufeff' + ''.join(self.parts))))
+        self.parts = []
+        self.entries = 0
+
+    def take(self):
+        """Returns all converted flowables and removes them from the builder."""
+        story, self.story = self.story, []
+        return story
+
+    def build(self):
+        """Converts the remaining HTML and returns all flowables not taken yet."""
+        self.flush()
+        return self.take()
+
+
+def replace_fragment_markers(story):
+    """
+    Replaces the markers at the start of every fragment with the spacer
+    pisaStory() adds in front of the first block of a story.
+    """
+    result = []
+    at_start = False
+    for flowable in story:
+        if isinstance(flowable, Spacer) and flowable.height == MARKER_HEIGHT:
+            if at_start:
+                # empty fragment
+                result.append(Spacer(1, 1))
+            at_start = True
+            continue
+        if at_start:
+            style = getattr(flowable, 'style', None)
+            space_before = getattr(style, 'spaceBefore', 0) or 0
+            if space_before > 0:
+                style.spaceBefore = 0
+                result.append(Spacer(1, space_before))
+            at_start = False
+        result.append(flowable)
+    if at_start:
+        result.append(Spacer(1, 1))
+    return result
+
+
+def build_pdf_for_glossary(glossary_id, glossary_name, temp_dir, entries=None):
+    """Yields the flowables of a glossary while its entries are loaded page by page."""
+    builder = StoryBuilder()
     logger.info('Loading glossary: {} - {}'.format(glossary_id, glossary_name))
     # create heading
-    heading = document.pisaStory('\ufeff<h1>{} (Glossar)</h1>'.format(glossary_name)).story
-    part.extend(heading)
-    # build paragraphs for questions
-    for question, answer in moodle.get_entries_for_glossary(glossary_id, temp_dir):
-        part.extend(document.pisaStory('\ufeff<h2>{}</h2>'.format(question)).story)
-        bs = BeautifulSoup(answer, features='html.parser')  # 'lxml', 'html5lib'
-        filter_for_xhtml2pdf(bs, temp_dir)
-        part.extend(document.pisaStory('\ufeff{}'.format(bs)).story)
-        # insert divider between entries (see https://stackoverflow.com/a/36112136)
-        part.append(HRFlowable(width='40%', thickness=2, color='darkgray'))
-    # pop last divider
-    part.pop()
-    part.append(PageBreak())
-    return part
-
-
-def build_pdf_for_wiki(wiki_id, wiki_name, temp_dir):
-    part = []
+    builder.add_html('<h1>{} (Glossar)</h1>'.format(glossary_name))
+    # build paragraphs for questions while the entries are loaded page by page
+    if entries is None:
+        entries = moodle.get_entries_for_glossary(glossary_id, temp_dir)
+    for no, entry in enumerate(images.prefetch_ahead(entries, lambda e: images.find_image_urls(e.definition),
+                                                     CONFIG['images']['prefetch_window'])):
+        # insert divider between entries
+        if no:
+            builder.add_divider()
+        builder.add_html('<h2>{}</h2>'.format(entry.concept))
+        builder.add_html(filter_for_xhtml2pdf(entry.definition), normalized=True)
+        builder.end_entry()
+        yield from builder.take()
+    yield from builder.build()
+    yield PageBreak()
+
+
+def build_pdf_for_wiki(wiki_id, wiki_name, temp_dir, pages=None):
+    """Yields the flowables of all pages of a wiki."""
+    builder = StoryBuilder()
     logger.info('Loading wiki: {} - {}'.format(wiki_id, wiki_name))
+    if pages is None:
+        pages = moodle.get_subwiki_pages(wiki_id)
+        for page in pages:
+            images.submit_html(page.content)
     # create heading
-    heading = document.pisaStory('\ufeff<h1>{} (Wiki)</h1>'.format(wiki_name)).story
-    part.extend(heading)
+    builder.add_html('<h1>{} (Wiki)</h1>'.format(wiki_name))
     # build paragraphs for questions
-    for page_id, page_name, page_content in moodle.get_subwiki_pages(wiki_id):
-        part.extend(document.pisaStory('\ufeff<h2>{}</h2>'.format(page_name)).story)
-        bs = BeautifulSoup(page_content, features='html.parser')
+    for page in pages:
+        builder.add_html('<h2>{}</h2>'.format(page.title))
         # TODO: Handle if image is external link to another site.
-        filter_for_xhtml2pdf(bs, temp_dir)
-        part.extend(document.pisaStory('\ufeff{}'.format(bs)).story)
-    part.append(PageBreak())
-    return part
+        builder.add_html(filter_for_xhtml2pdf(page.content), normalized=True)
+        builder.end_entry()
+        yield from builder.take()
+    yield from builder.build()
+    yield PageBreak()
 
 
-def build_pdf_for_database(database_id, database_name, temp_dir):
-    part = []
+def build_pdf_for_database(database_id, database_name, temp_dir, entries=None):
+    """Yields the flowables of a database while its entries are loaded page by page."""
+    builder = StoryBuilder()
     logger.info('Loading database: {} - {}'.format(database_id, database_name))
     # create heading
-    heading = document.pisaStory('\ufeff<h1>{} (Datenbank)</h1>'.format(database_name)).story
-    part.extend(heading)
-    # build paragraphs for questions
-    for entry in moodle.get_entries_for_database(database_id):
-        entry_heading = document.pisaStory('\ufeff<h2>Eintrag: {}</h2>'.format(entry['id'])).story
-        part.extend(entry_heading)
-        for k, v in entry.items():
-            # exclude file list
-            if k != 'files' and k != 'id':
-                if v in entry['files']:
-                    image_file_name = moodle.download_image(entry['files'][v], temp_dir)
-                    part.append(Image(image_file_name))  # , width=width, height=height)
-                else:
-                    part.extend(document.pisaStory('\ufeff<h3>{}</h3><p>{}</p>'.format(k, v)).story)
-        # bs = BeautifulSoup(page_content, features='html.parser')
-        # filter_for_xhtml2pdf(bs, temp_dir)
-        # part.extend(document.pisaStory('\ufeff{}'.format(bs)).story)
-    part.append(PageBreak())
-    return part
+    builder.add_html('<h1>{} (Datenbank)</h1>'.format(database_name))
+    # build paragraphs for entries while they are loaded page by page
+    if entries is None:
+        entries = moodle.get_entries_for_database(database_id)
+    for entry in images.prefetch_ahead(entries, get_image_urls_for_database_entry,
+                                       CONFIG['images']['prefetch_window']):
+        builder.add_html('<h2>Eintrag: {}</h2>'.format(entry.id))
+        for k, v in entry.fields:
+            file_url = entry.get_file_url(v)
+            if file_url:
+                image_file_name = images.resolve_image(file_url)
+                image_file_name, width, height = fit_image(image_file_name)
+                builder.add_flowable(Image(image_file_name, width=width, height=height))
+            else:
+                builder.add_html('<h3>{}</h3><p>{}</p>'.format(k, v))
+        # builder.add_html(filter_for_xhtml2pdf(page_content), normalized=True)
+        builder.end_entry()
+        yield from builder.take()
+    yield from builder.build()
+    yield PageBreak()
 
 
-def build_pdf_for_glossaries_and_wikis(glossaries, wikis, databases, output_file, callback=None):
+def get_image_urls_for_database_entry(entry):
+    """Returns the URLs of all attached files that are shown as images for a database entry."""
+    return [entry.get_file_url(v) for _, v in entry.fields if entry.get_file_url(v)]
+
+
+def build_pdf_for_glossaries_and_wikis(glossaries, wikis, databases, output_file, callback=None, incremental=False):
     """
     Creates a PDF file from Moodle glossaries, wikis and databases accessed by Moodle Web Service.
 
-    :param glossaries: list of glossaries to be exported, each entry containing a tuple of (at least) the id and name
-                       for the glossary
-    :param wikis: list of wikis to be exported, each entry containing a tuple of (at least) the id and name for a wiki
-    :param databases: list of databases to be exported, each entry containing a tuple of (at least) the id and name for
-                      the database
+    :param glossaries: list of glossaries to be exported
+    :param wikis: list of wikis to be exported
+    :param databases: list of databases to be exported
     :param output_file: file name for output PDF file
+    :param incremental: only load entries that were changed since the last export, all other entries are taken from
+                        the stored state of the last export
+    :return: statistics about reused and refetched modules and entries for incremental exports, otherwise None
     """
+    processes = get_render_processes(len(glossaries) + len(wikis) + len(databases))
+    cache = fragment_cache.get_fragment_cache()
+    if processes > 1 or cache is not None:
+        try:
+            return build_pdf_from_fragments(glossaries, wikis, databases, output_file, callback, incremental,
+                                            processes, cache)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logger.warning('Rendering in parallel failed ({}), rendering all modules in this process.'.format(e))
     logger.info('Creating PDF file from Moodle Modules...')
     document = SimpleDocTemplate(output_file, author=CONFIG['pdf']['author'], title=CONFIG['pdf']['title'])
-    story = []
+    statistics = export_state.ExportStatistics() if incremental else None
+    images.get_image_store().begin_export()
+    with tempfile.TemporaryDirectory() as temp_dir, images.prefetch():
+        story = generate_story(glossaries, wikis, databases, temp_dir, statistics, callback)
+        if CONFIG['pdf']['streaming']:
+            # lay out the pages while the modules are loaded and converted
+            story = LazyStory(story)
+        else:
+            story = list(story)
+        logger.info('Writing Moodle glossar to PDF file: {}.'.format(output_file))
+        profiling.checkpoint('before layout')
+        with metrics.span('pdf.layout'):
+            document.build(story, onFirstPage=create_page_margins, onLaterPages=create_page_margins)
+    logger.info('Saved {} kB by normalizing images.'.format(images.get_image_store().bytes_saved // 1024))
+    if statistics:
+        logger.info('Incremental export: {}'.format(statistics))
+    return statistics
+
+
+MODULE_BUILDERS = {'glossary': build_pdf_for_glossary, 'wiki': build_pdf_for_wiki,
+                   'database': build_pdf_for_database}
+
+INCREMENTAL_LOADERS = {'glossary': export_state.get_entries_for_glossary, 'wiki': export_state.get_subwiki_pages,
+                       'database': export_state.get_entries_for_database}
+
+CONTENT_LOADERS = {'glossary': lambda module_id, temp_dir: moodle.get_entries_for_glossary(module_id, temp_dir),
+                   'wiki': lambda module_id, temp_dir: moodle.get_subwiki_pages(module_id),
+                   'database': lambda module_id, temp_dir: moodle.get_entries_for_database(module_id)}
+
+IMAGE_URL_GETTERS = {'glossary': lambda entry: images.find_image_urls(entry.definition),
+                     'wiki': lambda page: images.find_image_urls(page.content),
+                     'database': get_image_urls_for_database_entry}
+
+
+def generate_story(glossaries, wikis, databases, temp_dir, statistics=None, callback=None):
+    """
+    Yields the flowables of all modules. Each module is loaded and converted
+    only when its flowables are needed. If statistics are given, only entries
+    changed since the last export are loaded (incremental export).
+    """
     no = 0
     overall = len(glossaries) + len(wikis) + len(databases)
     if callback and callable(callback):
         callback(no, overall)
+    for glossary in glossaries:
+        logger.info('Adding glossary no. {}: {}'.format(glossary.id, glossary.name))
+        yield from metrics.measure_iterator(generate_module('glossary', glossary, temp_dir, statistics),
+                                            'pdf.build_module', type='glossary')
+        no += 1
+        if callback and callable(callback):
+            callback(no, overall)
+    if wikis:
+        with metrics.span('pdf.load_wikis'):
+            if statistics is not None:
+                all_pages = [export_state.get_subwiki_pages(w.id, statistics) for w in wikis]
+            else:
+                # load pages of all wikis at once
+                all_pages = moodle_async.get_subwiki_pages([w.id for w in wikis])
+        for pages in all_pages:
+            for page in pages:
+                images.submit_html(page.content)
+        for wiki, pages in zip(wikis, all_pages):
+            logger.info('Adding wiki no. {}: {}'.format(wiki.id, wiki.name))
+            yield from metrics.measure_iterator(generate_module('wiki', wiki, temp_dir, content=pages),
+                                                'pdf.build_module', type='wiki')
+            no += 1
+            if callback and callable(callback):
+                callback(no, overall)
+    for database in databases:
+        logger.info('Adding database no. {}: {}'.format(database.id, database.name))
+        yield from metrics.measure_iterator(generate_module('database', database, temp_dir, statistics),
+                                            'pdf.build_module', type='database')
+        no += 1
+        if callback and callable(callback):
+            callback(no, overall)
+
+
+def generate_module(module_type, module, temp_dir, statistics=None, content=None):
+    """
+    Yields the flowables of a single module. The entries or pages are loaded
+    as given by content, only changed entries (if statistics are given) or
+    all entries.
+    """
+    if content is None and statistics is not None:
+        content = INCREMENTAL_LOADERS[module_type](module.id, statistics)
+    yield from MODULE_BUILDERS[module_type](module.id, module.name, temp_dir, content)
+
+
+class LazyStory(list):
+    """
+    List of flowables for SimpleDocTemplate.build(), which is filled from an
+    iterable while the pages are laid out. ReportLab only takes flowables from
+    the front of the list (and puts back the parts of split flowables), so
+    only a few flowables are held at any time and every flowable is released
+    as soon as it is drawn.
+    """
+    def __init__(self, flowables, lookahead=STREAMING_LOOKAHEAD):
+        super().__init__()
+        self.iterator = iter(flowables)
+        self.lookahead = lookahead
+
+    def _fill(self):
+        while self.iterator is not None and list.__len__(self) < self.lookahead:
+            flowable = next(self.iterator, None)
+            if flowable is None:
+                self.iterator = None
+            else:
+                self.append(flowable)
+
+    def __len__(self):
+        self._fill()
+        return list.__len__(self)
+
+    def __getitem__(self, index):
+        self._fill()
+        return list.__getitem__(self, index)
+
+
+############################## Parallel rendering ##############################
+
+def get_render_processes(module_count, merge=True):
+    """
+    Returns the number of processes rendering modules in parallel as
+    configured by the option "render_processes". Returns 1 if all modules
+    should be rendered in this process, e.g. if the rendered modules have to
+    be merged and the library pypdf is not installed.
+    """
+    if profiling.is_active():
+        logger.debug('Profiling only covers this process, rendering all modules in this process.')
+        return 1
+    processes = CONFIG['pdf']['render_processes']
+    if not processes:
+        # only count the processors this process may run on, e.g. in a container
+        processes = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    if merge and processes > 1 and module_count > 1 and pdfmerge.pypdf is None:
+        logger.warning('Library pypdf not installed, rendering all modules in this process.')
+        return 1
+    return max(1, min(processes, module_count))
+
+
+def build_pdf_from_fragments(glossaries, wikis, databases, output_file, callback=None, incremental=False,
+                             processes=1, cache=None):
+    """
+    Creates the same PDF file as build_pdf_for_glossaries_and_wikis(), but
+    every module is laid out into a separate fragment, in a pool of worker
+    processes if more than one process is given. The fragments are merged
+    afterwards and the page margins with continuous page numbers are added to
+    all pages.
+
+    If a fragment cache is given, only the entries or pages of every module
+    are listed first (see get_module_listing()). The content of a module is
+    only loaded and rendered, if its fragment is not cached or one of its
+    images has changed (if the option "revalidate_images" is set).
+    """
+    logger.info('Creating PDF file from Moodle Modules with {} processes...'.format(processes))
+    modules = [('glossary', g) for g in glossaries] + [('wiki', w) for w in wikis] + \
+        [('database', d) for d in databases]
+    statistics = export_state.ExportStatistics() if incremental else None
+    images.get_image_store().begin_export()
     with tempfile.TemporaryDirectory() as temp_dir:
-        if glossaries:
-            for glossary_id, glossary_name in glossaries:
-                logger.info('Adding glossary no. {}: {}'.format(glossary_id, glossary_name))
-                story.extend(build_pdf_for_glossary(glossary_id, glossary_name, temp_dir))
-                no += 1
-                if callback and callable(callback):
-                    callback(no, overall)
-        if wikis:
-            for wiki_id, wiki_name, _, _, _, _ in wikis:
-                logger.info('Adding wiki no. {}: {}'.format(wiki_id, wiki_name))
-                story.extend(build_pdf_for_wiki(wiki_id, wiki_name, temp_dir))
-                no += 1
-                if callback and callable(callback):
-                    callback(no, overall)
-        if databases:
-            for database_id, database_name, _, _ in databases:
-                logger.info('Adding database no. {}: {}'.format(database_id, database_name))
-                story.extend(build_pdf_for_database(database_id, database_name, temp_dir))
+        fragments = [os.path.join(temp_dir, 'fragment_{}.pdf'.format(i)) for i in range(len(modules))]
+        keys = [None] * len(modules)
+        contents = [None] * len(modules)
+        missing = list(range(len(modules)))
+        if cache is not None:
+            with metrics.span('pdf.fragment_keys'):
+                listings = []
+                for i, (module_type, module) in enumerate(modules):
+                    listing, contents[i] = get_module_listing(module_type, module, statistics)
+                    listings.append(listing)
+                keys = [cache.make_key(module_type, module, listing)
+                        for (module_type, module), listing in zip(modules, listings)]
+            cached = [cache.get(key) for key in keys]
+            if CONFIG['fragment_cache']['revalidate_images']:
+                with metrics.span('pdf.revalidate_images'):
+                    cached = revalidate_fragments(cached)
+            missing = []
+            for i, (module_type, module) in enumerate(modules):
+                if cached[i] is None:
+                    missing.append(i)
+                    # the content must not be taken from responses cached before the module was changed
+                    moodle.invalidate_module(module_type, module.id)
+                else:
+                    fragments[i] = cached[i][0]
+                    # entries loaded with the listing were already counted
+                    if statistics and contents[i] is None:
+                        statistics.add_module(len(listings[i]['entries']), 0)
+                    contents[i] = None
+            metrics.count('pdf.fragment_cache_hits', len(modules) - len(missing))
+            logger.info('Taking {} of {} modules from the fragment cache.'.format(len(modules) - len(missing),
+                                                                                  len(modules)))
+        image_urls = {}
+        no = len(modules) - len(missing)
+        if callback and callable(callback):
+            callback(no, len(modules))
+        if processes > 1 and len(missing) > 1:
+            with create_render_pool(min(processes, len(missing))) as executor:
+                futures = {executor.submit(run_render_task, build_module_fragment, *modules[i], fragments[i],
+                                           incremental, contents[i]): i for i in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    module_statistics, image_urls[futures[future]] = get_render_result(future)
+                    if statistics:
+                        statistics.merge(module_statistics)
+                    no += 1
+                    if callback and callable(callback):
+                        callback(no, len(modules))
+        else:
+            for i in missing:
+                module_statistics, image_urls[i] = build_module_fragment(*modules[i], fragments[i], incremental,
+                                                                         contents[i])
+                if statistics:
+                    statistics.merge(module_statistics)
                 no += 1
                 if callback and callable(callback):
-                    callback(no, overall)
+                    callback(no, len(modules))
+        if cache is not None:
+            store = images.get_image_store()
+            for i in missing:
+                cache.put(keys[i], fragments[i], {url: _get_file_name(store.lookup(url)) for url in image_urls[i]})
         logger.info('Writing Moodle glossar to PDF file: {}.'.format(output_file))
-        document.build(story, onFirstPage=create_page_margins, onLaterPages=create_page_margins)
+        with metrics.span('pdf.merge'):
+            pdfmerge.merge_fragments(fragments, output_file, create_page_margins, CONFIG['pdf']['title'],
+                                     CONFIG['pdf']['author'])
+    if cache is not None:
+        cache.evict()
+    logger.info('Saved {} kB by normalizing images.'.format(images.get_image_store().bytes_saved // 1024))
+    if statistics:
+        logger.info('Incremental export: {}'.format(statistics))
+    return statistics
+
+
+def get_module_listing(module_type, module, statistics=None):
+    """
+    Returns the listing of a module for the fragment cache (see
+    export_state.get_listing()) and the entries of a glossary or None.
+    Glossary entries can only be listed with their definitions, so they are
+    kept for rendering the glossary, if its fragment is not cached.
+    """
+    if module_type != 'glossary':
+        return export_state.get_listing(module_type, module.id), None
+    if statistics is not None:
+        entries = export_state.get_entries_for_glossary(module.id, statistics)
+    else:
+        entries = export_state.list_glossary_entries(module.id)
+    return {'entries': sorted((entry.id, entry.timemodified) for entry in entries)}, entries
+
+
+def revalidate_fragments(cached):
+    """
+    Revalidates the images of all cached fragments (as returned by
+    FragmentCache.get()) and returns the list with None instead of every
+    fragment, whose images have changed since it was rendered.
+    """
+    with images.prefetch() as prefetcher:
+        for fragment in cached:
+            for url in (fragment[1] if fragment else ()):
+                prefetcher.submit(url)
+        result = []
+        for fragment in cached:
+            if fragment and any(_get_file_name(prefetcher.resolve(url)) != file_name
+                                for url, file_name in fragment[1].items()):
+                fragment = None
+            result.append(fragment)
+        return result
+
+
+def _get_file_name(path):
+    return os.path.basename(path) if path else None
+
+
+class _LogForwarder(logging.Handler):
+    """Passes the log records of the worker processes to the loggers of this process."""
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+@contextlib.contextmanager
+def create_render_pool(processes):
+    """
+    Returns a pool of worker processes for run_render_task(). The workers
+    share the configured request rate, send their log records to this process
+    and collect metrics, if metrics are enabled in this process.
+    """
+    # new processes are started instead of forked, so that no connections or open databases are shared
+    context = multiprocessing.get_context('spawn')
+    log_queue = context.Queue()
+    listener = logging.handlers.QueueListener(log_queue, _LogForwarder())
+    listener.start()
+    try:
+        log_level = logging.getLogger('moodle2pdf').getEffectiveLevel()
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=context, initializer=init_render_process,
+                initargs=(CONFIG, processes, log_queue, log_level, metrics.is_enabled())) as executor:
+            yield executor
+    finally:
+        listener.stop()
+
+
+def init_render_process(configuration, processes, log_queue, log_level, collect_metrics):
+    # use the configuration of the main process including all changes made at runtime (site, token, ...)
+    config.CONFIG.clear()
+    config.CONFIG.update(configuration)
+    # all processes together must not send more requests than configured
+    moodle.share_rate_limit(processes)
+    package_logger = logging.getLogger('moodle2pdf')
+    package_logger.setLevel(log_level)
+    package_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    if collect_metrics:
+        # metrics are written by the main process
+        metrics.enable(exporters=[])
+    # revalidate every image once in every process
+    images.get_image_store().begin_export()
+
+
+def run_render_task(function, *args):
+    """
+    Calls the function in a worker process and returns its result together
+    with the metrics and the bytes saved by normalizing images since the last
+    task, which get_render_result() adds to those of the main process.
+    """
+    result = function(*args)
+    return result, metrics.collect(), images.get_image_store().take_bytes_saved()
+
+
+def get_render_result(future):
+    """Returns the result of run_render_task() and adds its metrics and saved bytes to this process."""
+    result, values, bytes_saved = future.result()
+    metrics.merge(values)
+    images.get_image_store().add_bytes_saved(bytes_saved)
+    return result
+
+
+def build_module_fragment(module_type, module, output_file, incremental=False, content=None):
+    """
+    Loads a single module (unless its content is given) and writes it into a
+    PDF file without page margins. Returns the statistics for incremental
+    exports (otherwise None) and the URLs of all images of the module.
+    """
+    statistics = export_state.ExportStatistics() if incremental else None
+    image_urls = []
+    logger.info('Adding {} no. {}: {}'.format(module_type, module.id, module.name))
+    with tempfile.TemporaryDirectory() as temp_dir, images.prefetch():
+        if content is None and statistics is not None:
+            content = INCREMENTAL_LOADERS[module_type](module.id, statistics)
+        elif content is None:
+            content = CONTENT_LOADERS[module_type](module.id, temp_dir)
+        if module_type == 'wiki':
+            for page in content:
+                images.submit_html(page.content)
+        story = generate_module(module_type, module, temp_dir,
+                                content=_record_image_urls(content, IMAGE_URL_GETTERS[module_type], image_urls))
+        fragment = SimpleDocTemplate(output_file, author=CONFIG['pdf']['author'], title=CONFIG['pdf']['title'])
+        profiling.checkpoint('before layout of {} no. {}'.format(module_type, module.id))
+        fragment.build(LazyStory(story) if CONFIG['pdf']['streaming'] else list(story))
+    return statistics, image_urls
+
+
+def _record_image_urls(content, get_image_urls, image_urls):
+    # the entries are loaded page by page, so the URLs are collected while they are rendered
+    for item in content:
+        image_urls.extend(get_image_urls(item))
+        yield item
+
+
+############################## Separate export ##############################
+
+def export_modules_separately(glossaries, wikis, databases, output_directory, callback=None, incremental=False,
+                              processes=None):
+    """
+    Exports every module into its own PDF file in the output directory. The
+    modules are exported in a pool of worker processes, if more than one
+    processor is available. A failed export is recorded in the manifest and
+    does not stop the export of all other modules.
+
+    :param output_directory: directory for all PDF files and the manifest
+    :param incremental: only load entries that were changed since the last export
+    :return: manifest with the output file, pages, duration and error of every module
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    jobs = export_jobs.create_jobs(glossaries, wikis, databases, output_directory)
+    manifest = export_jobs.Manifest(output_directory, jobs)
+    statistics = export_state.ExportStatistics() if incremental else None
+    processes = processes or get_render_processes(len(jobs), merge=False)
+    images.get_image_store().begin_export()
+    logger.info('Exporting {} modules into separate files with {} processes...'.format(len(jobs), processes))
+    start = time.perf_counter()
+    if callback and callable(callback):
+        callback(0, len(jobs))
+    contents = {}
+    if wikis and not incremental:
+        # load pages of all wikis at once over the pooled connections of this process
+        with metrics.span('pdf.load_wikis'):
+            all_pages = moodle_async.get_subwiki_pages([w.id for w in wikis])
+        contents = {w.id: pages for w, pages in zip(wikis, all_pages)}
+    pending = jobs
+    if processes > 1:
+        pending = []
+        with create_render_pool(processes) as executor:
+            futures = {executor.submit(run_render_task, build_module_document, job.module_type, job.module,
+                                       job.output_file, incremental, _get_content(job, contents)): job
+                       for job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                try:
+                    _finish_job(job, statistics, *get_render_result(future))
+                except concurrent.futures.process.BrokenProcessPool:
+                    pending.append(job)
+                except Exception as e:
+                    _fail_job(job, e)
+                if callback and callable(callback):
+                    callback(sum(j.finished for j in jobs), len(jobs))
+        if pending:
+            logger.warning('Exporting in parallel failed, exporting {} modules in this process.'.format(len(pending)))
+    for job in pending:
+        try:
+            _finish_job(job, statistics, *build_module_document(job.module_type, job.module, job.output_file,
+                                                                incremental, _get_content(job, contents)))
+        except Exception as e:
+            _fail_job(job, e)
+        if callback and callable(callback):
+            callback(sum(j.finished for j in jobs), len(jobs))
+    manifest.duration = time.perf_counter() - start
+    manifest.statistics = statistics
+    try:
+        logger.info('Wrote manifest of export to {}.'.format(manifest.write()))
+    except OSError as e:
+        logger.error('Could not write manifest: {}'.format(e))
+    logger.info('Exported {} of {} modules in {:.1f} s.'.format(len(jobs) - len(manifest.failed), len(jobs),
+                                                                manifest.duration))
+    logger.info('Saved {} kB by normalizing images.'.format(images.get_image_store().bytes_saved // 1024))
+    if statistics:
+        logger.info('Incremental export: {}'.format(statistics))
+    return manifest
+
+
+def _get_content(job, contents):
+    return contents.get(job.module.id) if job.module_type == 'wiki' else None
+
+
+def _finish_job(job, statistics, pages, duration, module_statistics):
+    job.finished = True
+    job.pages = pages
+    job.duration = duration
+    if statistics and module_statistics:
+        statistics.merge(module_statistics)
+    metrics.count('pdf.exported_modules', status='succeeded')
+    logger.info('Wrote {} with {} pages to {}.'.format(job, pages, job.output_file))
+
+
+def _fail_job(job, error):
+    job.finished = True
+    job.error = '{}: {}'.format(type(error).__name__, error)
+    metrics.count('pdf.exported_modules', status='failed')
+    logger.error('Could not export {}: {}'.format(job, job.error))
+
+
+def build_module_document(module_type, module, output_file, incremental=False, content=None):
+    """
+    Loads a single module and writes it atomically into its own PDF file with
+    page margins. Returns the number of pages, the duration in seconds and the
+    statistics for incremental exports (otherwise None).
+    """
+    start = time.perf_counter()
+    statistics = export_state.ExportStatistics() if incremental else None
+    logger.info('Exporting {} no. {}: {}'.format(module_type, module.id, module.name))
+    with tempfile.TemporaryDirectory() as temp_dir, images.prefetch(), \
+            pdfmerge.atomic_output(output_file) as temp_file:
+        if content:
+            for page in content:
+                images.submit_html(page.content)
+        story = generate_module(module_type, module, temp_dir, statistics, content)
+        document = SimpleDocTemplate(temp_file, author=CONFIG['pdf']['author'], title=module.name)
+        profiling.checkpoint('before layout of {} no. {}'.format(module_type, module.id))
+        document.build(LazyStory(story) if CONFIG['pdf']['streaming'] else list(story),
+                       onFirstPage=create_page_margins, onLaterPages=create_page_margins)
+    return document.page, time.perf_counter() - start, statistics
 
 
-def make_pdf_from_moodle(glossaries=None, wikis=None, databases=None, combine_to_one_document=False):
+def make_pdf_from_moodle(glossaries=None, wikis=None, databases=None, combine_to_one_document=False,
+                         incremental=False):
     if combine_to_one_document:
         output_file = CONFIG['pdf']['default_output_filename']
-        build_pdf_for_glossaries_and_wikis(glossaries, wikis, databases, output_file)
+        return build_pdf_for_glossaries_and_wikis(glossaries or [], wikis or [], databases or [], output_file,
+                                                  incremental=incremental)
     else:
-        logger.error('NOT IMPLEMENTED YET!')
-        # output_file = '{}.pdf'.format(f)
-        # create_pdf_doc_online((f, ), output_file)
+        manifest = export_modules_separately(glossaries or [], wikis or [], databases or [],
+                                             CONFIG['pdf']['output_directory'], incremental=incremental)
+        return manifest.statistics
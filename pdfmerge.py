@@ -0,0 +1,129 @@
+"""
+Merging of separately rendered PDF fragments into one document.
+
+Fragments are rendered without page margins, because the number of a page in
+the final document is not known while a fragment is rendered. After the
+fragments are concatenated, the page margins are drawn by the same function
+as used for a document rendered at once (e.g. create_page_margins() from the
+module pdf) onto an overlay, that is merged onto every page.
+
+Merging needs the library pypdf. If it is not installed, pypdf is None and
+callers have to render the whole document at once.
+"""
+
+import io
+import os
+import logging
+import secrets
+import contextlib
+
+from reportlab.pdfgen import canvas
+try:
+    import pypdf
+    from pypdf.generic import ContentStream, DictionaryObject, NameObject
+except ImportError:
+    pypdf = None
+
+
+logger = logging.getLogger('moodle2pdf.pdfmerge')
+
+# prefix for the names of all fonts of the overlay, so they never collide with the fonts of the fragments
+OVERLAY_FONT_PREFIX = 'Margin'
+
+
+class PageInfo:
+    """Minimal replacement for a document template passed to the callbacks drawing the page margins."""
+    def __init__(self, page, title='', author=''):
+        self.page = page
+        self.title = title
+        self.author = author
+
+
+def create_overlay(page_sizes, on_page, first_page=1, title='', author=''):
+    """
+    Returns a PDF file (as bytes) with one page for every given page size,
+    drawn by the callback on_page(canvas, doc) with continuous page numbers.
+    """
+    buffer = io.BytesIO()
+    overlay = canvas.Canvas(buffer)
+    for number, page_size in enumerate(page_sizes, start=first_page):
+        overlay.setPageSize(page_size)
+        on_page(overlay, PageInfo(number, title, author))
+        overlay.showPage()
+    overlay.save()
+    return buffer.getvalue()
+
+
+def merge_fragments(fragments, output_file, on_page=None, title='', author=''):
+    """
+    Concatenates the PDF fragments into one document, draws the page margins
+    with on_page(canvas, doc) on all pages and writes the document atomically
+    to the output file. Returns the number of pages.
+    """
+    writer = pypdf.PdfWriter()
+    for fragment in fragments:
+        writer.append(fragment)
+    if on_page:
+        page_sizes = [(float(p.mediabox.width), float(p.mediabox.height)) for p in writer.pages]
+        overlay = pypdf.PdfReader(io.BytesIO(create_overlay(page_sizes, on_page, title=title, author=author)))
+        for page, overlay_page in zip(writer.pages, overlay.pages):
+            rename_fonts(overlay_page, OVERLAY_FONT_PREFIX, writer)
+            page.merge_page(overlay_page)
+            # merging leaves the content of the page uncompressed
+            page.compress_content_streams()
+    writer.add_metadata({'/Title': title, '/Author': author})
+    with atomic_output(output_file) as temp_file, open(temp_file, 'wb') as f:
+        writer.write(f)
+    logger.debug('Merged {} fragments with {} pages into {}.'.format(len(fragments), len(writer.pages), output_file))
+    return len(writer.pages)
+
+
+def rename_fonts(page, prefix, writer):
+    """
+    Prefixes the names of all fonts used by the page and copies the fonts
+    into the writer, so all merged pages use the same font under the same
+    name. Otherwise pypdf renames the font on every merged page and adds all
+    those names to the font resources shared by all pages of a fragment.
+    """
+    fonts = page['/Resources'].get('/Font')
+    if not fonts:
+        return
+    fonts = fonts.get_object()
+    names = {name: NameObject('/{}{}'.format(prefix, name[1:])) for name in fonts}
+    content = ContentStream(page.get_contents(), page.pdf)
+    for operands, operator in content.operations:
+        if operator == b'Tf' and operands and operands[0] in names:
+            operands[0] = names[operands[0]]
+    page.replace_contents(content)
+    page['/Resources'][NameObject('/Font')] = DictionaryObject(
+        {names[name]: fonts[name].clone(writer).indirect_reference for name in fonts})
+
+
+@contextlib.contextmanager
+def atomic_output(output_file, suffix='.pdf'):
+    """
+    Context manager returning the name of a temporary file in the directory of
+    the output file. If the enclosed code succeeds, the temporary file replaces
+    the output file, otherwise it is removed. So an existing output file is
+    never left partially written.
+    """
+    temp_file = _create_temp_file(os.path.dirname(os.path.abspath(output_file)), suffix)
+    try:
+        yield temp_file
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file)
+        raise
+    os.replace(temp_file, output_file)
+
+
+def _create_temp_file(directory, suffix):
+    # unlike tempfile.mkstemp(), which makes files only readable by the owner, the file gets the mode of any newly
+    # created file (the umask is applied by the operating system)
+    while True:
+        temp_file = os.path.join(directory, 'tmp{}{}'.format(secrets.token_hex(8), suffix))
+        try:
+            os.close(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            return temp_file
+        except FileExistsError:
+            continue
@@ -0,0 +1,119 @@
+"""
+Profiling of exports.
+
+While the context manager profile() is active, all function calls are
+recorded with cProfile and all memory allocations are traced with tracemalloc.
+Afterwards three reports are written next to the output file:
+
+    FAQ.prof              call graph in the pstats format, e.g. for snakeviz
+                          or gprof2dot
+    FAQ_profile.txt       functions with the highest cumulative time
+    FAQ_allocations.txt   peak memory usage and lines of code with the
+                          largest memory allocations at each checkpoint
+
+Because most memory is freed again when the export is finished, code can take
+a snapshot of the allocations with checkpoint() at the point where the most
+memory is used, e.g. just before the layout of all pages. Without a profile
+checkpoint() does nothing.
+
+Only the thread starting the profile is profiled by cProfile, but that is the
+thread converting HTML and laying out the pages. Downloads run in other
+threads and show up as waiting time.
+"""
+
+import io
+import os
+import pstats
+import cProfile
+import logging
+import tracemalloc
+import contextlib
+
+
+logger = logging.getLogger('moodle2pdf.profiling')
+
+# number of entries in the reports
+TOP_ENTRIES = 40
+# number of frames stored for every memory allocation
+TRACEMALLOC_FRAMES = 10
+
+# list of tuples with name and snapshot of all checkpoints while a profile is active
+_checkpoints = None
+
+
+def is_active():
+    """Returns whether a profile is active."""
+    return _checkpoints is not None
+
+
+def get_report_files(output_file):
+    """Returns the file names of call graph, profile report and allocation report for an output file."""
+    base = os.path.splitext(output_file)[0]
+    return base + '.prof', base + '_profile.txt', base + '_allocations.txt'
+
+
+@contextlib.contextmanager
+def profile(output_file, enabled=True, top=TOP_ENTRIES):
+    """
+    Context manager profiling the enclosed code and writing the reports next
+    to the given output file. If enabled is false, nothing is done, so callers
+    can wrap their code unconditionally.
+    """
+    global _checkpoints
+    if not enabled:
+        yield
+        return
+    _checkpoints = []
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        checkpoint('end')
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        checkpoints, _checkpoints = _checkpoints, None
+        try:
+            write_reports(output_file, profiler, checkpoints, peak, top)
+        except OSError as e:
+            logger.error('Could not write profile: {}'.format(e))
+
+
+def checkpoint(name):
+    """Takes a snapshot of all memory allocations, if a profile is active."""
+    if _checkpoints is not None and tracemalloc.is_tracing():
+        _checkpoints.append((name, tracemalloc.take_snapshot()))
+
+
+def write_reports(output_file, profiler, checkpoints, peak, top=TOP_ENTRIES):
+    call_graph_file, profile_file, allocations_file = get_report_files(output_file)
+    profiler.dump_stats(call_graph_file)
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(top)
+    with open(profile_file, 'w', encoding='utf-8') as f:
+        f.write(stream.getvalue())
+    with open(allocations_file, 'w', encoding='utf-8') as f:
+        f.write('Peak of traced memory: {:.1f} MB\n'.format(peak / 1024 / 1024))
+        for name, snapshot in checkpoints:
+            snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                               tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                                               tracemalloc.Filter(False, '<unknown>')))
+            statistics = snapshot.statistics('lineno')
+            f.write('\n===== Checkpoint "{}": {:.1f} MB allocated =====\n\n'.format(
+                name, sum(s.size for s in statistics) / 1024 / 1024))
+            f.write('Top {} lines by allocated memory:\n'.format(top))
+            for i, statistic in enumerate(statistics[:top], start=1):
+                f.write('{:>3}. {}\n'.format(i, statistic))
+            f.write('\nTop {} tracebacks by allocated memory:\n'.format(min(top, 10)))
+            for i, statistic in enumerate(snapshot.statistics('traceback')[:min(top, 10)], start=1):
+                f.write('\n{:>3}. {} blocks, {:.1f} kB\n'.format(i, statistic.count, statistic.size / 1024))
+                for line in statistic.traceback.format():
+                    f.write('     {}\n'.format(line))
+    logger.info('Wrote profile to {}, {} and {}.'.format(call_graph_file, profile_file, allocations_file))
@@ -0,0 +1,75 @@
+"""
+Client-side rate limiting for requests to the Moodle site.
+
+The limiter combines a token bucket, that bounds the number of requests per
+second, with a limit for the number of concurrent requests. Both limits adapt
+to the server: they are halved whenever the server signals overload (HTTP 429
+or 503, timeouts) and slowly ramp back up while requests succeed. One limiter
+is shared by all threads, so the batch API and the image prefetcher together
+never send more than the server tolerates.
+"""
+
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger('moodle2pdf.ratelimit')
+
+
+class AdaptiveLimiter:
+    def __init__(self, rate, min_rate, max_rate, burst, concurrency, max_concurrency):
+        """
+        Creates a new limiter.
+
+        :param rate: initial number of requests per second
+        :param min_rate: number of requests per second the limiter never falls below
+        :param max_rate: number of requests per second the limiter never exceeds
+        :param burst: maximum number of requests sent at once after a idle period
+        :param concurrency: initial number of concurrent requests
+        :param max_concurrency: maximum number of concurrent requests
+        """
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.concurrency = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks until a request may be sent."""
+        with self.condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and self.in_flight < int(self.concurrency):
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                timeout = (1 - self.tokens) / self.rate if self.tokens < 1 else None
+                self.condition.wait(timeout)
+
+    def release(self, overloaded=False):
+        """
+        Marks a request as finished. If the server signaled overload, rate and
+        concurrency are halved, otherwise they are increased a bit.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency = max(1.0, self.concurrency / 2)
+                logger.warning('Server overloaded, reducing to {:.1f} requests/s and {} concurrent requests.'.format(
+                    self.rate, int(self.concurrency)))
+            else:
+                self.rate = min(self.max_rate, self.rate * 1.02)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
@@ -0,0 +1,216 @@
+"""
+Cache for the conversion of HTML into flowables by xhtml2pdf.
+
+Converting HTML with pisaStory() is the most expensive step of an export, but
+the same HTML is often converted many times: headings and field labels repeat
+in every module, and the same modules are exported again and again. Results
+are stored under a hash of the HTML and of everything else influencing the
+conversion (versions of xhtml2pdf and ReportLab, default style sheet), so a
+changed entry or an update of a library simply misses the cache.
+
+Flowables are changed while the pages are laid out and can not be used twice.
+Therefore all results are stored pickled and every hit returns a new copy,
+which is still many times faster than converting the HTML again. Recently used
+results are kept in memory; if enabled in the [story_cache] section of the
+configuration file, results are also stored in a SQLite database and are
+reused by later exports.
+
+xhtml2pdf creates a class with the default style for every conversion, which
+can not be pickled by reference. Those classes are pickled by their attributes
+and created again when loaded.
+"""
+
+import io
+import time
+import pickle
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections
+
+import reportlab
+import xhtml2pdf
+import xhtml2pdf.context
+import xhtml2pdf.default
+
+from config import CONFIG
+
+
+logger = logging.getLogger('moodle2pdf.story_cache')
+
+# change when the format of stored results changes
+CACHE_VERSION = 1
+# seconds to wait for a lock on the database held by another process
+SQLITE_TIMEOUT = 30
+
+_CLASS_ATTRIBUTES = ('__dict__', '__weakref__', '__module__', '__qualname__', '__doc__')
+
+
+class StoryCache:
+    def __init__(self, max_memory, filename=None, max_size=0):
+        """
+        Creates a cache for converted HTML.
+
+        :param max_memory: maximum size of all pickled results kept in memory in bytes
+        :param filename: file name of the SQLite database for persistent results or None
+        :param max_size: maximum size of all persistent results in bytes
+        """
+        self.max_memory = max_memory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # mapping from key to pickled story, ordered from least to most recently used
+        self.entries = collections.OrderedDict()
+        self.memory_size = 0
+        self.connection = None
+        if filename:
+            self.connection = sqlite3.connect(filename, timeout=SQLITE_TIMEOUT, check_same_thread=False)
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS stories (key TEXT PRIMARY KEY, data BLOB, '
+                                        'size INTEGER, accessed REAL)')
+
+    @staticmethod
+    def make_key(html):
+        """Builds the cache key from the HTML and the version of everything else influencing the conversion."""
+        content = hashlib.sha256(get_style_hash().encode('ascii'))
+        content.update(html.strip().encode('utf-8', 'surrogatepass'))
+        return content.hexdigest()
+
+    def get(self, key):
+        """Returns a new copy of the cached story for the given key or None."""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            elif self.connection is not None:
+                with self.connection:
+                    row = self.connection.execute('SELECT data FROM stories WHERE key = ?', (key,)).fetchone()
+                    if row is not None:
+                        self.connection.execute('UPDATE stories SET accessed = ? WHERE key = ?', (time.time(), key))
+                        data = row[0]
+                        self._remember(key, data)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            logger.debug('Could not load cached story: {}'.format(e))
+            self.remove(key)
+            return None
+
+    def put(self, key, story):
+        """Stores a copy of the story, it has to be stored before the pages are laid out."""
+        try:
+            data = dumps(story)
+        except Exception as e:
+            # e.g. flowables with callbacks, those are just converted every time
+            logger.debug('Could not store story in cache: {}'.format(e))
+            return
+        with self.lock:
+            self._remember(key, data)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('INSERT OR REPLACE INTO stories VALUES (?, ?, ?, ?)',
+                                            (key, data, len(data), time.time()))
+                    self._evict()
+
+    def remove(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.memory_size -= len(data)
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('DELETE FROM stories WHERE key = ?', (key,))
+
+    def clear(self):
+        """Removes all stories from the cache."""
+        with self.lock:
+            self.entries.clear()
+            self.memory_size = 0
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute('DELETE FROM stories')
+
+    def _remember(self, key, data):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.memory_size -= len(old)
+        if len(data) > self.max_memory:
+            return
+        self.entries[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.max_memory:
+            _, evicted = self.entries.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def _evict(self):
+        overall, = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM stories').fetchone()
+        if overall <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM stories ORDER BY accessed').fetchall():
+            if overall <= self.max_size:
+                break
+            evicted.append((key,))
+            overall -= size
+        self.connection.executemany('DELETE FROM stories WHERE key = ?', evicted)
+        logger.debug('Evicted {} cached stories.'.format(len(evicted)))
+
+
+_style_hash = None
+
+
+def get_style_hash():
+    """Returns a hash of the versions and the default style sheet used for converting HTML."""
+    global _style_hash
+    if _style_hash is None:
+        style = hashlib.sha256()
+        for value in (CACHE_VERSION, xhtml2pdf.__version__, reportlab.Version, xhtml2pdf.default.DEFAULT_CSS):
+            style.update(str(value).encode('utf-8'))
+            style.update(b'\0')
+        _style_hash = style.hexdigest()
+    return _style_hash
+
+
+class _StoryPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        if isinstance(obj, type) and obj is not xhtml2pdf.context.PmlParaFrag and \
+                issubclass(obj, xhtml2pdf.context.PmlParaFrag):
+            attributes = {k: v for k, v in obj.__dict__.items() if k not in _CLASS_ATTRIBUTES}
+            return _create_fragment_class, (obj.__bases__, attributes)
+        return NotImplemented
+
+
+def _create_fragment_class(bases, attributes):
+    cls = type(xhtml2pdf.context.PmlParaFrag.__name__, bases, attributes)
+    cls.__qualname__ = xhtml2pdf.context.PmlParaFrag.__qualname__
+    return cls
+
+
+def dumps(story):
+    """Returns the pickled story."""
+    buffer = io.BytesIO()
+    _StoryPickler(buffer, pickle.HIGHEST_PROTOCOL).dump(story)
+    return buffer.getvalue()
+
+
+_story_cache = None
+_story_cache_lock = threading.Lock()
+
+
+def get_story_cache():
+    """
+    Returns the shared story cache or None, if caching is disabled in the
+    [story_cache] section of the configuration file.
+    """
+    global _story_cache
+    cache_config = CONFIG['story_cache']
+    if not cache_config['enabled']:
+        return None
+    with _story_cache_lock:
+        if _story_cache is None:
+            _story_cache = StoryCache(cache_config['memory_size_mb'] * 1024 * 1024,
+                                      cache_config['filename'] if cache_config['persistent'] else None,
+                                      cache_config['max_size_mb'] * 1024 * 1024)
+        return _story_cache
@@ -0,0 +1,28 @@
+import PIL.Image
+import pytest
+
+import pdf
+import images
+
+
+@pytest.fixture
+def image_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, 'normalize_image', lambda path, width, height: path)
+    path = str(tmp_path / 'image.png')
+    PIL.Image.new('RGB', (200, 100)).save(path)
+    return path
+
+
+@pytest.mark.parametrize('value, expected', [('120', 120.0), ('80px', 80.0), ('50%', None), ('auto', None),
+                                             ('0', None), ('-10', None), ('inf', None), (None, None)])
+def test_parse_size(value, expected):
+    assert pdf.parse_size(value) == expected
+
+
+@pytest.mark.parametrize('width, height', [(0, None), (None, 0), (0, 0), (-5, 0)])
+def test_fit_image_ignores_non_positive_size(image_file, width, height):
+    assert pdf.fit_image(image_file, width, height) == (image_file, 200, 100)
+
+
+def test_fit_image_keeps_aspect_ratio(image_file):
+    assert pdf.fit_image(image_file, 0, 50) == (image_file, 100, 50)
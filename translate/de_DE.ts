@@ -56,6 +56,16 @@
         <source>Combine all glossaries into one PDF file</source>
         <translation>Alle Module in eine gemeinsame PDF-Datei ausgeben</translation>
     </message>
+    <message>
+        <location filename="../moodle2pdf.ui" line="114"/>
+        <source>Profile Export</source>
+        <translation>Export profilieren</translation>
+    </message>
+    <message>
+        <location filename="../moodle2pdf.ui" line="117"/>
+        <source>Write a profile of the export next to the PDF file</source>
+        <translation>Ein Profil des Exports neben der PDF-Datei speichern</translation>
+    </message>
     <message>
         <location filename="../moodleeditor.ui" line="63"/>
         <source>File</source>
@@ -195,9 +205,26 @@
         <translation>PDF-Datei erstellt.</translation>
     </message>
     <message>
-        <location filename="../moodle2pdf_gui.py" line="180"/>
-        <source>Separate export is not implemented yet.</source>
-        <translation>Export in einzelne Dateien ist noch nicht implementiert.</translation>
+        <location filename="../moodle2pdf_gui.py" line="205"/>
+        <source>Select Directory for PDF Files...</source>
+        <translation>Verzeichnis für PDF-Dateien auswählen...</translation>
+    </message>
+    <message>
+        <location filename="../moodle2pdf_gui.py" line="208"/>
+        <source>Building PDF files...</source>
+        <translation>Baue PDF-Dateien...</translation>
+    </message>
+    <message>
+        <location filename="../moodle2pdf_gui.py" line="216"/>
+        <source>Could not export these modules:
+{}</source>
+        <translation>Diese Module konnten nicht exportiert werden:
+{}</translation>
+    </message>
+    <message>
+        <location filename="../moodle2pdf_gui.py" line="220"/>
+        <source>Finished PDF files.</source>
+        <translation>PDF-Dateien erstellt.</translation>
     </message>
     <message>
         <location filename="../moodle2pdf_gui.py" line="182"/>